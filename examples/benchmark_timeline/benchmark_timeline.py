@@ -0,0 +1,154 @@
+"""
+Measure the throughput of the MFT timeline exporter on synthetic MFTs.
+
+usage: benchmark_timeline.py [record counts...]
+
+For each record count (default: 100000 1000000 10000000), this writes
+  a synthetic MFT to a temporary file, and reports the records/sec of
+  exporting it to each of the timeline formats. Parquet is skipped if
+  pyarrow is not installed.
+"""
+import os
+import time
+import struct
+import logging
+import tempfile
+
+from ntfs.BinaryParser import Mmap
+from ntfs.mft.MFT import MFTEnumerator
+from ntfs.mft.MFT import MFT_RECORD_SIZE
+from ntfs.mft.Timeline import TimelineExporter
+from ntfs.mft.Timeline import CSVTimelineWriter
+from ntfs.mft.Timeline import JSONLinesTimelineWriter
+from ntfs.mft.Timeline import ParquetTimelineWriter
+
+
+g_logger = logging.getLogger("ntfs.examples.benchmark_timeline")
+
+
+DEFAULT_RECORD_COUNTS = [100000, 1000000, 10000000]
+
+# a new directory every so many records, nested up to this depth
+DIRECTORY_INTERVAL = 64
+MAX_DEPTH = 8
+
+# 2017-01-01 00:00:00 as a FILETIME
+FILETIME = 131277024000000000
+NAME_LENGTH = 12
+
+SI_OFFSET = 0x38
+SI_SIZE = 0x60
+FN_OFFSET = SI_OFFSET + SI_SIZE
+FN_VALUE_OFFSET = FN_OFFSET + 0x18
+FN_SIZE = 0x18 + 0x42 + 2 * NAME_LENGTH + 6
+END_OFFSET = FN_OFFSET + FN_SIZE
+
+
+def make_record_template():
+    """
+    An in-use MFT record with resident $STANDARD_INFORMATION and
+      $FILENAME_INFORMATION attributes, whose record number,
+      flags, parent, and name are patched by `make_record`.
+    """
+    buf = bytearray(MFT_RECORD_SIZE)
+    # header: magic, usa offset, usa count, lsn, sequence, link count,
+    #  attrs offset, flags, bytes in use, bytes allocated
+    struct.pack_into("<IHHQHHHHII", buf, 0x0, 0x454C4946, 0x30, 3, 1,
+                     1, 1, SI_OFFSET, 0x1, END_OFFSET + 8, MFT_RECORD_SIZE)
+
+    struct.pack_into("<IIBBHHHIHBB", buf, SI_OFFSET,
+                     0x10, SI_SIZE, 0, 0, 0, 0, 0, 0x48, 0x18, 0, 0)
+    struct.pack_into("<QQQQI", buf, SI_OFFSET + 0x18,
+                     FILETIME, FILETIME, FILETIME, FILETIME, 0x20)
+
+    struct.pack_into("<IIBBHHHIHBB", buf, FN_OFFSET,
+                     0x30, FN_SIZE, 0, 0, 0, 0, 1, 0x42 + 2 * NAME_LENGTH, 0x18, 0, 0)
+    struct.pack_into("<QQQQQQQIIBB", buf, FN_VALUE_OFFSET,
+                     0, FILETIME, FILETIME, FILETIME, FILETIME,
+                     0, 0, 0x20, 0, NAME_LENGTH, 0x1)
+
+    struct.pack_into("<I", buf, END_OFFSET, 0xFFFFFFFF)
+    return buf
+
+
+def make_record(template, record_number, parent_number, is_directory):
+    buf = template
+    struct.pack_into("<I", buf, 0x2C, record_number)
+    struct.pack_into("<H", buf, 0x16, 0x3 if is_directory else 0x1)
+    struct.pack_into("<Q", buf, FN_VALUE_OFFSET, (1 << 48) | parent_number)
+    name = ("%012d" % record_number)[-NAME_LENGTH:].encode("utf-16le")
+    buf[FN_VALUE_OFFSET + 0x42:FN_VALUE_OFFSET + 0x42 + len(name)] = name
+
+    # update sequence array: the sequence value, then the original
+    #  last word of each sector
+    usn = "\x01\x00"
+    buf[0x30:0x32] = usn
+    buf[0x32:0x34] = buf[0x1FE:0x200]
+    buf[0x34:0x36] = buf[0x3FE:0x400]
+    buf[0x1FE:0x200] = usn
+    buf[0x3FE:0x400] = usn
+    ret = str(buf)
+    buf[0x1FE:0x200] = buf[0x32:0x34]
+    buf[0x3FE:0x400] = buf[0x34:0x36]
+    return ret
+
+
+def write_synthetic_mft(f, count):
+    """
+    Write `count` records into the given file, as a tree of nested
+      directories rooted at record 5.
+    """
+    template = make_record_template()
+    parents = [5]
+    for record_number in xrange(count):
+        if record_number == 5:
+            f.write(make_record(template, 5, 5, True))
+            continue
+        is_directory = record_number > 0 and record_number % DIRECTORY_INTERVAL == 0
+        if is_directory and len(parents) >= MAX_DEPTH:
+            # start a new chain of directories under the root,
+            #  rather than nesting this one any deeper
+            parents = [5]
+        f.write(make_record(template, record_number, parents[-1], is_directory))
+        if is_directory:
+            parents.append(record_number)
+
+
+def benchmark(mft_filename, count):
+    formats = [
+        ("csv", lambda f: CSVTimelineWriter(f)),
+        ("jsonl", lambda f: JSONLinesTimelineWriter(f)),
+    ]
+    try:
+        import pyarrow
+        formats.append(("parquet", lambda f: ParquetTimelineWriter(f.name)))
+    except ImportError:
+        g_logger.warning("pyarrow not installed, skipping Parquet")
+
+    with Mmap(mft_filename) as buf:
+        for name, make_writer in formats:
+            with tempfile.NamedTemporaryFile(suffix="." + name) as out:
+                exporter = TimelineExporter(MFTEnumerator(buf))
+                start = time.time()
+                rows = exporter.export(make_writer(out))
+                elapsed = time.time() - start
+                print("%10d records  %-8s %10.0f records/sec" %
+                      (count, name, rows / elapsed))
+
+
+def main(counts):
+    logging.basicConfig(level=logging.INFO)
+
+    for count in counts:
+        fd, mft_filename = tempfile.mkstemp(suffix=".mft")
+        try:
+            with os.fdopen(fd, "wb") as f:
+                write_synthetic_mft(f, count)
+            benchmark(mft_filename, count)
+        finally:
+            os.remove(mft_filename)
+
+
+if __name__ == '__main__':
+    import sys
+    main(map(int, sys.argv[1:]) or DEFAULT_RECORD_COUNTS)
@@ -125,11 +125,11 @@ def walk_directories(fs, directory, visitor):
       and a Directory
 
     this function applies the function `visitor` to each directory
-      in the file system recursively.
+      in the file system, top down. only the MFT records of the
+      directories are parsed, not those of the files.
     """
-    visitor(fs, directory)
-    for d in directory.get_directories():
-        walk_directories(fs, d, visitor)
+    for d, _, _ in directory.walk():
+        visitor(fs, d)
 
 
 def safe_date(f):
@@ -1,27 +1,41 @@
 """
 Dump the NTFS VBR for a volume.
+
+usage: inspect_vbr.py image [volume offset]
+
+If the volume offset is not given, the VBR of each NTFS volume
+  found in the image's partition table is dumped.
 """
 import logging
 
 from ntfs.volume import FlatVolume
 from ntfs.BinaryParser import Mmap
 from ntfs.filesystem import NTFSVBR
+from ntfs.volume.Partitions import find_ntfs_volumes
 
 
 g_logger = logging.getLogger("ntfs.examples.inspect_vbr")
 
 
-def main(image_filename, volume_offset):
+def main(image_filename, volume_offset=None):
     logging.basicConfig(level=logging.DEBUG)
     logging.getLogger("ntfs.mft").setLevel(logging.INFO)
 
     with Mmap(image_filename) as buf:
-        v = FlatVolume(buf, volume_offset)
-        vbr = NTFSVBR(v)
-        print(vbr.get_all_string())
+        if volume_offset is None:
+            volumes = find_ntfs_volumes(buf)
+        else:
+            volumes = [FlatVolume(buf, volume_offset)]
+
+        for v in volumes:
+            vbr = NTFSVBR(v)
+            print(vbr.get_all_string())
 
 
 if __name__ == '__main__':
     import sys
-    main(sys.argv[1], int(sys.argv[2]))
+    if len(sys.argv) > 2:
+        main(sys.argv[1], int(sys.argv[2]))
+    else:
+        main(sys.argv[1])
 
@@ -10,10 +10,12 @@ import calendar
 
 from fuse import FUSE, FuseOSError, Operations, fuse_get_context
 
+from ntfs.mft.MFT import Cache
 from ntfs.filesystem import NTFSFilesystem
 from ntfs.filesystem import ChildNotFoundError
 
 PERMISSION_ALL_READ = int("444", 8)
+PATH_ENTRY_CACHE_SIZE = 1024
 
 g_logger = logging.getLogger("ntfs.examples.mount")
 
@@ -55,8 +57,17 @@ class NTFSFuseOperations(Operations):
     def __init__(self, filesystem):
         self._fs = filesystem
         self._opened_files = {}
+        # map from path collation key to entry, since the kernel asks
+        #  for the same paths over and over, in any case.
+        self._path_entries = Cache(size_limit=PATH_ENTRY_CACHE_SIZE,
+                                   budget=filesystem.get_cache_budget())
 
     def _get_path_entry(self, path):
+        key = self._fs.get_collation_key(path)
+        entry = self._path_entries.lookup(key)
+        if entry is not None:
+            return entry
+
         root = self._fs.get_root_directory()
         if path == "/":
             g_logger.debug("asking for root")
@@ -68,6 +79,7 @@ class NTFSFuseOperations(Operations):
                 entry = root.get_path_entry(rest)
             except ChildNotFoundError:
                 raise FuseOSError(errno.ENOENT)
+        self._path_entries.insert(key, entry)
         return entry
 
     # Filesystem methods
@@ -101,7 +113,7 @@ class NTFSFuseOperations(Operations):
         dirents = ['.', '..']
         entry = self._get_path_entry(path)
 
-        dirents.extend(map(lambda r: r.get_name(), entry.get_children()))
+        dirents.extend(map(lambda e: e.filename(), entry.get_listing()))
         return dirents
 
     @log
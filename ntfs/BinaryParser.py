@@ -22,7 +22,8 @@ import sys
 import types
 import struct
 import logging
-import cPickle
+import functools
+import threading
 from datetime import datetime
 
 g_logger = logging.getLogger("ntfs.BinaryParser")
@@ -50,6 +51,26 @@ def unpack_from(fmt, buf, off=0):
         return struct.unpack_from(fmt, buf, 0x0)
 
 
+def view_buffer(buf, start, end):
+    """
+    Get a read-only view of the bytes buf[start:end] without copying them.
+
+    Things that provide their own `view` method (eg. a Volume) are asked
+      for it, while other __unpackable__ things (eg. FileMap) are sliced,
+      which copies the bytes.
+    Python 2 memory maps do not support memoryview, so they are viewed
+      with `buffer`.
+    """
+    if hasattr(buf, "view"):
+        return buf.view(start, end)
+    elif hasattr(buf, "__unpackable__"):
+        return buf[start:end]
+    elif isinstance(buf, mmap.mmap):
+        return buffer(buf, start, max(end - start, 0))
+    else:
+        return memoryview(buf)[start:end]
+
+
 def unpack(fmt, string):
     """
     Like the shimmed unpack_from, but for struct.unpack.
@@ -141,19 +162,147 @@ class decoratorargs(object):
         return decorator
 
 
+# the fields of a link in the list of a MemoizeCache
+_PREV, _NEXT, _KEY, _VALUE = 0, 1, 2, 3
+
+
+class MemoizeCache(object):
+    """
+    The least recently used results of a memoized method, for one instance.
+    Thread-safe.
+
+    The results are kept in a dict of links of a circular doubly linked
+      list, most recently used last, like Python 3's `lru_cache`, since
+      an OrderedDict is slow in Python 2. With a capacity of one, the
+      only result is kept as is.
+    """
+    __slots__ = ("_capacity", "_lock", "_links", "_root", "_last",
+                 "hits", "misses", "evictions")
+
+    def __init__(self, capacity):
+        self._capacity = capacity
+        self._lock = threading.Lock()
+        self._links = None
+        self._root = None
+        # tuple(key, value) of the only result, when the capacity is one
+        self._last = None
+        if capacity > 1:
+            self._links = {}
+            self._root = []
+            self._root[:] = [self._root, self._root, None, None]
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def lookup(self, key):
+        """
+        @rtype: tuple(bool, object)
+        @return: Whether the key was found, and its value.
+        @raises TypeError: if the key is not hashable.
+        """
+        with self._lock:
+            if self._links is None:
+                last = self._last
+                if last is not None and last[0] == key:
+                    self.hits += 1
+                    return True, last[1]
+                hash(key)
+                self.misses += 1
+                return False, None
+
+            link = self._links.get(key)
+            if link is None:
+                self.misses += 1
+                return False, None
+            # move the link to the end
+            prev, next_, _, value = link
+            prev[_NEXT] = next_
+            next_[_PREV] = prev
+            root = self._root
+            last = root[_PREV]
+            last[_NEXT] = root[_PREV] = link
+            link[_PREV] = last
+            link[_NEXT] = root
+            self.hits += 1
+            return True, value
+
+    def insert(self, key, value):
+        with self._lock:
+            if self._links is None:
+                if self._last is not None and self._last[0] != key:
+                    self.evictions += 1
+                self._last = (key, value)
+                return
+
+            if key in self._links:
+                self._links[key][_VALUE] = value
+                return
+            root = self._root
+            last = root[_PREV]
+            link = [last, root, key, value]
+            last[_NEXT] = root[_PREV] = self._links[key] = link
+            if len(self._links) > self._capacity:
+                oldest = root[_NEXT]
+                root[_NEXT] = oldest[_NEXT]
+                oldest[_NEXT][_PREV] = root
+                del self._links[oldest[_KEY]]
+                self.evictions += 1
+
+    def __len__(self):
+        with self._lock:
+            if self._links is None:
+                return 0 if self._last is None else 1
+            return len(self._links)
+
+    def clear(self):
+        with self._lock:
+            self._last = None
+            if self._links is not None:
+                self._links.clear()
+                self._root[:] = [self._root, self._root, None, None]
+
+    def stats(self):
+        """
+        @rtype: dict of str to int
+        """
+        return {
+            "entries": len(self),
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+        }
+
+    def __getstate__(self):
+        # locks cannot be pickled, and the results need not be
+        return {"_capacity": self._capacity}
+
+    def __setstate__(self, state):
+        self.__init__(state["_capacity"])
+
+
+# separates the positional and keyword arguments of a memoize key
+_MEMOIZE_KWARGS_MARK = object()
+
+
 class memoize(decoratorargs):
-    class Node:
-        __slots__ = ['key', 'value', 'older', 'newer']
-
-        def __init__(self, key, value, older=None, newer=None):
-            self.key = key
-            self.value = value
-            self.older = older
-            self.newer = newer
-
-    def __init__(self, func, capacity=1000,
-                 keyfunc=lambda *args, **kwargs: cPickle.dumps((args,
-                                                                kwargs))):
+    """
+    Memoize a method or property, per instance, keeping the results
+      of the most recently used arguments.
+
+    The results are stored in a MemoizeCache in the `__dict__` of
+      each instance, so they are not shared across instances, and are
+      released with the instance. The arguments must be hashable;
+      calls with unhashable arguments are not memoized.
+
+    Usage:
+
+        @memoize(capacity=1)
+        def header(self):
+            ...
+
+    The statistics of an instance are `Class.header.stats(instance)`.
+    """
+    def __init__(self, func, capacity=1000):
         if not isinstance(func, property):
             self.func = func
             self.name = func.__name__
@@ -163,85 +312,55 @@ class memoize(decoratorargs):
             self.name = func.fget.__name__
             self.is_property = True
         self.capacity = capacity
-        self.keyfunc = keyfunc
-        self.reset()
-
-    def reset(self):
-        self.mru = self.Node(None, None)
-        self.mru.older = self.mru.newer = self.mru
-        self.nodes = {self.mru.key: self.mru}
-        self.count = 1
-        self.hits = 0
-        self.misses = 0
+        self._attr = "_memoize_" + self.name
+
+    def _get_cache(self, inst):
+        cache = inst.__dict__.get(self._attr)
+        if cache is None:
+            # setdefault, in case another thread got here first
+            cache = inst.__dict__.setdefault(self._attr, MemoizeCache(self.capacity))
+        return cache
 
     def __get__(self, inst, clas):
-        self.obj = inst
+        if inst is None:
+            return self
         if self.is_property:
-            return self.__call__()
+            return self.call(inst)
+        return functools.partial(self.call, inst)
+
+    def call(self, inst, *args, **kwargs):
+        if kwargs:
+            key = args + (_MEMOIZE_KWARGS_MARK,) + tuple(sorted(kwargs.items()))
         else:
-            return self
+            key = args
 
-    def __call__(self, *args, **kwargs):
-        key = self.keyfunc(*args, **kwargs)
+        cache = self._get_cache(inst)
         try:
-            node = self.nodes[key]
-        except KeyError:
-            # We have an entry not in the cache
-            self.misses += 1
-            func = types.MethodType(self.func, self.obj, self.name)
-            value = func(*args, **kwargs)
-            lru = self.mru.newer  # Always true
-            # If we haven't reached capacity
-            if self.count < self.capacity:
-                # Put it between the MRU and LRU - it'll be the new MRU
-                node = self.Node(key, value, self.mru, lru)
-                self.mru.newer = node
-
-                lru.older = node
-                self.mru = node
-                self.count += 1
-            else:
-                # It's FULL! We'll make the LRU be the new MRU, but replace its
-                # value first
-                try:
-                    del self.nodes[lru.key]  # This mapping is now invalid
-                except KeyError:  # HACK TODO: this may not work/leak
-                    pass
-                lru.key = key
-                lru.value = value
-                self.mru = lru
-
-            # Add the new mapping
-            self.nodes[key] = self.mru
+            found, value = cache.lookup(key)
+        except TypeError:  # unhashable arguments
+            return self.func(inst, *args, **kwargs)
+        if found:
             return value
 
-        # We have an entry in the cache
-        self.hits += 1
-
-        # If it's already the MRU, do nothing
-        if node is self.mru:
-            return node.value
-
-        lru = self.mru.newer  # Always true
-
-        # If it's the LRU, update the MRU to be it
-        if node is lru:
-            self.mru = lru
-            return node.value
+        # the method is called outside the lock, so two threads may both
+        #  compute a missing result, but the results are the same
+        value = self.func(inst, *args, **kwargs)
+        cache.insert(key, value)
+        return value
 
-        # Remove the node from the list
-        node.older.newer = node.newer
-        node.newer.older = node.older
-
-        # Put it between MRU and LRU
-        node.older = self.mru
-        self.mru.newer = node
-
-        node.newer = lru
-        lru.older = node
+    def stats(self, inst):
+        """
+        @rtype: dict of str to int
+        """
+        return self._get_cache(inst).stats()
 
-        self.mru = node
-        return node.value
+    def reset(self, inst):
+        """
+        Forget the memoized results of the given instance.
+        """
+        cache = inst.__dict__.get(self._attr)
+        if cache is not None:
+            cache.clear()
 
 
 def align(offset, alignment):
@@ -385,11 +504,245 @@ def read_dword(buf, offset):
         raise OverrunBufferException(offset, len(buf))
 
 
+def read_qword(buf, offset):
+    """
+    Returns a little-endian unsigned qword from the relative offset of the given buffer.
+    Arguments:
+    - `buf`: The buffer from which to read the value.
+    - `offset`: The relative offset from the start of the block.
+    Throws:
+    - `OverrunBufferException`
+    """
+    try:
+        return unpack_from("<Q", buf, offset)[0]
+    except struct.error:
+        raise OverrunBufferException(offset, len(buf))
+
+
+class StructLayout(object):
+    """
+    A declarative structure layout that is compiled once into a
+      `struct.Struct` and a table of accessors.
+
+    `Block.declare_field` builds closures and bookkeeping for every
+      field of every instance. When a structure has a fixed layout,
+      declare it once with a StructLayout, install the accessors onto
+      the class with the `layout` class decorator, and parse each
+      instance with a single `Block.unpack_layout` call.
+    The accessors keep the `declare_field` API, eg. `record.flags()`.
+
+    Only fixed size, little-endian types are supported.
+    """
+    CODES = {
+        "byte": "B",
+        "int8": "b",
+        "word": "H",
+        "int16": "h",
+        "dword": "I",
+        "int32": "i",
+        "qword": "Q",
+        "int64": "q",
+        "float": "f",
+        "double": "d",
+        "filetime": "Q",
+    }
+
+    CONVERTERS = {
+        "filetime": parse_filetime,
+    }
+
+    def __init__(self, fields):
+        """
+        Constructor.
+        Arguments:
+        - `fields`: A sequence of tuples (type_, name[, offset[, length]])
+            with the same meaning as the parameters to `declare_field`.
+            If the offset is None or not provided, then the field
+            immediately follows the previous field.
+            The `binary` type requires a length.
+        """
+        super(StructLayout, self).__init__()
+        fmt = ["<"]
+        current = 0
+        # list of tuple(name, offset, type_, length)
+        self.fields = []
+        self.declared_fields = []
+        for field in fields:
+            type_, name = field[0], field[1]
+            offset = field[2] if len(field) > 2 else None
+            length = field[3] if len(field) > 3 else None
+
+            if offset is None:
+                offset = current
+            if offset < current:
+                raise ParseException("Overlapping field in layout: " + name)
+            if offset > current:
+                fmt.append("%dx" % (offset - current))
+
+            if type_ == "binary":
+                if length is None:
+                    raise ParseException("Binary layout field requires a length: " + name)
+                fmt.append("%ds" % length)
+                size = length
+            elif type_ in StructLayout.CODES:
+                code = StructLayout.CODES[type_]
+                fmt.append(code)
+                size = struct.calcsize("<" + code)
+            else:
+                raise ParseException("Layout not supported for type: " + type_)
+
+            self.fields.append((name, offset, type_, length))
+            self.declared_fields.append({
+                "offset": offset,
+                "type": type_,
+                "name": name,
+                "length": length,
+                "count": 1,
+                })
+            current = offset + size
+
+        self._struct = struct.Struct("".join(fmt))
+        self.size = current
+        self.offsets = dict((f[0], f[1]) for f in self.fields)
+
+    def __repr__(self):
+        return "StructLayout(%s)" % (", ".join(f[0] for f in self.fields))
+
+    def unpack_from(self, buf, offset=0):
+        """
+        Unpack all of the fields of this layout at once.
+        Arguments:
+        - `buf`: The buffer from which to read the values.
+        - `offset`: The absolute offset of the structure.
+        Throws:
+        - `OverrunBufferException`
+        """
+        try:
+            if hasattr(buf, "__unpackable__"):
+                return self._struct.unpack_from(buf[offset:offset + self.size], 0)
+            return self._struct.unpack_from(buf, offset)
+        except struct.error:
+            raise OverrunBufferException(offset + self.size, len(buf))
+
+
+def _make_layout_accessor(index, converter):
+    if converter is None:
+        def accessor(self):
+            return self._values[index]
+    else:
+        def accessor(self):
+            return converter(self._values[index])
+    return accessor
+
+
+def _make_variant_layout_accessor(name, table):
+    """
+    `table` is a dict from StructLayout to tuple(index, converter).
+    """
+    def accessor(self):
+        try:
+            index, converter = table[self._layout]
+        except KeyError:
+            raise AttributeError("%s has no field %s" %
+                                 (self.__class__.__name__, name))
+        if converter is None:
+            return self._values[index]
+        return converter(self._values[index])
+    return accessor
+
+
+def layout(*layouts):
+    """
+    Class decorator that installs the accessors for the given StructLayouts
+      onto a Block subclass.
+
+    With a single layout, the layout is available as `cls.LAYOUT`.
+    With many layouts (eg. resident and non-resident attributes), each
+      instance picks one when it calls `unpack_layout`, and they are
+      available as `cls.LAYOUTS`. Fields found at the same position in
+      every layout are read directly; the remainder raise AttributeError
+      when the instance's layout does not provide them.
+    """
+    def decorator(cls):
+        # map from field name to dict(StructLayout, tuple(index, converter))
+        tables = {}
+        offsets = {}
+        for l in layouts:
+            for index, (name, offset, type_, _) in enumerate(l.fields):
+                converter = StructLayout.CONVERTERS.get(type_)
+                tables.setdefault(name, {})[l] = (index, converter)
+                offsets.setdefault(name, set()).add(offset)
+
+        for name, table in tables.iteritems():
+            entries = set(table.values())
+            if len(table) == len(layouts) and len(entries) == 1:
+                index, converter = entries.pop()
+                setattr(cls, name, _make_layout_accessor(index, converter))
+            else:
+                setattr(cls, name, _make_variant_layout_accessor(name, table))
+            if len(offsets[name]) == 1:
+                setattr(cls, "_off_" + name, iter(offsets[name]).next())
+
+        if len(layouts) == 1:
+            cls.LAYOUT = layouts[0]
+        else:
+            cls.LAYOUTS = layouts
+        return cls
+    return decorator
+
+
+def _make_view_accessor(field_struct, field_offset, converter):
+    unpack_field = field_struct.unpack_from
+    size = field_struct.size
+
+    def accessor(self):
+        buf = self._buf
+        o = self._offset + field_offset
+        try:
+            if hasattr(buf, "__unpackable__"):
+                v = unpack_field(buf[o:o + size], 0)[0]
+            else:
+                v = unpack_field(buf, o)[0]
+        except struct.error:
+            raise OverrunBufferException(o, len(buf))
+        if converter is None:
+            return v
+        return converter(v)
+    return accessor
+
+
+def layout_view(layout):
+    """
+    Class decorator that installs accessors for the fields of the given
+      StructLayout that read each value straight from `self._buf` at
+      `self._offset` when called, rather than unpacking the whole
+      structure up front.
+
+    This suits lightweight views (possibly with `__slots__`) over large
+      buffers when only a few fields of each structure are inspected.
+    """
+    def decorator(cls):
+        for name, offset, type_, length in layout.fields:
+            if type_ == "binary":
+                code = "%ds" % length
+            else:
+                code = StructLayout.CODES[type_]
+            field_struct = struct.Struct("<" + code)
+            setattr(cls, name,
+                    _make_view_accessor(field_struct, offset,
+                                        StructLayout.CONVERTERS.get(type_)))
+        cls.LAYOUT = layout
+        return cls
+    return decorator
+
+
 class Block(object):
     """
     Base class for structure blocks in binary parsing.
     A block is associated with a offset into a byte-string.
     """
+    _layout = None
+
     def __init__(self, buf, offset):
         """
         Constructor.
@@ -407,6 +760,22 @@ class Block(object):
     def __repr__(self):
         return "Block(buf=%r, offset=%r)" % (self._buf, self._offset)
 
+    def unpack_layout(self, layout):
+        """
+        Parse all the fields of a precompiled StructLayout with
+          a single unpack.
+        The class must have had the layout's accessors installed
+          using the `layout` class decorator.
+
+        Arguments:
+        - `layout`: A StructLayout.
+        Throws:
+        - `OverrunBufferException`
+        """
+        self._values = layout.unpack_from(self._buf, self._offset)
+        self._layout = layout
+        self._implicit_offset = layout.size
+
     def declare_field(self, type_, name, offset=None, length=None, count=None):
         """
         Declaratively add fields to this block.
@@ -492,9 +861,17 @@ class Block(object):
                         ofs += len(r)
                     self._implicit_offset = ofs
             else:
-                # TODO(wb): this needs to cache/memoize
+                # the structure is parsed once, unless the buffer is
+                #  replaced, such as by fixups
+                parsed = []
+
                 def class_handler():
-                    return type_(self._buf, self.absolute_offset(offset), self)
+                    buf = self._buf
+                    if parsed and parsed[0] is buf:
+                        return parsed[1]
+                    ret = type_(buf, self.absolute_offset(offset), self)
+                    parsed[:] = [buf, ret]
+                    return ret
                 handler = class_handler
 
                 if hasattr(type_, "structure_size"):
@@ -596,7 +973,10 @@ class Block(object):
         @return A nicely formatted string that describes this structure.
         """
         ret = ""
-        for field in self._declared_fields:
+        fields = self._declared_fields
+        if self._layout is not None:
+            fields = self._layout.declared_fields + fields
+        for field in fields:
             v = getattr(self, field["name"])()
             if isinstance(v, Block):
                 if hasattr(v, "string"):
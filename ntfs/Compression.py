@@ -0,0 +1,136 @@
+#!/usr/bin/python
+"""
+Decompression of the LZNT1 format used by NTFS compressed attributes.
+
+A compressed stream is a sequence of chunks, each of which decompresses
+  to (at most) 4096 bytes. Each chunk starts with a two byte header
+  that provides the chunk's data size, and whether its data is
+  compressed. Compressed data is a sequence of groups of eight tokens,
+  each group preceded by a byte of flags that describe whether each
+  token is a literal byte, or a two byte back reference into the
+  data already decompressed from the chunk.
+"""
+import struct
+
+
+LZNT1_CHUNK_SIZE = 0x1000
+LZNT1_CHUNK_COMPRESSED = 0x8000
+LZNT1_CHUNK_SIZE_MASK = 0x0FFF
+
+
+class DecompressionError(Exception):
+    def __init__(self, msg):
+        super(DecompressionError, self).__init__(msg)
+        self._msg = msg
+
+    def __str__(self):
+        return "DecompressionError(%s)" % (self._msg)
+
+
+def _decompress_chunk(chunk, out):
+    """
+    Decompress the data of a single compressed chunk, appending to `out`.
+
+    @type chunk: str
+    @type out: bytearray
+    """
+    chunk_start = len(out)
+    chunk_len = len(chunk)
+    i = 0
+    while i < chunk_len:
+        flags = ord(chunk[i])
+        i += 1
+        for bit in xrange(8):
+            if i >= chunk_len:
+                break
+
+            if not flags & (1 << bit):
+                out.append(chunk[i])
+                i += 1
+                continue
+
+            if i + 2 > chunk_len:
+                raise DecompressionError("truncated back reference")
+            tag = struct.unpack_from("<H", chunk, i)[0]
+            i += 2
+
+            # the more data decompressed from the chunk, the more bits
+            #  of the tag are used for the back reference offset
+            position = len(out) - chunk_start - 1
+            offset_shift = 12
+            length_mask = 0x0FFF
+            while position >= 0x10:
+                position >>= 1
+                offset_shift -= 1
+                length_mask >>= 1
+
+            back = (tag >> offset_shift) + 1
+            length = (tag & length_mask) + 3
+            source = len(out) - back
+            if source < chunk_start:
+                raise DecompressionError("back reference before start of chunk")
+
+            if back >= length:
+                out.extend(out[source:source + length])
+            else:
+                # the reference overlaps the bytes it produces,
+                #  so it repeats the last `back` bytes
+                pattern = out[source:]
+                out.extend((pattern * (length // back + 1))[:length])
+
+
+def lznt1_decompress(buf):
+    """
+    Decompress a LZNT1 compressed stream.
+
+    @type buf: str
+    @rtype: bytearray
+    @raises DecompressionError: if the stream is corrupt.
+    """
+    out = bytearray()
+    offset = 0
+    chunk_count = 0
+    while offset + 2 <= len(buf):
+        header = struct.unpack_from("<H", buf, offset)[0]
+        if header == 0:
+            break
+        offset += 2
+
+        # a chunk that decompresses to less than the chunk size,
+        #  and is followed by another chunk, is padded with zeros
+        out.extend("\x00" * (chunk_count * LZNT1_CHUNK_SIZE - len(out)))
+        chunk_count += 1
+
+        size = (header & LZNT1_CHUNK_SIZE_MASK) + 1
+        chunk = buf[offset:offset + size]
+        offset += size
+        if len(chunk) < size:
+            raise DecompressionError("truncated chunk")
+
+        if header & LZNT1_CHUNK_COMPRESSED:
+            _decompress_chunk(chunk, out)
+        else:
+            out.extend(chunk)
+    return out
+
+
+def test():
+    # literals, then a back reference that overlaps itself
+    assert lznt1_decompress("\x05\xb0\x08abc\x06\x20") == "abc" * 4
+    # an uncompressed chunk
+    assert lznt1_decompress("\x03\x30abcd\x00\x00") == "abcd"
+    # a short chunk followed by another chunk is padded
+    ret = lznt1_decompress("\x03\x30abcd\x01\x30ef")
+    assert ret == "abcd" + "\x00" * (LZNT1_CHUNK_SIZE - 4) + "ef"
+
+    try:
+        lznt1_decompress("\x05\xb0\x01\x06\x20")
+    except DecompressionError:
+        pass
+    else:
+        assert False, "expected DecompressionError"
+    print "lznt1 passed tests."
+
+
+if __name__ == "__main__":
+    test()
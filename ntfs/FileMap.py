@@ -1,6 +1,9 @@
 #!/usr/bin/python
 
 import sys
+import Queue
+import weakref
+import threading
 from struct import unpack_from as old_unpack_from
 from struct import unpack_from as old_unpack
 from struct import calcsize
@@ -13,6 +16,24 @@ from SortedCollection import SortedCollection
 MEGABYTE = 1024 * 1024
 
 
+def _readahead_worker(filemap_ref, queue):
+    """
+    Read the blocks queued by a FileMap into its cache, until it is
+      closed or collected.
+    The thread holds only a weak reference to the FileMap, so that an
+      unused FileMap is collected, and this thread then exits.
+    """
+    while True:
+        block_number = queue.get()
+        if block_number is None:
+            return
+        filemap = filemap_ref()
+        if filemap is None:
+            return
+        filemap._prefetch_block(block_number)
+        del filemap
+
+
 class LRUQueue(object):
     """
     LRUQueue is a data structure that orders objects by
@@ -286,13 +307,30 @@ class FileMap(object):
        2) You can stack this over any Python file-like objects.
             eg. FileMap over ZipFile gives you a random access buffer
                   thats backed by a compressed image on the file system.
+
+    The file is read in aligned blocks of `block_size` bytes, and the
+      most recently used blocks are cached by block number, so finding
+      the block that contains an offset is a single dict lookup.
+    Slices that span blocks are assembled with a single allocation,
+      and `readinto` fills a caller's preallocated buffer directly.
+
+    If `readahead` is provided, then once blocks are accessed in
+      sequence, up to that many of the following blocks are read by
+      a background thread, so the reads overlap with the caller's
+      processing. Use `get_stats` to see how useful this is.
+    The thread is stopped by `close`, or when the FileMap is used as a
+      context manager and exits, or else when the FileMap is collected.
     """
     __unpackable__ = True
     def __init__(self, filelike, block_size=MEGABYTE,
-                 cache_size=10, size=None):
+                 cache_size=10, size=None, readahead=0):
         """
         If `size` is not provided, then `filelike` must have the
           `seek` and `tell` methods implemented.
+
+        The `readahead` window is limited to one less than the
+          `cache_size`, so prefetched blocks do not evict the block
+          in use.
         """
         super(FileMap, self).__init__()
         if size is None:
@@ -302,81 +340,241 @@ class FileMap(object):
         self._f = filelike
         self._block_size = block_size
         self._size = size
-        self._block_cache = RangeCache(cache_size)
+        self._cache_size = cache_size
+        # map from block number to block
+        self._blocks = {}
+        # map from block number to the tick of its last use.
+        #  a hit only updates a tick, and the least recently used
+        #  block is found when one must be evicted.
+        self._block_ticks = {}
+        self._tick = 0
+
+        self._readahead = max(0, min(readahead, cache_size - 1))
+        self._last_block_number = None
+        # blocks queued for, or being read by, the readahead thread
+        self._pending = set()
+        # prefetched blocks that have not been used yet
+        self._prefetched = set()
+        self._readahead_queue = None
+        self._readahead_thread = None
+        # protects the cache state
+        self._cond = threading.Condition()
+        # serializes the seeks and reads of the file
+        self._io_lock = threading.Lock()
+
+        self._hits = 0
+        self._misses = 0
+        self._prefetches = 0
+        self._prefetch_hits = 0
+        self._prefetch_wasted = 0
+
+    def _read_block(self, block_number):
+        with self._io_lock:
+            self._f.seek(block_number * self._block_size)
+            return self._f.read(self._block_size)
+
+    def _insert_block(self, block_number, buf):
+        """
+        Add a block to the cache, evicting the least recently used
+          block, if necessary. The caller must hold `self._cond`.
+        """
+        if len(self._blocks) >= self._cache_size:
+            ticks = self._block_ticks
+            lru_block_number = min(ticks, key=ticks.get)
+            del self._blocks[lru_block_number]
+            del ticks[lru_block_number]
+            if lru_block_number in self._prefetched:
+                self._prefetched.discard(lru_block_number)
+                self._prefetch_wasted += 1
+        self._blocks[block_number] = buf
+        self._block_ticks[block_number] = self._tick
+
+    def _schedule_readahead(self, block_number):
+        """
+        If the given block follows the last block accessed, then
+          queue the blocks that follow it for the readahead thread.
+          The caller must hold `self._cond`.
+        """
+        last_block_number = self._last_block_number
+        self._last_block_number = block_number
+        if last_block_number is None or block_number != last_block_number + 1:
+            return
+
+        if self._readahead_thread is None:
+            queue = Queue.Queue()
+            # when this FileMap is collected, wake the thread so it exits
+            filemap_ref = weakref.ref(self, lambda _: queue.put(None))
+            self._readahead_queue = queue
+            self._readahead_thread = threading.Thread(target=_readahead_worker,
+                                                      args=(filemap_ref, queue))
+            self._readahead_thread.daemon = True
+            self._readahead_thread.start()
+
+        last_block = (self._size - 1) // self._block_size
+        for next_block_number in xrange(block_number + 1,
+                                        min(block_number + self._readahead, last_block) + 1):
+            if next_block_number in self._blocks or next_block_number in self._pending:
+                continue
+            self._pending.add(next_block_number)
+            self._readahead_queue.put(next_block_number)
+
+    def _prefetch_block(self, block_number):
+        """
+        Read a block queued by `_schedule_readahead`, on the
+          readahead thread.
+        """
+        buf = self._read_block(block_number)
+        with self._cond:
+            self._pending.discard(block_number)
+            if block_number not in self._blocks:
+                self._insert_block(block_number, buf)
+                self._prefetched.add(block_number)
+                self._prefetches += 1
+            self._cond.notify_all()
+
+    def _get_block(self, block_number):
+        """
+        Get the block with the given number, updating the cache.
+        """
+        if self._readahead:
+            return self._get_block_with_readahead(block_number)
+
+        self._tick += 1
+        buf = self._blocks.get(block_number)
+        if buf is not None:
+            self._hits += 1
+            self._block_ticks[block_number] = self._tick
+            return buf
 
-    def __getitem__(self, index):
-        if index < 0:
-            index = self._size + index
-        block_index = index % self._block_size
-        block_start = index - block_index
-
-        try:
-            hit = self._block_cache.get(index)
-            buf = hit[2]
-            self._block_cache.touch(hit)
-            return buf[block_index]
-        except ValueError:
-            self._f.seek(block_start)
-            buf = self._f.read(self._block_size)
-            self._block_cache.push((block_start, self._block_size, buf))
-            return buf[block_index]
-
-    def _get_containing_block(self, index):
+        self._misses += 1
+        buf = self._read_block(block_number)
+        self._insert_block(block_number, buf)
+        return buf
+
+    def _get_block_with_readahead(self, block_number):
         """
-        Given an index, return block-aligned block that contains it,
-          updating the appropriate caches.
+        Like `_get_block`, but synchronized with the readahead thread.
         """
-        block_index = index % self._block_size
-        block_start = index - block_index
+        if block_number == self._last_block_number:
+            # fast path for repeated accesses to the same block,
+            #  which is already the most recently used.
+            buf = self._blocks.get(block_number)
+            if buf is not None:
+                self._hits += 1
+                return buf
+
+        with self._cond:
+            self._tick += 1
+            if block_number != self._last_block_number:
+                self._schedule_readahead(block_number)
+
+            while block_number in self._pending:
+                # the readahead thread is reading it now
+                self._cond.wait()
+
+            buf = self._blocks.get(block_number)
+            if buf is not None:
+                self._hits += 1
+                if block_number in self._prefetched:
+                    self._prefetched.discard(block_number)
+                    self._prefetch_hits += 1
+                self._block_ticks[block_number] = self._tick
+                return buf
+            self._misses += 1
+
+        buf = self._read_block(block_number)
+        with self._cond:
+            if block_number not in self._blocks:
+                self._insert_block(block_number, buf)
+        return buf
+
+    def get_stats(self):
+        """
+        Get the counters of the block cache:
+          - `hits`: block accesses found in the cache
+          - `misses`: block accesses that read the file
+          - `prefetches`: blocks read by the readahead thread
+          - `prefetch_hits`: prefetched blocks that were then accessed
+          - `prefetch_wasted`: prefetched blocks evicted before access
+
+        @rtype: dict of str to int
+        """
+        with self._cond:
+            return {
+                "hits": self._hits,
+                "misses": self._misses,
+                "prefetches": self._prefetches,
+                "prefetch_hits": self._prefetch_hits,
+                "prefetch_wasted": self._prefetch_wasted,
+            }
+
+    def close(self):
+        """
+        Stop the readahead thread, if its running.
+        The underlying file-like object is not closed.
+        """
+        if self._readahead_thread is not None:
+            self._readahead_queue.put(None)
+            self._readahead_thread.join()
+            self._readahead_thread = None
 
-        try:
-            hit = self._block_cache.get(block_start)
-            buf = hit[2]
-            self._block_cache.touch(hit)
-            return buf
-        except ValueError:
-            self._f.seek(block_start)
-            buf = self._f.read(self._block_size)
-            self._block_cache.push((block_start, self._block_size, buf))
-            return buf
+    def __enter__(self):
+        return self
 
-    def __getslice__(self, start, end):
-        if end == sys.maxint:
-            end = self._size
+    def __exit__(self, type, value, traceback):
+        self.close()
 
-        start_block_index = start % self._block_size
-        start_block_start = start - start_block_index
+    def __getitem__(self, index):
+        if index < 0:
+            index = self._size + index
+        block_number, block_index = divmod(index, self._block_size)
+        return self._get_block(block_number)[block_index]
 
-        end_block_index = end % self._block_size
-        end_block_start = end - end_block_index
+    def __getslice__(self, start, end):
+        end = min(end, self._size)
+        if end <= start:
+            return ""
 
-        if start_block_start == end_block_start:
+        start_block_number, start_block_index = divmod(start, self._block_size)
+        end_block_number = (end - 1) // self._block_size
+        if start_block_number == end_block_number:
             # easy case, everything falls within the same block
-            buf = self._get_containing_block(start)
-            return buf[start_block_index:end_block_index]
+            buf = self._get_block(start_block_number)
+            return buf[start_block_index:end - start_block_number * self._block_size]
         else:
-            # hard case, slice goes over one or more block boundaries
-            ret = ""
-
-            # phase 1, start to block boundary
-            buf = self._get_containing_block(start_block_start)
-            s = start_block_index
-            e = start_block_start + self._block_size
-            ret += buf[s:e]
-
-            # phase 2, any complete blocks
-            cur_block_start = start_block_start + self._block_size
-            while cur_block_start + self._block_size < end_block_start:
-                buf = self._get_containing_block(cur_block_start)
-                ret += buf
-                cur_block_start += self._block_size
-
-            # phase 3, block boundary to end
-            buf = self._get_containing_block(cur_block_start)
-            s = 0
-            e = end_block_index or self._block_size
-            ret += buf[0:e]
-            return ret
+            # hard case, slice goes over one or more block boundaries.
+            # the join allocates the result once, and the complete
+            #  blocks in the middle are not copied beforehand.
+            end_block_index = end - end_block_number * self._block_size
+            parts = [self._get_block(start_block_number)[start_block_index:]]
+            for block_number in xrange(start_block_number + 1, end_block_number):
+                parts.append(self._get_block(block_number))
+            parts.append(self._get_block(end_block_number)[:end_block_index])
+            return "".join(parts)
+
+    def readinto(self, offset, buf):
+        """
+        Read the bytes starting at the given offset into a buffer,
+          such as a bytearray, until it is full.
+
+        @type offset: int
+        @param buf: A writable buffer.
+        @rtype: int
+        @return: The number of bytes read, which is less than the
+          length of the buffer if the end of the file is reached.
+        """
+        end = min(offset + len(buf), self._size)
+        current = offset
+        while current < end:
+            block_number, block_index = divmod(current, self._block_size)
+            block = self._get_block(block_number)
+            chunk = buffer(block, block_index, end - current)
+            if len(chunk) == 0:
+                # the file is shorter than expected
+                break
+            buf[current - offset:current - offset + len(chunk)] = chunk
+            current += len(chunk)
+        return current - offset
 
     def __len__(self):
         return self._size
@@ -409,6 +607,51 @@ class FileMap(object):
         assert buf[-4:] == "efgh"
         assert buf[-8:] == "4567efgh"
 
+        assert buf[3:13] == "3abcd4567e"
+        assert buf[8:4] == ""
+        assert len(buf._blocks) == 2
+
+        # the least recently used block is evicted
+        buf[0], buf[4], buf[0], buf[8]
+        assert sorted(buf._blocks.keys()) == [0, 2]
+
+        b = bytearray(6)
+        assert buf.readinto(3, b) == 6
+        assert b == "3abcd4"
+        assert buf.readinto(14, b) == 2
+        assert b[:2] == "gh"
+
+        # the file is shorter than the given size
+        buf = FileMap(StringIO("0123ab"), block_size=4, size=8)
+        assert buf[2:8] == "23ab"
+
+        # sequential access with readahead
+        buf = FileMap(StringIO("0123abcd4567efgh"), block_size=4,
+                      cache_size=3, readahead=2)
+        assert "".join(buf[i] for i in xrange(16)) == "0123abcd4567efgh"
+        assert buf[:] == "0123abcd4567efgh"
+        stats = buf.get_stats()
+        assert stats["hits"] + stats["misses"] >= 16
+        assert stats["prefetch_hits"] <= stats["prefetches"]
+        buf.close()
+
+        # the readahead thread stops when the context exits...
+        with FileMap(StringIO("0123abcd4567efgh"), block_size=4,
+                     cache_size=3, readahead=2) as buf:
+            assert buf[0:16] == "0123abcd4567efgh"
+            thread = buf._readahead_thread
+            assert thread is not None
+        assert not thread.is_alive()
+
+        # ...or when the FileMap is collected, without being closed
+        unclosed = FileMap(StringIO("0123abcd4567efgh"), block_size=4,
+                           cache_size=3, readahead=2)
+        assert unclosed[0:16] == "0123abcd4567efgh"
+        thread = unclosed._readahead_thread
+        del unclosed
+        thread.join(5)
+        assert not thread.is_alive()
+
         return True
 
 
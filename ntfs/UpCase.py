@@ -0,0 +1,147 @@
+#!/usr/bin/python
+"""
+Case-insensitive comparison of filenames, as NTFS collates them.
+
+NTFS compares filenames by first mapping each UTF-16 code unit to its
+  uppercase form using the volume's $UpCase table (the file with
+  MFT record 10), and then comparing the code units. The table is
+  written when the volume is formatted, so it may differ from the
+  case mapping of Python's unicode database.
+"""
+import sys
+import array
+
+
+UPCASE_TABLE_SIZE = 0x20000  # 65536 UTF-16 code units
+DEFAULT_KEY_CACHE_SIZE = 0x10000  # keys
+
+
+class UpCaseTable(object):
+    """
+    A $UpCase table, with the collation keys of filenames.
+
+    The key of a filename is its uppercase form, encoded as big endian
+      UTF-16, so that comparing the keys of two filenames compares
+      their code units in the order used by the directory indexes.
+    The keys of recently used filenames are cached, so they can be
+      shared by directory index searches and path lookups.
+    """
+    def __init__(self, table=None, key_cache_size=DEFAULT_KEY_CACHE_SIZE):
+        """
+        Constructor.
+        Arguments:
+        - `table`: (Optional) Sequence of the uppercase form of each
+            code unit. Defaults to the uppercase forms given by Python.
+        - `key_cache_size`: The maximum number of cached keys.
+        """
+        super(UpCaseTable, self).__init__()
+        if table is None:
+            table = default_upcase_table()
+        # unicode.translate only needs the code units that change
+        self._map = dict((i, u) for i, u in enumerate(table) if i != u)
+        self._key_cache = {}
+        self._key_cache_size = key_cache_size
+
+    @classmethod
+    def from_buffer(cls, buf, key_cache_size=DEFAULT_KEY_CACHE_SIZE):
+        """
+        Parse the contents of the $UpCase file.
+
+        @type buf: str
+        @rtype: UpCaseTable
+        """
+        table = array.array("H", str(buf[:UPCASE_TABLE_SIZE]))
+        if sys.byteorder == "big":
+            table.byteswap()
+        return cls(table, key_cache_size=key_cache_size)
+
+    def upcase(self, name):
+        """
+        @type name: str or unicode
+        @param name: A filename. A str is decoded as UTF-8.
+        @rtype: unicode
+        """
+        if isinstance(name, str):
+            name = name.decode("utf-8")
+        return name.translate(self._map)
+
+    def compute_key(self, name):
+        """
+        Like `key`, but the key is not cached.
+        Use this for one-off keys, such as those of whole paths.
+
+        @rtype: str
+        """
+        # big endian UTF-16 orders like the code units
+        return self.upcase(name).encode("utf-16-be")
+
+    def key(self, name):
+        """
+        Get the collation key of the given filename: compare the keys
+          of two filenames to compare the filenames, ignoring case.
+
+        @type name: str or unicode
+        @rtype: str
+        """
+        try:
+            return self._key_cache[name]
+        except KeyError:
+            pass
+        if len(self._key_cache) >= self._key_cache_size:
+            self._key_cache.clear()
+        ret = self._key_cache[name] = self.compute_key(name)
+        return ret
+
+    def compare(self, a, b):
+        """
+        Compare two filenames, ignoring case, like `cmp`.
+
+        @rtype: int
+        """
+        return cmp(self.key(a), self.key(b))
+
+    def equals(self, a, b):
+        """
+        Are the two filenames the same, ignoring case?
+
+        @rtype: bool
+        """
+        return self.key(a) == self.key(b)
+
+
+def default_upcase_table():
+    """
+    The uppercase form of each UTF-16 code unit according to Python,
+      for when the volume's $UpCase table cannot be read.
+      Code units whose uppercase form is more than one code unit
+      are left as is, like NTFS.
+
+    @rtype: array.array of "H"
+    """
+    table = array.array("H", [0]) * (UPCASE_TABLE_SIZE // 2)
+    for i in xrange(UPCASE_TABLE_SIZE // 2):
+        upper = unichr(i).upper()
+        table[i] = ord(upper) if len(upper) == 1 else i
+    return table
+
+
+def test():
+    upcase = UpCaseTable()
+    assert upcase.equals("system32", u"SYSTEM32")
+    assert upcase.compare("a", "B") < 0
+    assert upcase.compare("_", "a") > 0  # "_" sorts after "A", though before "a"
+    assert upcase.key(u"\xe9t\xe9") == upcase.key(u"\xc9T\xc9")
+    # sharp s has no single code unit uppercase form
+    assert upcase.upcase(u"stra\xdfe") == u"STRA\xdfE"
+
+    # the table need not agree with Python
+    table = array.array("H", range(UPCASE_TABLE_SIZE // 2))
+    table[ord("a")] = ord("A")
+    upcase = UpCaseTable.from_buffer(table.tostring())
+    assert upcase.equals("a", "A")
+    assert not upcase.equals("b", "B")
+    print "upcase passed tests."
+
+
+if __name__ == "__main__":
+    test()
@@ -1,8 +1,16 @@
 import sys
+import struct
+import bisect
 import logging
 
 from ntfs.BinaryParser import Block
+from ntfs.BinaryParser import layout_view
+from ntfs.BinaryParser import view_buffer
 from ntfs.BinaryParser import OverrunBufferException
+from ntfs.UpCase import UpCaseTable
+from ntfs.Compression import lznt1_decompress
+from ntfs.mft.MFT import Cache
+from ntfs.mft.MFT import CacheBudget
 from ntfs.mft.MFT import InvalidRecordException
 from ntfs.mft.MFT import MREF
 from ntfs.mft.MFT import MSEQNO
@@ -13,6 +21,17 @@ from ntfs.mft.MFT import MFTEnumerator
 from ntfs.mft.MFT import MFT_RECORD_SIZE
 from ntfs.mft.MFT import INDEX_ALLOCATION
 from ntfs.mft.MFT import AttributeNotFoundError
+from ntfs.mft.MFT import INDEX_BLOCK
+from ntfs.mft.MFT import apply_fixups
+from ntfs.mft.MFT import FILENAME_FLAGS
+from ntfs.mft.MFT import FILENAME_TYPES
+from ntfs.mft.MFT import FilenameAttribute
+from ntfs.mft.MFT import MFTIndexEntryView
+from ntfs.mft.MFT import MFTTree
+from ntfs.mft.Snapshot import SnapshotError
+from ntfs.mft.Snapshot import MFTIndexSnapshot
+from ntfs.mft.Snapshot import snapshot_key
+from ntfs.mft.Snapshot import write_snapshot
 
 
 g_logger = logging.getLogger("ntfs.filesystem")
@@ -60,8 +79,36 @@ class File(object):
 
 
 class NTFSFileMetadataMixin(object):
-    def __init__(self, record):
-        self._record = record
+    """
+    The metadata of a file or directory, from its MFT record.
+
+    When built from a directory listing, the MFT record is only
+      loaded when it is first needed, so that listing a directory
+      does not parse the records of its children.
+    """
+    def __init__(self, record, entry=None):
+        """
+        Constructor.
+        Arguments:
+        - `record`: The MFTRecord, or None to load it on demand.
+        - `entry`: (Optional) The DirectoryEntry from which the
+            file was found. Requires `self._fs`.
+        """
+        self._mft_record = record
+        self._entry = entry
+
+    @property
+    def _record(self):
+        if self._mft_record is None:
+            self._mft_record = self._fs.get_record(self._entry.record_number())
+        return self._mft_record
+
+    def _get_name(self):
+        # a DOS name is the short alias of another name
+        if self._entry is not None and \
+           self._entry.filename_type() != FILENAME_TYPES.DOS:
+            return self._entry.filename()
+        return self._record.filename_information().filename()
 
     def get_filenames(self):
         ret = []
@@ -97,6 +144,8 @@ class NTFSFileMetadataMixin(object):
         return self._record.is_file()
 
     def is_directory(self):
+        if self._entry is not None:
+            return self._entry.is_directory()
         return self._record.is_directory()
 
     def get_size(self):
@@ -115,14 +164,21 @@ class NTFSFileMetadataMixin(object):
 
 
 class NTFSFile(File, NTFSFileMetadataMixin):
-    def __init__(self, filesystem, mft_record):
+    def __init__(self, filesystem, mft_record=None, entry=None):
+        """
+        Constructor.
+        Arguments:
+        - `filesystem`: The NTFSFilesystem.
+        - `mft_record`: The MFTRecord, or None to load it on demand.
+        - `entry`: (Optional) The DirectoryEntry from which the
+            file was found, required if `mft_record` is None.
+        """
         File.__init__(self)
-        NTFSFileMetadataMixin.__init__(self, mft_record)
+        NTFSFileMetadataMixin.__init__(self, mft_record, entry=entry)
         self._fs = filesystem
-        self._record = mft_record
 
     def get_name(self):
-        return self._record.filename_information().filename()
+        return self._get_name()
 
     def get_parent_directory(self):
         return self._fs.get_record_parent(self._record)
@@ -133,7 +189,9 @@ class NTFSFile(File, NTFSFileMetadataMixin):
     def read(self, offset, length):
         data_attribute = self._record.data_attribute()
         data = self._fs.get_attribute_data(data_attribute)
-        return data[offset:offset+length]
+        # reads past the end of the data are truncated
+        offset = min(offset, len(data))
+        return data[offset:min(offset + length, len(data))]
 
     def get_full_path(self):
         return self._fs.get_record_path(self._record)
@@ -184,23 +242,72 @@ class DirectoryDoesNotExistError(PathDoesNotExistError):
 
 
 class NTFSDirectory(Directory, NTFSFileMetadataMixin):
-    def __init__(self, filesystem, mft_record):
+    def __init__(self, filesystem, mft_record=None, entry=None):
+        """
+        Constructor.
+        Arguments:
+        - `filesystem`: The NTFSFilesystem.
+        - `mft_record`: The MFTRecord, or None to load it on demand.
+        - `entry`: (Optional) The DirectoryEntry from which the
+            directory was found, required if `mft_record` is None.
+        """
         Directory.__init__(self)
-        NTFSFileMetadataMixin.__init__(self, mft_record)
+        NTFSFileMetadataMixin.__init__(self, mft_record, entry=entry)
         self._fs = filesystem
-        self._record = mft_record
 
     def get_name(self):
-        return self._record.filename_information().filename()
+        return self._get_name()
+
+    def _make_child(self, entry):
+        if entry.is_directory():
+            return NTFSDirectory(self._fs, entry=entry)
+        else:
+            return NTFSFile(self._fs, entry=entry)
 
     def get_children(self):
-        ret = []
-        for child in self._fs.get_record_children(self._record):
-            if child.is_directory():
-                ret.append(NTFSDirectory(self._fs, child))
-            else:
-                ret.append(NTFSFile(self._fs, child))
-        return ret
+        """
+        The children are built from the directory listing, and their
+          MFT records are only loaded when needed.
+        """
+        return map(self._make_child, self.get_listing())
+
+    def get_listing(self):
+        """
+        List the children from the directory index, without parsing
+          their MFT records.
+
+        @rtype: list of DirectoryEntry
+        """
+        return self._fs.get_record_listing(self._record)
+
+    def walk(self):
+        """
+        Like `os.walk`, top down, yield a tuple (directory, directories,
+          files) for this directory and each directory below it.
+        Since the children are built from directory listings, only the
+          MFT records of the directories are parsed.
+
+        @rtype: generator of tuple(NTFSDirectory, list of NTFSDirectory, list of NTFSFile)
+        """
+        visited = set()
+        stack = [self]
+        while stack:
+            directory = stack.pop()
+            # guard against cycles in a corrupt filesystem
+            record_number = directory._record.inode
+            if record_number in visited:
+                continue
+            visited.add(record_number)
+
+            directories = []
+            files = []
+            for child in directory.get_children():
+                if isinstance(child, NTFSDirectory):
+                    directories.append(child)
+                else:
+                    files.append(child)
+            yield directory, directories, files
+            stack.extend(reversed(directories))
 
     def get_files(self):
         return filter(lambda c: isinstance(c, NTFSFile),
@@ -217,13 +324,29 @@ class NTFSDirectory(Directory, NTFSFileMetadataMixin):
         return "Directory(name: %s)" % (self.get_name())
 
     def get_child(self, name):
-        name_lower = name.lower()
+        """
+        Find the child with the given name, ignoring case, by searching
+          the directory index, so only the matching child is parsed.
+        If the index is corrupt, then all the children are compared.
+
+        @raise ChildNotFoundError: if the given filename is not found.
+        """
+        try:
+            entry = self._fs.get_record_child_entry(self._record, name)
+        except (OverrunBufferException, AttributeNotFoundError) as e:
+            g_logger.warning("failed to search directory index, scanning children: %s", e)
+            return self._get_child_linear(name)
+        return self._make_child(entry)
+
+    def _get_child_linear(self, name):
+        upcase_table = self._fs.get_upcase_table()
+        key = upcase_table.key(name)
         for child in self.get_children():
             if len(child.get_filenames()) > 1:
                 g_logger.debug("file names: %s -> %s",
                   child.get_name(), child.get_filenames())
             for fn in child.get_filenames():
-                if name_lower == fn.lower():
+                if key == upcase_table.key(fn):
                     return child
         raise ChildNotFoundError()
 
@@ -370,6 +493,19 @@ class ClusterAccessor(object):
         g_logger.debug('Get clusters %s:%s', start, end)
         return self._volume[start:end]
 
+    def get_bytes(self, start, end):
+        """
+        Read the bytes at the given volume offsets, which need not
+          be cluster aligned.
+        """
+        return self._volume[start:end]
+
+    def view(self, start, end):
+        """
+        Like `get_bytes`, but without copying the bytes, if possible.
+        """
+        return view_buffer(self._volume, start, end)
+
     def __len__(self):
         return len(self._volume) / self._cluster_size
 
@@ -395,6 +531,14 @@ INODE_RESERVED2 = 14
 INODE_RESERVED3 = 15
 INODE_FIRST_USER = 16
 
+INDEX_BLOCK_VCN_SIZE = 512
+# the estimated memory of the cached records, paths, and directory listings
+DEFAULT_CACHE_BUDGET_BYTES = 256 * 1024 * 1024
+
+
+# units: compression units
+DEFAULT_COMPRESSION_UNIT_CACHE_SIZE = 64
+
 
 class NonResidentAttributeData(object):
     """
@@ -404,62 +548,94 @@ class NonResidentAttributeData(object):
     once constructed, use this like a bytestring.
     you can unpack from it, slice it, etc.
 
-    implementation note: this is likely a good place to optimize
+    the byte offset at which each run starts within the logical buffer
+      is precomputed, so the run containing an offset is found with
+      a binary search. slices within a single run are read straight
+      from the volume, while slices across runs are copied into a
+      single preallocated buffer. use `view` to avoid copying
+      slices within a single run at all.
+
+    sparse runs read as zeros, without touching the volume.
+    the compression units of compressed attributes are decompressed
+      when first read, and the most recently used are cached.
+
+    if the data size is provided, then the buffer ends there, and the
+      bytes between the initialized size and the data size read as zeros,
+      without touching the volume. the slack space past the data size
+      is available via `slack_data`.
     """
     __unpackable__ = True
-    def __init__(self, clusters, runlist):
+    def __init__(self, clusters, runlist, compression_unit=0,
+                 unit_cache_size=DEFAULT_COMPRESSION_UNIT_CACHE_SIZE,
+                 data_size=None, initialized_size=None):
+        """
+        Constructor.
+        Arguments:
+        - `clusters`: The ClusterAccessor of the volume.
+        - `runlist`: The Runlist of the attribute.
+        - `compression_unit`: If the attribute is compressed, the log2 of
+            the number of clusters in a compression unit. Otherwise, zero.
+        - `unit_cache_size`: The number of decompressed compression
+            units to cache.
+        - `data_size`: The logical size of the data, from the attribute.
+            Defaults to the total size of the runs.
+        - `initialized_size`: The size of the data that has been written,
+            from the attribute. Defaults to the data size.
+        """
         self._clusters = clusters
         self._runlist = runlist
         self._runentries = list(self._runlist.runs())
-        self._len = None
 
-    def __getitem__(self, index):
-        # TODO: clarify variable names and their units
         # units: bytes
-        current_run_start_offset = 0
-
-        if index < 0:
-            index = len(self) + index
-
-        clusters = self._clusters
+        # the logical offset at which each run starts,
+        #  followed by the total length
         csize = clusters.get_cluster_size()
-
-        # units: clusters
+        self._run_offsets = [0]
         for cluster_offset, num_clusters in self._runentries:
-            # units: bytes
-            run_length = num_clusters * csize
-            right_border = current_run_start_offset + run_length
-
-            # Check if the target byte in the run entry
-            if current_run_start_offset <= index < right_border:
-                # units: bytes
-                target_idx = index - current_run_start_offset
-                # The index of the cluster that contains the target byte
-                target_cluster_idx = int(target_idx/csize)
-                # The index of the target byte relative to the cluster
-                byte_relative_idx = (target_idx - target_cluster_idx * csize)
-                cluster = clusters[cluster_offset+target_cluster_idx]
-                return cluster[byte_relative_idx]
-            # else looking at next run entry
-            current_run_start_offset += run_length
-        raise IndexError("%d is greater than the non resident "
-                         "attribute data length %s", index, len(self))
+            g_logger.debug("NonResidentAttributeData: run: "
+                           "cluster: %s len: %x", cluster_offset, num_clusters)
+            self._run_offsets.append(self._run_offsets[-1] + num_clusters * csize)
+        self._runs_len = self._run_offsets[-1]
+
+        if data_size is None:
+            data_size = self._runs_len
+        if initialized_size is None:
+            initialized_size = data_size
+        self._len = data_size
+        self._initialized_size = min(initialized_size, data_size)
 
-    def __getslice__(self, start, stop):
+        # units: bytes
+        self._unit_size = 0
+        if compression_unit:
+            self._unit_size = csize << compression_unit
+        self._unit_cache = Cache(size_limit=unit_cache_size)
+
+    def _get_run_index(self, index):
         """
+        Get the index of the run that contains the given logical byte offset.
+        """
+        return bisect.bisect_right(self._run_offsets, index) - 1
 
-        :param start: start byte
-        :param stop: stop byte
-        :return:
+    def _get_volume_offset(self, run_index, index):
+        """
+        Get the volume byte offset of the given logical byte offset,
+          which must fall within the given run, which must not be sparse.
         """
-        # TODO: there are some pretty bad inefficiencies here, i believe
-        # TODO: clarify variable names and their units
-        ret = bytearray()
-        virt_byte_offset = 0
-        have_found_start = False
+        cluster_offset, _ = self._runentries[run_index]
+        return (cluster_offset * self._clusters.get_cluster_size() +
+                index - self._run_offsets[run_index])
 
-        g_logger.debug("NonResidentAttributeData: getslice: "
-                       "start: %x end: %x", start, stop)
+    def __getitem__(self, index):
+        if index < 0:
+            index = len(self) + index
+
+        if not 0 <= index < len(self):
+            raise IndexError("%d is greater than the non resident "
+                             "attribute data length %s" % (index, len(self)))
+
+        return self._get_range(index, index + 1)[0]
+
+    def _normalize_slice(self, start, stop):
         _len = len(self)
         if stop == sys.maxint:
             stop = _len
@@ -472,62 +648,203 @@ class NonResidentAttributeData(object):
 
         if max(start, stop) > _len:
             raise IndexError("(%d, %d) is greater "
-                             "than the non resident attribute data length %s",
-                             start, stop, _len)
-        clusters = self._clusters
-        csize = clusters.get_cluster_size()
-        for cluster_offset, num_clusters in self._runentries:
-            g_logger.debug("NonResidentAttributeData: "
-                           "getslice: runentry: start: %x len: %x",
-                           cluster_offset * csize, num_clusters * csize)
-            run_byte_len = num_clusters * csize
-            # check if start byte in the data run
-            virt_byte_stop = virt_byte_offset + run_byte_len
-            is_start_in_run = (virt_byte_offset <= start < virt_byte_stop)
-
-            if not have_found_start:
-                if is_start_in_run:
-                    have_found_start = True
-                else:
-                    virt_byte_offset += run_byte_len
-                    continue
-
-            cluster_stop = cluster_offset + num_clusters
-            _bytes = clusters[cluster_offset:cluster_stop]
-
-            is_stop_in_run = stop <= virt_byte_stop
-            # This is the situation when we have only one data run
-            # everything is in this run
-            if is_start_in_run and is_stop_in_run:
-                return _bytes[start:stop]
-
-            _start = _stop = None
-            if is_start_in_run:
-                _start = start - virt_byte_offset
-            if is_stop_in_run:
-                _stop = stop - virt_byte_offset
-            # if start and stop are not in the data run,
-            # then copy all bytes from the data run's clusters
-            # _bytes[None:None] === _bytes[:]
-            ret.extend(_bytes[_start:_stop])
-            virt_byte_offset += run_byte_len
+                             "than the non resident attribute data length %s" %
+                             (start, stop, _len))
+        return start, stop
 
+    def _check_runs_range(self, start, stop):
+        """
+        @raises OverrunBufferException: if the runs do not reach
+          the given logical byte offsets.
+        """
+        if stop > self._runs_len:
+            raise OverrunBufferException(stop, self._runs_len)
+
+    def _get_runs_range(self, start, stop, view=False):
+        """
+        Read the logical bytes [start, stop) from the runs, as stored
+          on the volume.
+        """
+        if stop <= start:
+            return ""
+        self._check_runs_range(start, stop)
+
+        first_run = self._get_run_index(start)
+        last_run = self._get_run_index(stop - 1)
+        if first_run == last_run:
+            # everything falls within the same run
+            if self._runentries[first_run][0] is None:
+                return "\x00" * (stop - start)
+            offset = self._get_volume_offset(first_run, start)
+            if view:
+                return self._clusters.view(offset, offset + stop - start)
+            return self._clusters.get_bytes(offset, offset + stop - start)
+
+        # the slice goes over one or more run boundaries
+        ret = bytearray(stop - start)
+        index = start
+        for run_index in xrange(first_run, last_run + 1):
+            run_stop = min(self._run_offsets[run_index + 1], stop)
+            if self._runentries[run_index][0] is not None:
+                offset = self._get_volume_offset(run_index, index)
+                ret[index - start:run_stop - start] = \
+                    self._clusters.view(offset, offset + run_stop - index)
+            index = run_stop
         return ret
 
-    def __len__(self):
-        if self._len is not None:
-            return self._len
-        ret = 0
-        for cluster_start, num_clusters in self._runentries:
-            g_logger.debug("NonResidentAttributeData: len: run: "
-                           "cluster: %x len: %x", cluster_start, num_clusters)
-            ret += num_clusters * self._clusters.get_cluster_size()
-        self._len = ret
+    def _get_unit(self, unit_index):
+        """
+        Get the decompressed data of the given compression unit.
+
+        A unit that is not backed by any clusters is all zeros, and a unit
+          that is entirely backed by clusters is stored uncompressed.
+          Otherwise, the clusters at the start of the unit contain the
+          compressed data, and the rest of the unit is sparse.
+
+        @rtype: str
+        """
+        unit = self._unit_cache.lookup(unit_index)
+        if unit is not None:
+            return unit
+
+        start = unit_index * self._unit_size
+        stop = min(start + self._unit_size, self._runs_len)
+
+        allocated = 0
+        for run_index in xrange(self._get_run_index(start),
+                                self._get_run_index(stop - 1) + 1):
+            if self._runentries[run_index][0] is None:
+                continue
+            allocated += (min(self._run_offsets[run_index + 1], stop) -
+                          max(self._run_offsets[run_index], start))
+
+        if allocated == stop - start:
+            unit = str(self._get_runs_range(start, stop))
+        elif allocated == 0:
+            unit = "\x00" * (stop - start)
+        else:
+            g_logger.debug("NonResidentAttributeData: decompressing unit: %x", unit_index)
+            compressed = self._get_runs_range(start, start + allocated)
+            unit = lznt1_decompress(str(compressed))
+            unit = str(unit[:stop - start]) + "\x00" * (stop - start - len(unit))
+
+        self._unit_cache.insert(unit_index, unit)
+        return unit
+
+    def _get_units_range(self, start, stop, view=False):
+        """
+        Read the logical bytes [start, stop) from the decompressed
+          compression units.
+        """
+        if stop <= start:
+            return ""
+        self._check_runs_range(start, stop)
+
+        unit_size = self._unit_size
+        first_unit = start // unit_size
+        last_unit = (stop - 1) // unit_size
+        if first_unit == last_unit:
+            unit = self._get_unit(first_unit)
+            unit_start = first_unit * unit_size
+            if view:
+                return memoryview(unit)[start - unit_start:stop - unit_start]
+            return unit[start - unit_start:stop - unit_start]
+
+        ret = bytearray(stop - start)
+        index = start
+        for unit_index in xrange(first_unit, last_unit + 1):
+            unit = self._get_unit(unit_index)
+            unit_start = unit_index * unit_size
+            unit_stop = min(unit_start + unit_size, stop)
+            ret[index - start:unit_stop - start] = \
+                unit[index - unit_start:unit_stop - unit_start]
+            index = unit_stop
         return ret
 
+    def _get_stored_range(self, start, stop, view=False):
+        """
+        Read the logical bytes [start, stop) as stored in the runs,
+          regardless of the data size and initialized size.
+        """
+        if self._unit_size:
+            return self._get_units_range(start, stop, view=view)
+        return self._get_runs_range(start, stop, view=view)
+
+    def _get_range(self, start, stop, view=False):
+        g_logger.debug("NonResidentAttributeData: getslice: "
+                       "start: %x end: %x", start, stop)
+        initialized_size = self._initialized_size
+        if stop <= initialized_size:
+            return self._get_stored_range(start, stop, view=view)
+        if start >= initialized_size:
+            return "\x00" * (stop - start)
+
+        # the slice goes over the initialized size
+        ret = bytearray(stop - start)
+        ret[0:initialized_size - start] = \
+            self._get_stored_range(start, initialized_size, view=True)
+        return ret
+
+    def __getslice__(self, start, stop):
+        """
+        :param start: start byte
+        :param stop: stop byte
+        :return: a str, if the slice falls within a single run
+          (or compression unit), otherwise a bytearray.
+        """
+        start, stop = self._normalize_slice(start, stop)
+        return self._get_range(start, stop)
+
+    def view(self, start, stop):
+        """
+        Like a slice, but if the slice falls within a single run
+          (or compression unit), a view of the volume (or cached unit)
+          is returned, which does not copy the bytes (see `view_buffer`).
+
+        :param start: start byte
+        :param stop: stop byte
+        """
+        start, stop = self._normalize_slice(start, stop)
+        return self._get_range(start, stop, view=True)
+
+    def slack_data(self):
+        """
+        Get the bytes stored in the runs past the data size,
+          that is, the slack space of the attribute.
+        """
+        return self._get_stored_range(self._len, self._runs_len)
+
+    def __len__(self):
+        return self._len
+
+
+def estimate_listing_size(k, listing):
+    """
+    Estimate the memory used by a cached directory listing.
+
+    @rtype: int
+    """
+    return (sys.getsizeof(k) + sys.getsizeof(listing) +
+            sum(sys.getsizeof(e) + sys.getsizeof(e._buf) for e in listing))
+
 
 class NTFSFilesystem(object):
-    def __init__(self, volume, cluster_size=None):
+    def __init__(self, volume, cluster_size=None, snapshot_filename=None,
+                 cache_budget=None):
+        """
+        Constructor.
+        Arguments:
+        - `volume`: The Volume containing the filesystem.
+        - `cluster_size`: (Optional) The cluster size, overriding the VBR.
+        - `snapshot_filename`: (Optional) The path of a sidecar file
+            holding a snapshot of the MFT indexes. If it matches the
+            MFT, then the indexes are loaded from it, otherwise they are
+            built and written to it. Either way, the MFT is read from
+            the volume as needed, rather than copied up front.
+        - `cache_budget`: (Optional) The CacheBudget shared by the caches
+            of records, paths, and directory listings. Defaults to a
+            budget of DEFAULT_CACHE_BUDGET_BYTES.
+        """
         oem_id = volume[3:7]
         assert oem_id == 'NTFS', 'Wrong OEM signature'
 
@@ -541,6 +858,11 @@ class NTFSFilesystem(object):
 
         self._clusters = ClusterAccessor(volume, cluster_size)
         self._logger = logging.getLogger("NTFSFilesystem")
+        self._upcase_table = None
+        if cache_budget is None:
+            cache_budget = CacheBudget(DEFAULT_CACHE_BUDGET_BYTES)
+        self._cache_budget = cache_budget
+        self._listing_cache = Cache(budget=cache_budget, sizeof=estimate_listing_size)
 
         # balance memory usage with performance
         try:
@@ -561,13 +883,17 @@ class NTFSFilesystem(object):
                 g_logger.error("failed to read MFTMirr from image: %s", e)
                 raise CorruptNTFSFilesystemError("failed to read MFT or MFTMirr from image")
 
-        if len(b) > 1024 * 1024 * 500:
+        if len(b) > 1024 * 1024 * 500 or snapshot_filename is not None:
             self._mft_data = b
         else:
             # note optimization: copy entire mft buffer from NonResidentNTFSAttribute
             #  to avoid getslice lookups
             self._mft_data = b[:]
-        self._enumerator = MFTEnumerator(self._mft_data)
+        self._enumerator = MFTEnumerator(self._mft_data, cache_budget=cache_budget)
+        self._mft_tree = None
+        self._snapshot = None
+        if snapshot_filename is not None:
+            self._load_snapshot(snapshot_filename)
 
         # test there's at least some user content (aside from root), or we'll
         #   assume something's up
@@ -577,11 +903,85 @@ class NTFSFilesystem(object):
             g_logger.error("overrun reading first user MFT record")
             raise CorruptNTFSFilesystemError("failed to read first user record (MFT not large enough)")
 
+    def _load_snapshot(self, filename):
+        """
+        Load the MFT indexes from the given snapshot file, or build
+          them and write the snapshot, if it is missing or stale.
+        """
+        key = snapshot_key(self._vbr.volume_serial_number(), self._mft_data)
+        try:
+            self._snapshot = MFTIndexSnapshot(filename, key=key)
+        except SnapshotError as e:
+            g_logger.info("building MFT index snapshot: %s", e)
+            path_index = self._enumerator.build_path_index()
+            tree = MFTTree(self._mft_data)
+            tree.build()
+            try:
+                write_snapshot(filename, key, path_index, tree)
+            except (IOError, OSError) as e:
+                g_logger.warning("failed to write MFT index snapshot: %s", e)
+            self._enumerator.set_path_index(path_index)
+            self._mft_tree = tree
+            return
+
+        g_logger.debug("loaded MFT index snapshot: %s", filename)
+        self._enumerator.set_path_index(self._snapshot.path_index())
+        self._mft_tree = self._snapshot.tree()
+
+    def get_mft_tree(self):
+        """
+        Get the tree of the records of the MFT, which is built on
+          first use, unless it was loaded from a snapshot.
+
+        @rtype: MFTTree
+        """
+        if self._mft_tree is None:
+            tree = MFTTree(self._mft_data)
+            tree.build()
+            self._mft_tree = tree
+        return self._mft_tree
+
+    def get_cluster_size(self):
+        return self._cluster_size
+
+    def get_cache_budget(self):
+        """
+        Get the CacheBudget shared by the caches of this filesystem,
+          with which other caches, such as those of a FUSE mount, may
+          share the same memory ceiling.
+
+        @rtype: CacheBudget
+        """
+        return self._cache_budget
+
+    def get_cache_stats(self):
+        """
+        @rtype: dict of str to dict of str to int
+        @return: The statistics of the record, path, and listing caches,
+          and of their budget.
+        """
+        ret = self._enumerator.cache_stats()
+        ret["listings"] = self._listing_cache.stats()
+        return ret
+
     def get_attribute_data(self, attribute):
         if attribute.non_resident() == 0:
             return attribute.value()
         else:
-            return NonResidentAttributeData(self._clusters, attribute.runlist())
+            compression_unit = 0
+            if attribute.is_compressed():
+                compression_unit = attribute.compression_unit()
+
+            # the sizes are only valid in the first extent of an attribute
+            data_size = None
+            initialized_size = None
+            if attribute.lowest_vcn() == 0:
+                data_size = attribute.data_size()
+                initialized_size = attribute.initialized_size()
+            return NonResidentAttributeData(self._clusters, attribute.runlist(),
+                                            compression_unit=compression_unit,
+                                            data_size=data_size,
+                                            initialized_size=initialized_size)
 
     def get_mft_record(self):
         mft_lcn = self._vbr.mft_lcn()
@@ -639,42 +1039,325 @@ class NTFSFilesystem(object):
 
         return NTFSDirectory(self, parent_record)
 
-    def get_record_children(self, record):
-        # we use a map here to de-dup entries with different filename types
-        #  such as 8.3, POSIX, or Windows,  but the same ultimate MFT reference
-        ret = {}  # type: dict(int, MFTRecord)
+    def get_upcase_table(self):
+        """
+        Load the volume's $UpCase table, which is used to collate filenames.
+        The table is loaded once, and shared with the MFT enumerator.
+        If it cannot be read, then the uppercase forms given by Python
+          are used instead.
+
+        @rtype: UpCaseTable
+        """
+        if self._upcase_table is None:
+            try:
+                record = self._enumerator.get_record(INODE_UPCASE)
+                data = self.get_attribute_data(record.data_attribute())
+                upcase_table = UpCaseTable.from_buffer(data)
+            except (OverrunBufferException, InvalidRecordException, AttributeError) as e:
+                g_logger.warning("failed to read $UpCase, using default table: %s", e)
+                upcase_table = UpCaseTable()
+            self._upcase_table = upcase_table
+            self._enumerator.set_upcase_table(upcase_table)
+        return self._upcase_table
+
+    def get_collation_key(self, name):
+        """
+        Get the key by which the given filename is ordered in a
+          directory index (see `UpCaseTable.key`).
+
+        @type name: str or unicode
+        @rtype: str
+        """
+        return self.get_upcase_table().key(name)
+
+    def get_record_child_entry(self, record, name):
+        """
+        Find the child of a directory with the given name, ignoring case,
+          by descending the B+tree of the directory's $I30 index.
+        So, only the index nodes on the path to the name are read.
+
+        @type record: MFTRecord
+        @rtype: DirectoryEntry
+        @raises ChildNotFoundError: if the given filename is not found.
+        @raises AttributeNotFoundError: if the directory has no index,
+          or its index refers to a missing $INDEX_ALLOCATION.
+        @raises OverrunBufferException: if the index is corrupt.
+        """
+        return DirectoryEntry.from_index_entry(DirectoryIndex(self, record).find(name))
+
+    def get_record_child_reference(self, record, name):
+        """
+        Like `get_record_child_entry`, but get the MFT reference of the child.
+
+        @rtype: int
+        """
+        return self.get_record_child_entry(record, name).mft_reference()
+
+    def get_record_listing(self, record):
+        """
+        List the children of a directory using its $I30 index alone,
+          without parsing the children's MFT records.
+        Listings are cached by the record number, sequence number,
+          and LSN of the directory, so a directory that is listed
+          again is not parsed again.
+
+        A child with more than one name in the index, such as a Win32
+          and a DOS name, is listed once, preferring the Win32 name.
+        The entries are in the order of the index.
+
+        @type record: MFTRecord
+        @rtype: list of DirectoryEntry
+        """
         if not record.is_directory():
-            return ret.values()
+            return []
+
+        key = (record.inode, record.sequence_number(), record.lsn())
+        listing = self._listing_cache.lookup(key)
+        if listing is not None:
+            return listing
 
-        # TODO: cleanup the duplication here
+        try:
+            index = DirectoryIndex(self, record)
+            listing = self._build_listing(DirectoryEntry.from_index_entry(entry)
+                                          for entry in index.entries())
+        except (OverrunBufferException, AttributeNotFoundError) as e:
+            g_logger.warning("failed to walk directory index, scanning INDX blocks: %s", e)
+            listing = self._build_listing(self._scan_record_index_entries(record))
+
+        self._listing_cache.insert(key, listing)
+        return listing
+
+    @staticmethod
+    def _build_listing(entries):
+        """
+        @type entries: iterable of DirectoryEntry
+        @rtype: list of DirectoryEntry
+        """
+        ret = []
+        positions = {}  # type: dict(int, int)
+        for entry in entries:
+            record_number = entry.record_number()
+            if record_number == INODE_ROOT and entry.filename() == ".":
+                continue
+            i = positions.get(record_number)
+            if i is None:
+                positions[record_number] = len(ret)
+                ret.append(entry)
+            elif ret[i].filename_type() == FILENAME_TYPES.DOS:
+                ret[i] = entry
+        return ret
+
+    def _scan_record_index_entries(self, record):
+        """
+        A generator of a DirectoryEntry for each entry found in the INDX
+          blocks of the directory, in the order they are stored,
+          without walking the B+tree.
+        """
         try:
             indx_alloc_attr = record.attribute(ATTR_TYPE.INDEX_ALLOCATION)
             indx_alloc = INDEX_ALLOCATION(self.get_attribute_data(indx_alloc_attr), 0)
-            #g_logger.debug("INDEX_ALLOCATION len: %s", hex(len(indx_alloc)))
-            #g_logger.debug("alloc:\n%s", indx_alloc.get_all_string(indent=2))
-            indx = indx_alloc
-
-            for block in indx.blocks():
+            for block in indx_alloc.blocks():
                 for entry in block.index().entries():
-                    ref = MREF(entry.header().mft_reference())
-                    if ref == INODE_ROOT and \
-                       entry.filename_information().filename() == ".":
-                        continue
-                    ret[ref] = self._enumerator.get_record(ref)
+                    yield DirectoryEntry.from_index_entry(entry)
 
         except AttributeNotFoundError:
             indx_root_attr = record.attribute(ATTR_TYPE.INDEX_ROOT)
             indx_root = INDEX_ROOT(self.get_attribute_data(indx_root_attr), 0)
-            indx = indx_root
+            for entry in indx_root.index().entries():
+                yield DirectoryEntry.from_index_entry(entry)
+
+    def get_record_children(self, record):
+        """
+        @type record: MFTRecord
+        @rtype: list of MFTRecord
+        """
+        return [self._enumerator.get_record(entry.record_number())
+                for entry in self.get_record_listing(record)]
+
+
+@layout_view(FilenameAttribute.LAYOUT)
+class DirectoryEntry(object):
+    """
+    A lightweight entry of a directory listing: a copy of the
+      $FILENAME_INFORMATION key of an entry in the directory's index,
+      so the child's MFT record need not be parsed.
+    The fields of the key, eg. `logical_size()` or `modified_time()`,
+      are read from the copy when called.
+
+    Windows only updates the sizes and timestamps in the index now and
+      then, so they may be stale. The child's MFT record has the
+      accurate values.
+    """
+    __slots__ = ("_buf", "_offset", "_mft_reference")
+
+    def __init__(self, mft_reference, key):
+        """
+        Constructor.
+        Arguments:
+        - `mft_reference`: The MFT reference of the child.
+        - `key`: The $FILENAME_INFORMATION value of the index entry.
+        """
+        self._buf = key
+        self._offset = 0
+        self._mft_reference = mft_reference
+
+    @classmethod
+    def from_index_entry(cls, entry):
+        """
+        @type entry: MFTIndexEntryView or MFT_INDEX_ENTRY
+        """
+        if isinstance(entry, MFTIndexEntryView):
+            return cls(entry.mft_reference(), entry.key())
+        header = entry.header()
+        start = entry.offset() + 0x10
+        return cls(header.mft_reference(), str(entry._buf[start:start + header.key_length()]))
+
+    def __repr__(self):
+        return "DirectoryEntry(filename=%r, record_number=%d)" % \
+            (self.filename(), self.record_number())
+
+    def filename(self):
+        return self._buf[0x42:0x42 + 2 * self.filename_length()].decode("utf-16le")
+
+    def mft_reference(self):
+        return self._mft_reference
+
+    def record_number(self):
+        return MREF(self._mft_reference)
+
+    def sequence_number(self):
+        return MSEQNO(self._mft_reference)
+
+    def is_directory(self):
+        return bool(self.flags() & FILENAME_FLAGS.DIRECTORY)
 
-            for entry in indx.index().entries():
-                ref = MREF(entry.header().mft_reference())
-                if ref == INODE_ROOT and \
-                   entry.filename_information().filename() == ".":
-                    continue
-                ret[ref] = self._enumerator.get_record(ref)
 
-        return ret.values()
+class DirectoryIndex(object):
+    """
+    The B+tree of a directory's $I30 index: the root node is found in
+      the $INDEX_ROOT attribute, and the other nodes are INDX blocks
+      in the $INDEX_ALLOCATION attribute, which are read and fixed up
+      when they are first visited.
+    """
+    def __init__(self, filesystem, record):
+        """
+        Constructor.
+        Arguments:
+        - `filesystem`: The NTFSFilesystem.
+        - `record`: The MFTRecord of the directory.
+
+        @raises AttributeNotFoundError: if the directory has no index.
+        """
+        super(DirectoryIndex, self).__init__()
+        self._fs = filesystem
+        self._record = record
+        indx_root_attr = record.attribute(ATTR_TYPE.INDEX_ROOT)
+        self._indx_root = INDEX_ROOT(filesystem.get_attribute_data(indx_root_attr), 0)
+        self._indx_alloc = None
+        self._block_size = None
+        self._vcn_size = None
+
+    def root(self):
+        """
+        @rtype: INDEX
+        """
+        return self._indx_root.index()
+
+    def get_node(self, vcn):
+        """
+        Read the node with the given VCN.
+
+        @rtype: INDEX
+        @raises AttributeNotFoundError: if there is no $INDEX_ALLOCATION.
+        @raises OverrunBufferException: if the VCN is beyond the allocation.
+        """
+        if self._indx_alloc is None:
+            indx_alloc_attr = self._record.attribute(ATTR_TYPE.INDEX_ALLOCATION)
+            self._indx_alloc = self._fs.get_attribute_data(indx_alloc_attr)
+            cluster_size = self._fs.get_cluster_size()
+            self._block_size = self._indx_root.index_record_size_bytes()
+            # VCNs count clusters, unless the blocks are smaller
+            #  than a cluster, when they count 512 byte units.
+            if self._block_size >= cluster_size:
+                self._vcn_size = cluster_size
+            else:
+                self._vcn_size = INDEX_BLOCK_VCN_SIZE
+
+        offset = vcn * self._vcn_size
+        buf = bytearray(self._indx_alloc[offset:offset + self._block_size])
+        if len(buf) < self._block_size:
+            raise OverrunBufferException(offset + self._block_size, len(self._indx_alloc))
+        usa_offset = struct.unpack_from("<H", buf, 0x4)[0]
+        usa_count = struct.unpack_from("<H", buf, 0x6)[0]
+        for fixup_offset in apply_fixups(buf, usa_offset, usa_count):
+            g_logger.warning("Bad fixup in INDX block at %s", hex(offset + fixup_offset))
+        return INDEX_BLOCK(buf, 0, fixup=False).index()
+
+    def find(self, name):
+        """
+        Find the entry with the given name, ignoring case, by descending
+          from the root node towards the name.
+
+        @rtype: MFTIndexEntryView
+        @raises ChildNotFoundError: if the given filename is not found.
+        """
+        upcase_table = self._fs.get_upcase_table()
+        key = upcase_table.key(name)
+
+        node = self.root()
+        visited = set()
+        while True:
+            child_vcn = None
+            for entry in node.node_entries():
+                if not entry.is_index_entry_end():
+                    c = cmp(key, upcase_table.key(entry.filename()))
+                    if c == 0:
+                        return entry
+                    if c > 0:
+                        continue
+                # the name sorts before this entry, so it can only
+                #  be found in this entry's child node.
+                if entry.is_index_entry_node():
+                    child_vcn = entry.child_vcn()
+                break
+
+            if child_vcn is None or child_vcn in visited:
+                raise ChildNotFoundError()
+            visited.add(child_vcn)
+            node = self.get_node(child_vcn)
+
+    def entries(self):
+        """
+        A generator of all the entries of the index, in collation
+          order, by walking the tree: the entries of each entry's
+          child node come before the entry.
+
+        @rtype: generator of MFTIndexEntryView
+        """
+        visited = set()
+        stack = [self.root().node_entries()]
+        while stack:
+            for entry in stack[-1]:
+                if entry.is_index_entry_node():
+                    child_vcn = entry.child_vcn()
+                    if child_vcn not in visited:
+                        visited.add(child_vcn)
+                        # visit the child, then come back for this entry
+                        stack.append(self._resume(entry, self.get_node(child_vcn)))
+                        break
+                if not entry.is_index_entry_end():
+                    yield entry
+            else:
+                stack.pop()
+
+    @staticmethod
+    def _resume(entry, node):
+        """
+        The entries of the child node, followed by the entry itself.
+        """
+        for child_entry in node.node_entries():
+            yield child_entry
+        yield entry
 
 
 def main():
@@ -2,9 +2,11 @@
 
 import array
 import os
+import mmap
 import sys
 import struct
 import logging
+import threading
 from datetime import datetime
 from collections import OrderedDict  # python 2.7 only
 
@@ -12,6 +14,11 @@ from .. import Progress
 from .. import BinaryParser
 from ..BinaryParser import Block
 from ..BinaryParser import Nestable
+from ..BinaryParser import StructLayout
+from ..BinaryParser import layout
+from ..BinaryParser import layout_view
+from ..BinaryParser import memoize
+from ..UpCase import UpCaseTable
 
 
 g_logger = logging.getLogger("ntfs.mft")
@@ -34,6 +41,135 @@ class INDXException(Exception):
         return "INDX Exception: %s" % (self._value)
 
 
+FIXUP_SECTOR_SIZE = 512
+
+
+def apply_fixups(buf, usa_offset, usa_count, offset=0):
+    """
+    Apply the update sequence array fixups of the block at the given
+      offset, in place.
+    The last word of each sector is checked against the update sequence
+      number, and replaced by the matching entry of the array, using
+      strided slices rather than a loop over the sectors.
+
+    @type buf: bytearray
+    @param usa_offset: The relative offset of the update sequence array.
+    @param usa_count: The number of words in the update sequence array,
+      which is one more than the number of sectors.
+    @param offset: The offset of the block in the buffer.
+    @rtype: list of int
+    @return: The relative offsets of the sector ends whose check value
+      does not match, and so are not patched.
+    @raises OverrunBufferException: if the block extends past the buffer.
+    """
+    count = usa_count - 1
+    if count < 1:
+        return []
+
+    usa_start = offset + usa_offset
+    usa_end = usa_start + 2 * usa_count
+    end = offset + count * FIXUP_SECTOR_SIZE
+    if usa_end > len(buf) or end > len(buf):
+        raise BinaryParser.OverrunBufferException(max(usa_end, end), len(buf))
+
+    usa = buf[usa_start:usa_end]
+    first = offset + FIXUP_SECTOR_SIZE - 2
+    if buf[first:end:FIXUP_SECTOR_SIZE] == usa[0:1] * count and \
+       buf[first + 1:end:FIXUP_SECTOR_SIZE] == usa[1:2] * count:
+        buf[first:end:FIXUP_SECTOR_SIZE] = usa[2::2]
+        buf[first + 1:end:FIXUP_SECTOR_SIZE] = usa[3::2]
+        return []
+
+    bad = []
+    for i in xrange(count):
+        o = first + i * FIXUP_SECTOR_SIZE
+        if buf[o:o + 2] != usa[0:2]:
+            bad.append(o - offset)
+            continue
+        buf[o:o + 2] = usa[2 + 2 * i:4 + 2 * i]
+    return bad
+
+
+def apply_fixups_batch(buf, block_size, offset=0, count=None):
+    """
+    Apply the update sequence array fixups of a contiguous run of blocks
+      of the same size, such as MFT records or INDX blocks, in place.
+
+    Consecutive blocks whose headers have the same update sequence array
+      offset and count are fixed up together, one strided slice per
+      sector for the whole group, rather than one block at a time.
+    Blocks with an empty update sequence array, such as zeroed
+      blocks, are left as is.
+
+    @type buf: bytearray
+    @type block_size: int
+    @param offset: The offset of the first block in the buffer.
+    @param count: The number of blocks. Defaults to as many as fit in
+      the buffer.
+    @rtype: list of int
+    @return: The indices of the blocks with a bad fixup, or whose update
+      sequence array does not fit in the block.
+    """
+    if count is None:
+        count = (len(buf) - offset) // block_size
+    sectors_per_block = block_size // FIXUP_SECTOR_SIZE
+
+    bad = []
+    start = 0
+    while start < count:
+        base = offset + start * block_size
+        header = buf[base + 0x4:base + 0x8]
+        end = start + 1
+        while end < count and \
+              buf[offset + end * block_size + 0x4:offset + end * block_size + 0x8] == header:
+            end += 1
+
+        usa_offset, usa_count = struct.unpack("<HH", str(header))
+        sectors = usa_count - 1
+        if sectors < 1:
+            pass
+        elif sectors > sectors_per_block or \
+             usa_offset + 2 * usa_count > FIXUP_SECTOR_SIZE - 2:
+            bad.extend(xrange(start, end))
+        else:
+            bad.extend(_apply_fixups_group(buf, block_size, base,
+                                           end - start, usa_offset, sectors, start))
+        start = end
+    return sorted(bad)
+
+
+def _apply_fixups_group(buf, block_size, base, n, usa_offset, sectors, first_index):
+    """
+    Fix up `n` consecutive blocks with the same update sequence array
+      offset and count, starting at offset `base`.
+
+    @rtype: list of int
+    @return: The indices of the blocks with a bad fixup.
+    """
+    end = base + n * block_size
+    usn_lo = buf[base + usa_offset:end:block_size]
+    usn_hi = buf[base + usa_offset + 1:end:block_size]
+
+    bad = set()
+    for i in xrange(sectors):
+        check = base + (i + 1) * FIXUP_SECTOR_SIZE - 2
+        entry = base + usa_offset + 2 + 2 * i
+        check_lo = buf[check:end:block_size]
+        check_hi = buf[check + 1:end:block_size]
+        if check_lo == usn_lo and check_hi == usn_hi:
+            buf[check:end:block_size] = buf[entry:end:block_size]
+            buf[check + 1:end:block_size] = buf[entry + 1:end:block_size]
+            continue
+
+        for j in xrange(n):
+            if check_lo[j] != usn_lo[j] or check_hi[j] != usn_hi[j]:
+                bad.add(first_index + j)
+                continue
+            o = j * block_size
+            buf[check + o:check + o + 2] = buf[entry + o:entry + o + 2]
+    return bad
+
+
 class FixupBlock(Block):
     """
     a fixup block requires modification to the underlying buffer.
@@ -55,27 +191,12 @@ class FixupBlock(Block):
         super(FixupBlock, self).__init__(buf, offset)
 
     def fixup(self, num_fixups, fixup_value_offset):
-        fixup_buffer = array.array("b", self.unpack_binary(0, length=(num_fixups - 1) * 512))
+        fixup_buffer = bytearray(self.unpack_binary(0, length=(num_fixups - 1) * FIXUP_SECTOR_SIZE))
         self._buf = fixup_buffer
         self._offset = 0
 
-        fixup_value = self.unpack_word(fixup_value_offset)
-
-        for i in range(0, num_fixups - 1):
-            fixup_offset = 512 * (i + 1) - 2
-            check_value = self.unpack_word(fixup_offset)
-
-            if check_value != fixup_value:
-                logging.warning("Bad fixup at %s", hex(self.offset() + fixup_offset))
-                continue
-
-            new_value = self.unpack_word(fixup_value_offset + 2 + 2 * i)
-            self.pack_word(fixup_offset, new_value)
-
-            check_value = self.unpack_word(fixup_offset)
-            g_logger.debug("Fixup verified at %s and patched from %s to %s.",
-                          hex(self.offset() + fixup_offset),
-                          hex(fixup_value), hex(check_value))
+        for fixup_offset in apply_fixups(fixup_buffer, fixup_value_offset, num_fixups):
+            g_logger.warning("Bad fixup at %s", hex(fixup_offset))
 
 
 class INDEX_ENTRY_FLAGS:
@@ -87,13 +208,16 @@ class INDEX_ENTRY_FLAGS:
     INDEX_ENTRY_SPACE_FILLER = 0xFFFF
 
 
+@layout(StructLayout([
+    ("word", "length", 0x8),
+    ("word", "key_length"),
+    ("word", "index_entry_flags"),  # see INDEX_ENTRY_FLAGS
+    ("word", "reserved"),
+]))
 class INDEX_ENTRY_HEADER(Block, Nestable):
     def __init__(self, buf, offset, parent):
         super(INDEX_ENTRY_HEADER, self).__init__(buf, offset)
-        self.declare_field("word", "length", 0x8)
-        self.declare_field("word", "key_length")
-        self.declare_field("word", "index_entry_flags")  # see INDEX_ENTRY_FLAGS
-        self.declare_field("word", "reserved")
+        self.unpack_layout(self.LAYOUT)
 
     @staticmethod
     def structure_size(buf, offset, parent):
@@ -112,24 +236,35 @@ class INDEX_ENTRY_HEADER(Block, Nestable):
         return self.index_entry_flags() & INDEX_ENTRY_FLAGS.INDEX_ENTRY_SPACE_FILLER
 
 
+@layout(StructLayout([
+    ("qword", "mft_reference", 0x0),
+    ("word", "length"),
+    ("word", "key_length"),
+    ("word", "index_entry_flags"),  # see INDEX_ENTRY_FLAGS
+    ("word", "reserved"),
+]))
 class MFT_INDEX_ENTRY_HEADER(INDEX_ENTRY_HEADER):
     """
     Index used by the MFT for INDX attributes.
     """
     def __init__(self, buf, offset, parent):
         super(MFT_INDEX_ENTRY_HEADER, self).__init__(buf, offset, parent)
-        self.declare_field("qword", "mft_reference", 0x0)
 
 
+@layout(StructLayout([
+    ("word", "data_offset", 0x0),
+    ("word", "data_length"),
+    ("dword", "reserved"),
+    ("word", "length"),
+    ("word", "key_length"),
+    ("word", "index_entry_flags"),  # see INDEX_ENTRY_FLAGS
+]))
 class SECURE_INDEX_ENTRY_HEADER(INDEX_ENTRY_HEADER):
     """
     Index used by the $SECURE file indices SII and SDH
     """
     def __init__(self, buf, offset, parent):
         super(SECURE_INDEX_ENTRY_HEADER, self).__init__(buf, offset, parent)
-        self.declare_field("word", "data_offset", 0x0)
-        self.declare_field("word", "data_length")
-        self.declare_field("dword", "reserved")
 
 
 class INDEX_ENTRY(Block, Nestable):
@@ -197,6 +332,67 @@ class MFT_INDEX_ENTRY(Block, Nestable):
             return False
 
 
+@layout_view(StructLayout([
+    ("qword", "mft_reference", 0x0),
+    ("word", "length"),
+    ("word", "key_length"),
+    ("word", "index_entry_flags"),  # see INDEX_ENTRY_FLAGS
+    ("word", "reserved"),
+    # the key is a $FILENAME_INFORMATION value
+    ("qword", "mft_parent_reference"),
+    ("qword", "physical_size", 0x38),
+    ("qword", "logical_size"),
+    ("dword", "filename_flags"),  # see FILENAME_FLAGS
+    ("byte", "filename_length", 0x50),
+    ("byte", "filename_type"),  # see FILENAME_TYPES
+]))
+class MFTIndexEntryView(object):
+    """
+    A lightweight view of an entry of a node of the MFT directory
+      index $I30, for walking the index without parsing every entry.
+
+    The END entry of a node has no key, so only its header fields
+      and child VCN are meaningful.
+    """
+    __slots__ = ("_buf", "_offset")
+
+    def __init__(self, buf, offset):
+        self._buf = buf
+        self._offset = offset
+
+    def offset(self):
+        return self._offset
+
+    def is_index_entry_node(self):
+        return self.index_entry_flags() & INDEX_ENTRY_FLAGS.INDEX_ENTRY_NODE
+
+    def is_index_entry_end(self):
+        return self.index_entry_flags() & INDEX_ENTRY_FLAGS.INDEX_ENTRY_END
+
+    def filename(self):
+        start = self._offset + 0x52
+        return self._buf[start:start + 2 * self.filename_length()].decode("utf-16le")
+
+    def filename_information(self):
+        return FilenameAttribute(self._buf, self._offset + 0x10, None)
+
+    def key(self):
+        """
+        A copy of the key of this entry, its $FILENAME_INFORMATION value.
+
+        @rtype: str
+        """
+        start = self._offset + 0x10
+        return str(self._buf[start:start + self.key_length()])
+
+    def child_vcn(self):
+        """
+        The VCN of the node of the entries less than this one.
+        Only valid if `is_index_entry_node()`.
+        """
+        return BinaryParser.read_qword(self._buf, self._offset + self.length() - 0x8)
+
+
 class SII_INDEX_ENTRY(Block, Nestable):
     """
     Index entry for the $SECURE:$SII index.
@@ -250,14 +446,17 @@ class INDEX_HEADER_FLAGS:
     NODE_MASK = 0x1
 
 
+@layout(StructLayout([
+    ("dword", "entries_offset", 0x0),
+    ("dword", "index_length"),
+    ("dword", "allocated_size"),
+    ("byte", "index_header_flags"),  # see INDEX_HEADER_FLAGS
+    # then 3 bytes padding/reserved
+]))
 class INDEX_HEADER(Block, Nestable):
     def __init__(self, buf, offset, parent):
         super(INDEX_HEADER, self).__init__(buf, offset)
-        self.declare_field("dword", "entries_offset", 0x0)
-        self.declare_field("dword", "index_length")
-        self.declare_field("dword", "allocated_size")
-        self.declare_field("byte", "index_header_flags")  # see INDEX_HEADER_FLAGS
-        # then 3 bytes padding/reserved
+        self.unpack_layout(self.LAYOUT)
 
     @staticmethod
     def structure_size(buf, offset, parent):
@@ -312,6 +511,23 @@ class INDEX(Block, Nestable):
             offset += len(e)
             yield e
 
+    def node_entries(self):
+        """
+        A generator of an MFTIndexEntryView for each entry of this
+          node of a directory index, in collation order, through the
+          END entry, which has no key but may point to the node of the
+          entries greater than all the others.
+        """
+        header = self.header()
+        offset = self.offset() + header.entries_offset()
+        end = self.offset() + header.index_length()
+        while offset < end:
+            e = MFTIndexEntryView(self._buf, offset)
+            yield e
+            if e.is_index_entry_end() or e.length() == 0:
+                return
+            offset += e.length()
+
     def slack_entries(self):
         """
         A generator that yields INDEX_ENTRYs found in the slack space
@@ -449,7 +665,13 @@ class IndexRecordHeader(FixupBlock):
 
 
 class INDEX_BLOCK(FixupBlock):
-    def __init__(self, buf, offset, parent=None):
+    def __init__(self, buf, offset, parent=None, fixup=True):
+        """
+        Constructor.
+        Arguments:
+        - `fixup`: If False, the update sequence fixups are not applied,
+            because the buffer has already been fixed up.
+        """
         super(INDEX_BLOCK, self).__init__(buf, offset, parent)
         self.declare_field("dword", "magic", 0x0)
         self.declare_field("word",  "usa_offset")
@@ -458,7 +680,8 @@ class INDEX_BLOCK(FixupBlock):
         self.declare_field("qword", "vcn")
         self._index_offset = self.current_field_offset()
         self.add_explicit_field(self._index_offset, INDEX, "index")
-        self.fixup(self.usa_count(), self.usa_offset())
+        if fixup:
+            self.fixup(self.usa_count(), self.usa_offset())
 
     def index(self):
         return INDEX(self._buf, self._offset + self._index_offset,
@@ -472,6 +695,9 @@ class INDEX_BLOCK(FixupBlock):
         return 0x1000
 
 
+INDX_FIXUP_BATCH_SIZE = 64  # blocks
+
+
 class INDEX_ALLOCATION(FixupBlock):
     def __init__(self, buf, offset, parent=None):
         super(INDEX_ALLOCATION, self).__init__(buf, offset, parent)
@@ -491,9 +717,19 @@ class INDEX_ALLOCATION(FixupBlock):
         return count
 
     def blocks(self):
-        for i in xrange(INDEX_ALLOCATION.guess_num_blocks(self._buf, self.offset())):
-            # TODO: don't hardcode things
-            yield INDEX_BLOCK(self._buf, self._offset + 0x1000 * i)
+        # TODO: don't hardcode things
+        BLOCK_SIZE = 0x1000
+        num_blocks = INDEX_ALLOCATION.guess_num_blocks(self._buf, self.offset())
+        # the blocks are copied and fixed up a batch at a time
+        for first in xrange(0, num_blocks, INDX_FIXUP_BATCH_SIZE):
+            count = min(INDX_FIXUP_BATCH_SIZE, num_blocks - first)
+            start = self._offset + BLOCK_SIZE * first
+            buf = bytearray(self._buf[start:start + BLOCK_SIZE * count])
+            for i in apply_fixups_batch(buf, BLOCK_SIZE):
+                g_logger.warning("Bad fixup in INDX block at %s",
+                                 hex(start + BLOCK_SIZE * i))
+            for i in xrange(count):
+                yield INDEX_BLOCK(buf, BLOCK_SIZE * i, fixup=False)
 
     @staticmethod
     def structure_size(buf, offset, parent):
@@ -532,20 +768,23 @@ class StandardInformationFieldDoesNotExist(Exception):
         return "Standard Information attribute field does not exist: %s" % (self._msg)
 
 
+@layout(StructLayout([
+    ("filetime", "created_time", 0x0),
+    ("filetime", "modified_time"),
+    ("filetime", "changed_time"),
+    ("filetime", "accessed_time"),
+    ("dword", "attributes"),
+    ("binary", "reserved", None, 0xC),
+    # ("dword", "owner_id", 0x30),  # Win2k+, NTFS 3.x
+    # ("dword", "security_id"),  # Win2k+, NTFS 3.x
+    # ("qword", "quota_charged"),  # Win2k+, NTFS 3.x
+    # ("qword", "usn"),  # Win2k+, NTFS 3.x
+]))
 class StandardInformation(Block):
     # TODO(wb): implement sizing so we can make this nestable
     def __init__(self, buf, offset, parent):
         super(StandardInformation, self).__init__(buf, offset)
-        self.declare_field("filetime", "created_time", 0x0)
-        self.declare_field("filetime", "modified_time")
-        self.declare_field("filetime", "changed_time")
-        self.declare_field("filetime", "accessed_time")
-        self.declare_field("dword", "attributes")
-        self.declare_field("binary", "reserved", self.current_field_offset(), 0xC)
-        # self.declare_field("dword", "owner_id", 0x30)  # Win2k+, NTFS 3.x
-        # self.declare_field("dword", "security_id")  # Win2k+, NTFS 3.x
-        # self.declare_field("qword", "quota_charged")  # Win2k+, NTFS 3.x
-        # self.declare_field("qword", "usn")  # Win2k+, NTFS 3.x
+        self.unpack_layout(self.LAYOUT)
 
     # Can't implement this unless we know the NTFS version in use
     #@staticmethod
@@ -601,21 +840,24 @@ class StandardInformation(Block):
             raise StandardInformationFieldDoesNotExist("USN")
 
 
+@layout(StructLayout([
+    ("qword", "mft_parent_reference", 0x0),
+    ("filetime", "created_time"),
+    ("filetime", "modified_time"),
+    ("filetime", "changed_time"),
+    ("filetime", "accessed_time"),
+    ("qword", "physical_size"),
+    ("qword", "logical_size"),
+    ("dword", "flags"),
+    ("dword", "reparse_value"),
+    ("byte", "filename_length"),
+    ("byte", "filename_type"),
+]))
 class FilenameAttribute(Block, Nestable):
     def __init__(self, buf, offset, parent):
         super(FilenameAttribute, self).__init__(buf, offset)
-        self.declare_field("qword", "mft_parent_reference", 0x0)
-        self.declare_field("filetime", "created_time")
-        self.declare_field("filetime", "modified_time")
-        self.declare_field("filetime", "changed_time")
-        self.declare_field("filetime", "accessed_time")
-        self.declare_field("qword", "physical_size")
-        self.declare_field("qword", "logical_size")
-        self.declare_field("dword", "flags")
-        self.declare_field("dword", "reparse_value")
-        self.declare_field("byte", "filename_length")
-        self.declare_field("byte", "filename_type")
-        self.declare_field("wstring", "filename", 0x42, self.filename_length())
+        self.unpack_layout(self.LAYOUT)
+        self.add_explicit_field(0x42, "wstring", "filename", self.filename_length())
 
     @staticmethod
     def structure_size(buf, offset, parent):
@@ -624,6 +866,9 @@ class FilenameAttribute(Block, Nestable):
     def __len__(self):
         return 0x42 + (self.filename_length() * 2)
 
+    def filename(self):
+        return self.unpack_wstring(0x42, self.filename_length())
+
 
 class SlackIndexEntry(IndexEntry):
     def __init__(self, buf, offset, parent):
@@ -682,7 +927,13 @@ class Runentry(Block, Nestable):
         return 0x1 + (self._length_length + self._offset_length)
 
     def is_valid(self):
-        return self._offset_length > 0 and self._length_length > 0
+        return self._length_length > 0
+
+    def is_sparse(self):
+        """
+        A sparse run has no offset, and is not backed by any clusters.
+        """
+        return self._offset_length == 0
 
     def lsb2num(self, binary):
         count = 0
@@ -753,23 +1004,97 @@ class Runlist(Block):
         """
         Yields tuples (volume offset, length).
         Recall that the entries are relative to one another
+        The volume offset of a sparse run is None.
         """
         last_offset = 0
         for e in self._entries(length=length):
+            if e.is_sparse():
+                yield (None, e.length())
+                continue
             current_offset = last_offset + e.offset()
             current_length = e.length()
             last_offset = current_offset
             yield (current_offset, current_length)
 
 
+class MergedRunlist(object):
+    """
+    The runlists of the extents of a non-resident attribute, read as
+      a single runlist, in VCN order.
+    """
+    def __init__(self, extents):
+        """
+        Constructor.
+        Arguments:
+        - `extents`: List of tuple (lowest VCN, highest VCN, Runlist),
+            sorted by lowest VCN.
+        """
+        super(MergedRunlist, self).__init__()
+        self._extents = extents
+
+    def runs(self, length=None):
+        """
+        Yields tuples (volume offset, length), like `Runlist.runs`.
+        A missing extent reads as a sparse run.
+        """
+        next_vcn = self._extents[0][0] if self._extents else 0
+        for lowest_vcn, highest_vcn, runlist in self._extents:
+            if lowest_vcn < next_vcn:
+                g_logger.warning("overlapping attribute extent at VCN %d", lowest_vcn)
+                continue
+            if lowest_vcn > next_vcn:
+                yield (None, lowest_vcn - next_vcn)
+            for run in runlist.runs(length=length):
+                yield run
+            next_vcn = highest_vcn + 1
+
+
 class ATTR_TYPE:
     STANDARD_INFORMATION = 0x10
+    ATTRIBUTE_LIST = 0x20
     FILENAME_INFORMATION = 0x30
     DATA = 0x80
     INDEX_ROOT = 0x90
     INDEX_ALLOCATION = 0xA0
 
 
+ATTRIBUTE_HEADER_FIELDS = [
+    ("dword", "type", 0x0),
+    ("dword", "size"),  # this value must rounded up to 0x8 byte alignment
+    ("byte", "non_resident"),
+    ("byte", "name_length"),
+    ("word", "name_offset"),
+    ("word", "flags"),
+    ("word", "instance"),
+]
+
+
+NONRESIDENT_ATTRIBUTE_LAYOUT = StructLayout(ATTRIBUTE_HEADER_FIELDS + [
+    ("qword", "lowest_vcn", 0x10),
+    ("qword", "highest_vcn"),
+    ("word", "runlist_offset"),
+    ("byte", "compression_unit"),
+    ("byte", "reserved1"),
+    ("byte", "reserved2"),
+    ("byte", "reserved3"),
+    ("byte", "reserved4"),
+    ("byte", "reserved5"),
+    ("qword", "allocated_size"),
+    ("qword", "data_size"),
+    ("qword", "initialized_size"),
+    ("qword", "compressed_size"),
+])
+
+
+RESIDENT_ATTRIBUTE_LAYOUT = StructLayout(ATTRIBUTE_HEADER_FIELDS + [
+    ("dword", "value_length", 0x10),
+    ("word", "value_offset"),
+    ("byte", "value_flags"),
+    ("byte", "reserved"),
+])
+
+
+@layout(NONRESIDENT_ATTRIBUTE_LAYOUT, RESIDENT_ATTRIBUTE_LAYOUT)
 class Attribute(Block, Nestable):
     TYPES = {
         16: "$STANDARD INFORMATION",
@@ -811,34 +1136,12 @@ class Attribute(Block, Nestable):
 
     def __init__(self, buf, offset, parent):
         super(Attribute, self).__init__(buf, offset)
-        self.declare_field("dword", "type")
-        self.declare_field("dword", "size")  # this value must rounded up to 0x8 byte alignment
-        self.declare_field("byte", "non_resident")
-        self.declare_field("byte", "name_length")
-        self.declare_field("word", "name_offset")
-        self.declare_field("word", "flags")
-        self.declare_field("word", "instance")
-        if self.non_resident() > 0:
-            self.declare_field("qword", "lowest_vcn", 0x10)
-            self.declare_field("qword", "highest_vcn")
-            self.declare_field("word", "runlist_offset")
-            self.declare_field("byte", "compression_unit")
-            self.declare_field("byte", "reserved1")
-            self.declare_field("byte", "reserved2")
-            self.declare_field("byte", "reserved3")
-            self.declare_field("byte", "reserved4")
-            self.declare_field("byte", "reserved5")
-            self.declare_field("qword", "allocated_size")
-            self.declare_field("qword", "data_size")
-            self.declare_field("qword", "initialized_size")
-            self.declare_field("qword", "compressed_size")
+        if BinaryParser.read_byte(buf, offset + 0x8) > 0:
+            self.unpack_layout(NONRESIDENT_ATTRIBUTE_LAYOUT)
         else:
-            self.declare_field("dword", "value_length", 0x10)
-            self.declare_field("word", "value_offset")
-            self.declare_field("byte", "value_flags")
-            self.declare_field("byte", "reserved")
-            self.declare_field("binary", "value",
-                               self.value_offset(), self.value_length())
+            self.unpack_layout(RESIDENT_ATTRIBUTE_LAYOUT)
+            self.add_explicit_field(self.value_offset(), "binary",
+                                    "value", self.value_length())
 
     @staticmethod
     def structure_size(buf, offset, parent):
@@ -854,14 +1157,94 @@ class Attribute(Block, Nestable):
     def runlist(self):
         return Runlist(self._buf, self.offset() + self.runlist_offset(), self)
 
-    def size(self):
-        s = self.unpack_dword(self._off_size)
-        return s + (8 - (s % 8))
+    def is_compressed(self):
+        return self.flags() & ATTRIBUTE_FLAGS.COMPRESSED
+
+    def value(self):
+        """
+        The content of a resident attribute.
+        """
+        return self.unpack_binary(self.value_offset(), self.value_length())
 
     def name(self):
         return self.unpack_wstring(self.name_offset(), self.name_length())
 
 
+class AttributeExtents(object):
+    """
+    A non-resident attribute whose runlist is split into extents,
+      usually across the extension records listed in the
+      $ATTRIBUTE_LIST of a record, read as a single attribute.
+
+    The header fields, eg. `data_size()`, are those of the first
+      extent, the only one with valid sizes, while the runlist
+      merges the runlists of all the extents.
+    """
+    def __init__(self, extents):
+        """
+        Constructor.
+        Arguments:
+        - `extents`: The Attributes of each extent.
+        """
+        super(AttributeExtents, self).__init__()
+        self._extents = sorted(extents, key=lambda a: a.lowest_vcn())
+
+    def __len__(self):
+        return len(self._extents[0])
+
+    def __str__(self):
+        return str(self._extents[0])
+
+    def extents(self):
+        return self._extents
+
+    def highest_vcn(self):
+        return self._extents[-1].highest_vcn()
+
+    def runlist(self):
+        return MergedRunlist([(a.lowest_vcn(), a.highest_vcn(), a.runlist())
+                              for a in self._extents])
+
+    def __getattr__(self, name):
+        return getattr(self._extents[0], name)
+
+
+def merge_attribute_extents(attributes):
+    """
+    Merge the extents of a non-resident attribute, if it has more than one.
+
+    @type attributes: list of Attribute
+    @param attributes: The extents of the same attribute.
+    @rtype: Attribute or AttributeExtents
+    """
+    if len(attributes) == 1 or attributes[0].non_resident() == 0:
+        return attributes[0]
+    return AttributeExtents(attributes)
+
+
+class ATTRIBUTE_FLAGS:
+    COMPRESSED = 0x0001
+    ENCRYPTED = 0x4000
+    SPARSE = 0x8000
+
+
+class FILENAME_FLAGS:
+    """
+    The file attribute flags of a $FILENAME_INFORMATION attribute.
+    """
+    READONLY = 0x01
+    HIDDEN = 0x02
+    SYSTEM = 0x04
+    DIRECTORY = 0x10000000  # has an $I30 index
+
+
+class FILENAME_TYPES:
+    POSIX = 0x0
+    WIN32 = 0x1
+    DOS = 0x2
+    WIN32_AND_DOS = 0x3
+
+
 class MFT_RECORD_FLAGS:
     MFT_RECORD_IN_USE = 0x1
     MFT_RECORD_IS_DIRECTORY = 0x2
@@ -885,65 +1268,133 @@ class AttributeNotFoundError(Exception):
     pass
 
 
+MFT_RECORD_HEADER_LAYOUT = StructLayout([
+    # 0x0 File or BAAD
+    ("dword", "magic"),
+    # 0x04 Offset to fixup array
+    ("word",  "usa_offset"),
+    # 0x06 Number of entries in fixup array
+    ("word",  "usa_count"),
+    # 0x08 $LogFile sequence number
+    ("qword", "lsn"),
+    # 0x10 Sequence value
+    ("word",  "sequence_number"),
+    # 0x12 Link Count
+    ("word",  "link_count"),
+    # 0x14 Offset of first attribute
+    ("word",  "attrs_offset"),
+    # 0x16 Flags:
+    #   0x00 - not in use
+    #   0x01 - in use
+    #   0x02 - directory
+    #   0x03 - directory in use
+    ("word",  "flags"),
+
+    # 0x18 Used size of MFT entry
+    ("dword", "bytes_in_use"),
+    # 0x1c Allocated size of MFT entry
+    ("dword", "bytes_allocated"),
+    # 0x20 File reference to base record
+    ("qword", "base_mft_record"),
+    # 0x28 Nex attribute identifier
+    ("word",  "next_attr_instance"),
+
+    # Attributes and fixup values
+    # 0x2a
+    ("word",  "reserved"),
+    # 0x2c
+    ("dword", "mft_record_number"),
+])
+
+
+@layout(MFT_RECORD_HEADER_LAYOUT)
 class MFTRecord(FixupBlock):
-    def __init__(self, buf, offset, parent, inode=None):
+    def __init__(self, buf, offset, parent, inode=None, fixup=True):
+        """
+        Constructor.
+        Arguments:
+        - `buf`: Byte string containing the MFT record.
+        - `offset`: The offset into the buffer at which the record starts.
+        - `inode`: (Optional) The record number, if known.
+        - `fixup`: If False, the update sequence fixups are not applied,
+            and the record is parsed in place. Only do this if the buffer
+            is already fixed up, or nothing past the first sector is read.
+        """
         super(MFTRecord, self).__init__(buf, offset, parent)
-
-        # 0x0 File or BAAD
-        self.declare_field("dword", "magic")
-        # 0x04 Offset to fixup array
-        self.declare_field("word",  "usa_offset")
-        # 0x06 Number of entries in fixup array
-        self.declare_field("word",  "usa_count")
-        # 0x08 $LogFile sequence number
-        self.declare_field("qword", "lsn")
-        # 0x10 Sequence value
-        self.declare_field("word",  "sequence_number")
-        # 0x12 Link Count
-        self.declare_field("word",  "link_count")
-        # 0x14 Offset of first attribute
-        self.declare_field("word",  "attrs_offset")
-        # 0x16 Flags:
-        #   0x00 - not in use
-        #   0x01 - in use
-        #   0x02 - directory
-        #   0x03 - directory in use
-        self.declare_field("word",  "flags")
-
-        # 0x18 Used size of MFT entry
-        self.declare_field("dword", "bytes_in_use")
-        # 0x1c Allocated size of MFT entry
-        self.declare_field("dword", "bytes_allocated")
-        # 0x20 File reference to base record
-        self.declare_field("qword", "base_mft_record")
-        # 0x28 Nex attribute identifier
-        self.declare_field("word",  "next_attr_instance")
-
-        # Attributes and fixup values
-        # 0x2a
-        self.declare_field("word",  "reserved")
-        # 0x2c
-        self.declare_field("dword", "mft_record_number")
+        self.unpack_layout(self.LAYOUT)
 
         self.inode = inode or self.mft_record_number()
-        self.fixup(self.usa_count(), self.usa_offset())
+        self._enumerator = None
+        if fixup:
+            self.fixup(self.usa_count(), self.usa_offset())
+
+    def set_enumerator(self, enumerator):
+        """
+        Resolve the $ATTRIBUTE_LIST of this record, if any, using
+          the given enumerator, so that `attributes` includes the
+          attributes in the extension records.
+
+        @type enumerator: MFTEnumerator
+        """
+        self._enumerator = enumerator
+        # the extension records may hold other attributes
+        MFTRecord.filename_information.reset(self)
+        MFTRecord.standard_information.reset(self)
 
     def attributes(self):
+        """
+        Yield the attributes of this record, followed by those of its
+          extension records, if it has an $ATTRIBUTE_LIST and an enumerator.
+        """
+        has_attribute_list = False
+        for a in self.record_attributes():
+            if a.type() == ATTR_TYPE.ATTRIBUTE_LIST:
+                has_attribute_list = True
+            yield a
+
+        if has_attribute_list and self._enumerator is not None:
+            for extension in self._enumerator.get_extension_records(self):
+                for a in extension.record_attributes():
+                    yield a
+
+    def record_attributes(self):
+        """
+        Yield the attributes stored in this record only.
+        """
         offset = self.attrs_offset()
-        right_border = self.offset() + self.bytes_in_use()
+        right_border = self.bytes_in_use()
 
-        while (self.unpack_dword(offset) != 0 and
-               self.unpack_dword(offset) != 0xFFFFFFFF and
-               offset + self.unpack_dword(offset + 4) <= right_border):
-            a = Attribute(self._buf, offset, self)
+        while True:
+            type_ = self.unpack_dword(offset)
+            if type_ == 0 or type_ == 0xFFFFFFFF:
+                break
+            if offset + self.unpack_dword(offset + 4) > right_border:
+                break
+            a = Attribute(self._buf, self.absolute_offset(offset), self)
             offset += len(a)
             yield a
 
     def attribute(self, attr_type):
+        """
+        Get the first attribute of the given type. If it is non-resident
+          and split into extents, then they are merged, whichever
+          record each extent is found in.
+
+        @raises AttributeNotFoundError: if the record has no such attribute.
+        """
+        extents = []
         for a in self.attributes():
-            if a.type() == attr_type:
-                return a
-        raise AttributeNotFoundError()
+            if a.type() != attr_type:
+                continue
+            if not extents:
+                if a.non_resident() == 0:
+                    return a
+                extents.append(a)
+            elif a.non_resident() and a.name() == extents[0].name():
+                extents.append(a)
+        if not extents:
+            raise AttributeNotFoundError()
+        return merge_attribute_extents(extents)
 
     def is_directory(self):
         return self.flags() & MFT_RECORD_FLAGS.MFT_RECORD_IS_DIRECTORY
@@ -971,6 +1422,7 @@ class MFTRecord(FixupBlock):
         return ret
 
     # this a required resident attribute
+    @memoize(capacity=1)
     def filename_information(self):
         """
         MFT Records may have more than one FN info attribute,
@@ -991,6 +1443,7 @@ class MFTRecord(FixupBlock):
         return fn
 
     # this a required resident attribute
+    @memoize(capacity=1)
     def standard_information(self):
         try:
             attr = self.attribute(ATTR_TYPE.STANDARD_INFORMATION)
@@ -1000,23 +1453,102 @@ class MFTRecord(FixupBlock):
 
     def data_attribute(self):
         """
-        Returns None if the default $DATA attribute does not exist
+        Returns None if the default $DATA attribute does not exist.
+        If it is split into extents, then they are merged.
         """
-        for attr in self.attributes():
-            if attr.type() == ATTR_TYPE.DATA and attr.name() == "":
-                return attr
+        extents = [attr for attr in self.attributes()
+                   if attr.type() == ATTR_TYPE.DATA and attr.name() == ""]
+        if not extents:
+            return None
+        return merge_attribute_extents(extents)
 
     def slack_data(self):
         """
         Returns A binary string containing the MFT record slack.
         """
-        return self._buf[self.offset()+self.bytes_in_use():self.offset() + 1024].tostring()
+        return self.unpack_binary(self.bytes_in_use(),
+                                  MFT_RECORD_SIZE - self.bytes_in_use())
 
     def active_data(self):
         """
-        Returns A binary string containing the MFT record slack.
+        Returns A binary string containing the active MFT record data.
         """
-        return self._buf[self.offset():self.offset() + self.bytes_in_use()].tostring()
+        return self.unpack_binary(0, self.bytes_in_use())
+
+
+# the first update sequence word is stored at the end of the first sector.
+#  if the active data of the record ends before this, then no fixups
+#  are necessary to parse the record.
+FIRST_SECTOR_FIXUP_OFFSET = 0x1FE
+
+
+@layout_view(MFT_RECORD_HEADER_LAYOUT)
+class MFTRecordView(object):
+    """
+    A lightweight view of an MFT record found within a larger buffer,
+      such as the entire MFT.
+
+    The header fields, eg. `flags()` or `sequence_number()`, are read
+      straight from the source buffer, so constructing and querying a
+      view makes no copies. The complete MFTRecord is only built when
+      an attribute of the record is requested, and only if the record
+      extends past the first sector are the fixups applied (which
+      copies the record).
+
+    Any method of MFTRecord not implemented here is forwarded to the
+      complete record.
+    """
+    __slots__ = ("_buf", "_offset", "inode", "_record", "_fixup", "_enumerator")
+
+    def __init__(self, buf, offset, inode=None, fixup=True, enumerator=None):
+        """
+        Constructor.
+        Arguments:
+        - `buf`: Byte string containing the MFT record.
+        - `offset`: The offset into the buffer at which the record starts.
+        - `inode`: (Optional) The record number, if known.
+        - `fixup`: If False, the buffer has already been fixed up.
+        - `enumerator`: (Optional) The MFTEnumerator used to resolve
+            the $ATTRIBUTE_LIST of the complete record.
+        """
+        self._buf = buf
+        self._offset = offset
+        self._record = None
+        self._fixup = fixup
+        self._enumerator = enumerator
+        self.inode = inode or self.mft_record_number()
+
+    def __repr__(self):
+        return "MFTRecordView(inode=%r)" % (self.inode)
+
+    def offset(self):
+        return self._offset
+
+    def is_valid(self):
+        return self.magic() == 0x454C4946  # "FILE"
+
+    def is_directory(self):
+        return self.flags() & MFT_RECORD_FLAGS.MFT_RECORD_IS_DIRECTORY
+
+    def is_active(self):
+        return self.flags() & MFT_RECORD_FLAGS.MFT_RECORD_IN_USE
+
+    def record(self):
+        """
+        Get the complete MFTRecord for this view, parsing it if necessary.
+
+        @rtype: MFTRecord
+        """
+        if self._record is None:
+            needs_fixup = self._fixup and self.bytes_in_use() > FIRST_SECTOR_FIXUP_OFFSET
+            self._record = MFTRecord(self._buf, self._offset, None,
+                                     inode=self.inode, fixup=needs_fixup)
+            if self._enumerator is not None:
+                self._record.set_enumerator(self._enumerator)
+        return self._record
+
+    def __getattr__(self, name):
+        return getattr(self.record(), name)
 
 
 class InvalidAttributeException(INDXException):
@@ -1050,33 +1582,243 @@ class InvalidRecordException(Exception):
         return "InvalidRecordException(%s)" % (self._msg)
 
 
+def estimate_entry_size(k, v):
+    """
+    Estimate the memory used by a cache entry, counting the key and
+      the value, but not the objects they refer to.
+    Suitable for strings, such as paths.
+
+    @rtype: int
+    """
+    return sys.getsizeof(k) + sys.getsizeof(v)
+
+
+# the memory used by a parsed MFTRecord, aside from its copy of the
+#  record: the object, its attribute dict, its unpacked fields, and
+#  its memoized $STANDARD_INFORMATION and $FILENAME_INFORMATION
+MFT_RECORD_OVERHEAD = 2560  # bytes
+
+
+def estimate_record_size(k, record):
+    """
+    Estimate the memory used by a cached MFTRecord.
+    Only the bytes of the record itself are counted, since the record
+      may be parsed in place from a buffer holding the whole MFT,
+      such as that of `MFTEnumerator.fixup_all`.
+
+    @rtype: int
+    """
+    return sys.getsizeof(k) + MFT_RECORD_SIZE + MFT_RECORD_OVERHEAD
+
+
+class CacheBudget(object):
+    """
+    A limit on the estimated memory used by the entries of one or
+      more Caches, such as all the caches of a filesystem.
+
+    When an insertion into any of the caches exceeds the budget, then
+      the least recently used entries across all of the caches are
+      evicted, until the caches fit within the budget again.
+
+    The caches that share a budget also share its lock, so that an
+      eviction from one cache on behalf of another is never seen
+      half done by another thread.
+    """
+    def __init__(self, max_bytes):
+        """
+        Constructor.
+        Arguments:
+        - `max_bytes`: The estimated memory the caches may use, in bytes.
+        """
+        super(CacheBudget, self).__init__()
+        self._max_bytes = max_bytes
+        self._bytes = 0
+        # map from (cache id, key) to cache, least recently used first
+        self._lru = OrderedDict()
+        self._evictions = 0
+        self._lock = threading.Lock()
+
+    def max_bytes(self):
+        return self._max_bytes
+
+    def bytes(self):
+        return self._bytes
+
+    # the following are called by the caches, with the lock held
+
+    def _insert(self, cache, k, size):
+        self._lru[(id(cache), k)] = cache
+        self._bytes += size
+
+    def _touch(self, cache, k):
+        key = (id(cache), k)
+        self._lru[key] = self._lru.pop(key)
+
+    def _remove(self, cache, k, size):
+        del self._lru[(id(cache), k)]
+        self._bytes -= size
+
+    def _evict(self):
+        while self._bytes > self._max_bytes and self._lru:
+            (_, k), cache = self._lru.popitem(last=False)
+            self._bytes -= cache._evict(k)
+            self._evictions += 1
+
+    def stats(self):
+        """
+        @rtype: dict of str to int
+        """
+        with self._lock:
+            return {
+                "max_bytes": self._max_bytes,
+                "bytes": self._bytes,
+                "entries": len(self._lru),
+                "evictions": self._evictions,
+            }
+
+
 class Cache(object):
-    def __init__(self, size_limit):
+    """
+    A least recently used cache, bounded by number of entries, and/or by
+      estimated memory, either its own or shared with other caches via a
+      CacheBudget.
+    The hits and misses of `lookup` and `exists`, and the evictions,
+      are counted.
+
+    A Cache may be used from several threads. Use `lookup` rather than
+      `exists`, `touch`, and `get`, since another thread may evict the
+      entry between those calls.
+    """
+    def __init__(self, size_limit=None, max_bytes=None, budget=None,
+                 sizeof=estimate_entry_size):
+        """
+        Constructor.
+        Arguments:
+        - `size_limit`: (Optional) The maximum number of entries.
+        - `max_bytes`: (Optional) The estimated memory the entries may
+            use, in bytes.
+        - `budget`: (Optional) The CacheBudget shared with other caches.
+        - `sizeof`: Function (key, value) -> int that estimates the
+            memory used by an entry, in bytes.
+        """
         super(Cache, self).__init__()
-        self._c = OrderedDict()
+        self._c = OrderedDict()  # map from key to tuple(value, size)
         self._size_limit = size_limit
+        self._max_bytes = max_bytes
+        self._budget = budget
+        self._sizeof = sizeof
+        self._bytes = 0
+        self._hits = 0
+        self._misses = 0
+        self._evictions = 0
+        if budget is not None:
+            self._lock = budget._lock
+        else:
+            self._lock = threading.Lock()
 
     def insert(self, k, v):
         """
         add a key and value to the front
         """
-        self._c[k] = v
-        if len(self._c) > self._size_limit:
-            self._c.popitem(last=False)
+        with self._lock:
+            self._insert(k, v)
+
+    def _insert(self, k, v):
+        if k in self._c:
+            self._remove(k)
+        size = 0
+        if self._max_bytes is not None or self._budget is not None:
+            size = self._sizeof(k, v)
+        self._c[k] = (v, size)
+        self._bytes += size
+        if self._budget is not None:
+            self._budget._insert(self, k, size)
+
+        while self._c and \
+              ((self._size_limit is not None and len(self._c) > self._size_limit) or
+               (self._max_bytes is not None and self._bytes > self._max_bytes)):
+            oldest = next(iter(self._c))
+            self._remove(oldest)
+            self._evictions += 1
+        if self._budget is not None:
+            self._budget._evict()
+
+    def _remove(self, k):
+        _, size = self._c.pop(k)
+        self._bytes -= size
+        if self._budget is not None:
+            self._budget._remove(self, k, size)
+
+    def _evict(self, k):
+        """
+        Evict the given entry on behalf of the budget.
+
+        @rtype: int
+        @return: The size of the entry.
+        """
+        _, size = self._c.pop(k)
+        self._bytes -= size
+        self._evictions += 1
+        return size
+
+    def lookup(self, k, default=None):
+        """
+        Get the value of a key, and bring it to the front, or get the
+          default, if the key is not in the cache, in a single step.
+        """
+        with self._lock:
+            entry = self._c.pop(k, None)
+            if entry is None:
+                self._misses += 1
+                return default
+            self._hits += 1
+            self._c[k] = entry
+            if self._budget is not None:
+                self._budget._touch(self, k)
+            return entry[0]
 
     def exists(self, k):
-        return k in self._c
+        with self._lock:
+            if k in self._c:
+                self._hits += 1
+                return True
+            self._misses += 1
+            return False
 
     def touch(self, k):
         """
         bring a key to the front
         """
-        v = self._c[k]
-        del self._c[k]
-        self._c[k] = v
+        with self._lock:
+            v = self._c.pop(k)
+            self._c[k] = v
+            if self._budget is not None:
+                self._budget._touch(self, k)
 
     def get(self, k):
-        return self._c[k]
+        with self._lock:
+            return self._c[k][0]
+
+    def clear(self):
+        with self._lock:
+            for k in self._c.keys():
+                self._remove(k)
+
+    def __len__(self):
+        return len(self._c)
+
+    def stats(self):
+        """
+        @rtype: dict of str to int
+        """
+        with self._lock:
+            return {
+                "entries": len(self._c),
+                "bytes": self._bytes,
+                "hits": self._hits,
+                "misses": self._misses,
+                "evictions": self._evictions,
+            }
 
 
 MFT_RECORD_SIZE = 1024
@@ -1086,21 +1828,517 @@ ORPHAN_ENTRY = "$ORPHAN"
 CYCLE_ENTRY = "<CYCLE>"
 
 
+class MFTHeaderScan(object):
+    """
+    Columnar arrays of a few MFT record header fields for every record
+      in an MFT buffer, parsed at once using NumPy.
+
+    The MFT buffer is viewed as an array of 1024 byte records, so no
+      Python objects are created per record. This is the fast way to
+      triage an MFT, such as counting the active files and directories.
+      The header fields do not require fixups.
+
+    Each of these attributes is a NumPy array indexed by record number:
+      - `magic`
+      - `flags`
+      - `sequence_number`
+      - `base_mft_record` (the raw MFT reference; see MREF, MSEQNO)
+      - `link_count`
+      - `valid`: boolean mask of records with the "FILE" magic
+      - `active`: boolean mask of valid, in-use records
+      - `directory`: boolean mask of valid directory records
+
+    Requires the `numpy` module.
+    """
+    def __init__(self, buf):
+        """
+        Constructor.
+        Arguments:
+        - `buf`: The MFT buffer. Objects that support the buffer
+            interface (str, bytearray, mmap) are viewed in place, while
+            other buffers (eg. NonResidentAttributeData) are copied.
+        """
+        import numpy
+        super(MFTHeaderScan, self).__init__()
+        dtype = numpy.dtype({
+            "names": ["magic", "sequence_number", "link_count",
+                      "flags", "base_mft_record"],
+            "formats": ["<u4", "<u2", "<u2", "<u2", "<u8"],
+            "offsets": [0x0, 0x10, 0x12, 0x16, 0x20],
+            "itemsize": MFT_RECORD_SIZE,
+        })
+
+        if hasattr(buf, "__unpackable__"):
+            buf = buf[:]
+        count = len(buf) // MFT_RECORD_SIZE
+        records = numpy.frombuffer(buf, dtype=dtype, count=count)
+
+        # copy the columns out of the record array,
+        #  so we don't hold a view into the buffer.
+        self.magic = records["magic"].copy()
+        self.flags = records["flags"].copy()
+        self.sequence_number = records["sequence_number"].copy()
+        self.base_mft_record = records["base_mft_record"].copy()
+        self.link_count = records["link_count"].copy()
+
+        self.valid = self.magic == 0x454C4946  # "FILE"
+        self.active = self.valid & \
+            ((self.flags & MFT_RECORD_FLAGS.MFT_RECORD_IN_USE) != 0)
+        self.directory = self.valid & \
+            ((self.flags & MFT_RECORD_FLAGS.MFT_RECORD_IS_DIRECTORY) != 0)
+
+    def __len__(self):
+        return len(self.magic)
+
+    def count_active_files(self):
+        return int((self.active & ~self.directory).sum())
+
+    def count_active_directories(self):
+        return int((self.active & self.directory).sum())
+
+    def active_record_numbers(self):
+        """
+        @rtype: numpy.ndarray
+        """
+        return self.active.nonzero()[0]
+
+
+MFT_FIXUP_CHUNK_SIZE = 4096  # records
+
+
+class FixedUpMFT(object):
+    """
+    A copy of an MFT with the update sequence fixups of every record
+      applied in a single pass, along with a bitmap of the records
+      found to be bad during the pass:
+      - records without the "FILE" magic, such as unused or
+        overwritten records,
+      - records with an update sequence array that does not fit
+        the record, and
+      - torn records, with a sector whose check value does not match
+        the update sequence number.
+
+    The copy is either held in memory, or written to a scratch file
+      that is then memory mapped.
+    """
+    def __init__(self, buf, scratch_filename=None,
+                 progress_class=Progress.NullProgress):
+        """
+        Constructor.
+        Arguments:
+        - `buf`: The MFT buffer.
+        - `scratch_filename`: (Optional) The path of a file to which
+            the fixed up MFT is written, rather than kept in memory.
+        - `progress_class`: A Progress subclass.
+        """
+        super(FixedUpMFT, self).__init__()
+        count = len(buf) // MFT_RECORD_SIZE
+        self._count = count
+        self._bitmap = bytearray((count + 7) // 8)
+        self._bad_count = 0
+        self._file = None
+        self._mmap = None
+
+        if scratch_filename is None:
+            self._buf = bytearray(count * MFT_RECORD_SIZE)
+            write = self._write_memory
+        else:
+            self._file = open(scratch_filename, "w+b")
+            write = self._write_file
+
+        progress = progress_class(count)
+        for start in xrange(0, count, MFT_FIXUP_CHUNK_SIZE):
+            n = min(MFT_FIXUP_CHUNK_SIZE, count - start)
+            chunk = bytearray(buf[start * MFT_RECORD_SIZE:(start + n) * MFT_RECORD_SIZE])
+            for i in self._find_bad_magic(chunk, n):
+                self._set_bad(start + i)
+            for i in apply_fixups_batch(chunk, MFT_RECORD_SIZE, count=n):
+                self._set_bad(start + i)
+            write(start, chunk)
+            progress.set_current(start + n)
+        progress.set_complete()
+
+        if self._file is not None:
+            self._file.flush()
+            if count > 0:
+                self._mmap = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ)
+                self._buf = self._mmap
+            else:
+                self._buf = ""
+
+        g_logger.debug("fixed up %d records, %d bad", count, self._bad_count)
+
+    def _write_memory(self, start, chunk):
+        self._buf[start * MFT_RECORD_SIZE:start * MFT_RECORD_SIZE + len(chunk)] = chunk
+
+    def _write_file(self, start, chunk):
+        self._file.write(chunk)
+
+    @staticmethod
+    def _find_bad_magic(chunk, n):
+        """
+        @rtype: list of int
+        @return: The indices of the records in the chunk without the "FILE" magic.
+        """
+        if all(chunk[i::MFT_RECORD_SIZE] == c * n for i, c in enumerate("FILE")):
+            return []
+        return [i for i in xrange(n)
+                if chunk[i * MFT_RECORD_SIZE:i * MFT_RECORD_SIZE + 4] != "FILE"]
+
+    def _set_bad(self, record_num):
+        mask = 1 << (record_num & 7)
+        if not self._bitmap[record_num >> 3] & mask:
+            self._bitmap[record_num >> 3] |= mask
+            self._bad_count += 1
+
+    def __len__(self):
+        return self._count
+
+    def buffer(self):
+        """
+        The fixed up MFT, which supports slicing and the buffer interface.
+        """
+        return self._buf
+
+    def bitmap(self):
+        """
+        The bitmap of bad records: bit (n % 8) of byte (n / 8) is set
+          if record n is bad.
+
+        @rtype: bytearray
+        """
+        return self._bitmap
+
+    def is_bad(self, record_num):
+        return bool(self._bitmap[record_num >> 3] & (1 << (record_num & 7)))
+
+    def bad_count(self):
+        return self._bad_count
+
+    def bad_records(self):
+        """
+        A generator of the numbers of the bad records, in order.
+        """
+        for i, byte in enumerate(self._bitmap):
+            if not byte:
+                continue
+            for bit in xrange(8):
+                if byte & (1 << bit):
+                    yield i * 8 + bit
+
+    def close(self):
+        """
+        Release the scratch file, if any.
+        The buffer may not be used after this.
+        """
+        if self._mmap is not None:
+            self._mmap.close()
+            self._mmap = None
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+
+
+class MFTPathIndex(object):
+    """
+    A table of the parent reference and filename of every record in an
+      MFT, built in a single pass over the records.
+
+    Paths are resolved by walking the parent record numbers in the
+      table, so no ancestor record is parsed again, and the paths of
+      ancestors are memoized as they are resolved. The paths are the
+      same as those of `MFTEnumerator.get_path`, including the ORPHAN,
+      CYCLE, and UNKNOWN entries.
+
+    The table is stored in compact arrays indexed by record number:
+      - `_valid`: 1 if the record has the "FILE" magic
+      - `_sequence`: the sequence number of the record
+      - `_parent`: the parent record number, or the record count if
+          it is beyond the end of the MFT
+      - `_parent_sequence`: the parent sequence number
+      - `_name`: the index of the filename in the shared name table,
+          or -1 if the record has no filename
+    """
+    def __init__(self, enumerator, progress_class=Progress.NullProgress,
+                 upcase_table=None):
+        """
+        Constructor.
+        Arguments:
+        - `enumerator`: The MFTEnumerator of the records to index.
+        - `upcase_table`: (Optional) The UpCaseTable used to compare paths.
+            Defaults to the uppercase forms given by Python.
+        """
+        super(MFTPathIndex, self).__init__()
+        count = enumerator.len()
+        self._count = count
+        self._valid = array.array("B", [0]) * count
+        self._sequence = array.array("H", [0]) * count
+        self._parent = array.array("L", [count]) * count
+        self._parent_sequence = array.array("H", [0]) * count
+        self._name = array.array("l", [-1]) * count
+        self._names = []
+        # map from record number to resolved path, for ancestors only
+        self._paths = {}
+        # map from path collation key to record number, built on first lookup
+        self._lookup = None
+        self._upcase_table = upcase_table
+
+        name_ids = {}
+        progress = progress_class(count)
+        for record_num in xrange(count):
+            progress.set_current(record_num)
+            try:
+                view = enumerator.get_record_view(record_num)
+            except InvalidRecordException:
+                continue
+
+            self._valid[record_num] = 1
+            self._sequence[record_num] = view.sequence_number()
+
+            fn = view.filename_information()
+            if not fn:
+                continue
+
+            name = fn.filename()
+            name_id = name_ids.get(name)
+            if name_id is None:
+                name_id = len(self._names)
+                name_ids[name] = name_id
+                self._names.append(name)
+            self._name[record_num] = name_id
+
+            parent_ref = fn.mft_parent_reference()
+            self._parent[record_num] = min(MREF(parent_ref), count)
+            self._parent_sequence[record_num] = MSEQNO(parent_ref)
+        progress.set_complete()
+
+    @classmethod
+    def from_tables(cls, tables, upcase_table=None):
+        """
+        Create an index from the tables of another index, such as
+          those persisted by an MFTIndexSnapshot, rather than from the
+          records of an MFT.
+
+        @type tables: dict of str to sequence
+        @param tables: As returned by `tables`. The sequences need only
+          support indexing and `len`.
+        @rtype: MFTPathIndex
+        """
+        self = cls.__new__(cls)
+        super(MFTPathIndex, self).__init__()
+        self._count = len(tables["valid"])
+        self._valid = tables["valid"]
+        self._sequence = tables["sequence"]
+        self._parent = tables["parent"]
+        self._parent_sequence = tables["parent_sequence"]
+        self._name = tables["name"]
+        self._names = tables["names"]
+        self._paths = {}
+        self._lookup = None
+        self._upcase_table = upcase_table
+        return self
+
+    def tables(self):
+        """
+        The tables of the index, from which `from_tables` creates
+          an identical index.
+
+        @rtype: dict of str to sequence
+        """
+        return {
+            "valid": self._valid,
+            "sequence": self._sequence,
+            "parent": self._parent,
+            "parent_sequence": self._parent_sequence,
+            "name": self._name,
+            "names": self._names,
+        }
+
+    def __len__(self):
+        return self._count
+
+    def get_path(self, record_num):
+        """
+        @type record_num: int
+        @rtype: str
+        @return: The path of the given record, as formatted by
+          `MFTEnumerator.get_path`.
+        """
+        r = self._get_path_impl(record_num)
+        if r == "":
+            return FILE_SEP
+        else:
+            return r
+
+    def set_upcase_table(self, upcase_table):
+        """
+        Compare paths using the given UpCaseTable, such as the
+          volume's $UpCase table, from now on.
+        """
+        self._upcase_table = upcase_table
+        self._lookup = None
+
+    def _get_upcase_table(self):
+        if self._upcase_table is None:
+            self._upcase_table = UpCaseTable()
+        return self._upcase_table
+
+    def _get_lookup(self):
+        """
+        Get the map from path collation key to record number, resolving
+          the paths of all the records on first use.
+        Like `MFTEnumerator.enumerate_records`, the reserved records
+          12-15 are skipped, and if more than one record has the same
+          path, the lowest record number wins.
+
+        @rtype: dict of str to int
+        """
+        if self._lookup is None:
+            compute_key = self._get_upcase_table().compute_key
+            lookup = {}
+            for record_num in xrange(self._count):
+                if 12 <= record_num < 16:  # reserved records are 12-15
+                    continue
+                if not self._valid[record_num]:
+                    continue
+                lookup.setdefault(compute_key(self.get_path(record_num)), record_num)
+            self._lookup = lookup
+        return self._lookup
+
+    def get_record_number(self, path):
+        """
+        Find the record with the given path, ignoring case.
+
+        @type path: str
+        @rtype: int
+        @raises KeyError: if no record has the given path.
+        """
+        lookup = self._get_lookup()
+        return lookup[self._get_upcase_table().compute_key(path)]
+
+    def get_record_numbers(self, paths):
+        """
+        Find the records with the given paths, ignoring case.
+
+        @type paths: iterable of str
+        @rtype: list of int
+        @return: The record number of each path, in the same order,
+          or None for paths that are not found.
+        """
+        lookup = self._get_lookup()
+        compute_key = self._get_upcase_table().compute_key
+        return [lookup.get(compute_key(path)) for path in paths]
+
+    def _get_path_impl(self, record_num):
+        # the records between the given record and the ancestor
+        #  from which the path is known
+        chain = []
+        visited = set()
+        current = record_num
+        while True:
+            if current in self._paths:
+                path = self._paths[current]
+                break
+
+            if current == 5:
+                path = ""
+                break
+
+            if current in visited:
+                path = CYCLE_ENTRY
+                break
+            visited.add(current)
+
+            name_id = self._name[current]
+            if name_id == -1:
+                path = UNKNOWN_ENTRY
+                break
+
+            parent = self._parent[current]
+            if parent == self._count or \
+               not self._valid[parent] or \
+               self._sequence[parent] != self._parent_sequence[current]:
+                path = ORPHAN_ENTRY + FILE_SEP + self._names[name_id]
+                break
+
+            chain.append(current)
+            current = parent
+
+        for current in reversed(chain):
+            path = path + FILE_SEP + self._names[self._name[current]]
+            if current != record_num:
+                self._paths[current] = path
+        return path
+
+
+EXTENSION_SCAN_CHUNK_SIZE = 4096  # records
+# the magic, flags, and base record reference of a record header
+EXTENSION_SCAN_HEADER = "4s18xH8xQ%dx" % (MFT_RECORD_SIZE - 0x28)
+EXTENSION_SCAN_CHUNK_HEADERS = struct.Struct("<" + EXTENSION_SCAN_HEADER * EXTENSION_SCAN_CHUNK_SIZE)
+
+
+DEFAULT_ENUMERATOR_CACHE_BYTES = 256 * 1024 * 1024
+
+
 class MFTEnumerator(object):
-    def __init__(self, buf, record_cache=None, path_cache=None):
-        DEFAULT_CACHE_SIZE = 102400
+    def __init__(self, buf, record_cache=None, path_cache=None, cache_budget=None):
+        """
+        Constructor.
+        Arguments:
+        - `buf`: The MFT.
+        - `record_cache`: (Optional) The Cache of parsed records.
+        - `path_cache`: (Optional) The Cache of record paths.
+        - `cache_budget`: (Optional) The CacheBudget of the default
+            caches. Defaults to a budget of
+            DEFAULT_ENUMERATOR_CACHE_BYTES shared by both caches.
+        """
+        if cache_budget is None:
+            cache_budget = CacheBudget(DEFAULT_ENUMERATOR_CACHE_BYTES)
         if record_cache is None:
-            record_cache = Cache(size_limit=DEFAULT_CACHE_SIZE)
+            record_cache = Cache(budget=cache_budget, sizeof=estimate_record_size)
         if path_cache is None:
-            path_cache = Cache(size_limit=DEFAULT_CACHE_SIZE)
+            path_cache = Cache(budget=cache_budget)
 
         self._buf = buf
         self._record_cache = record_cache
         self._path_cache = path_cache
+        self._cache_budget = cache_budget
+        self._path_index = None
+        self._fixed_up = None
+        self._upcase_table = None
+        self._extension_map = None
 
     def len(self):
         return len(self._buf) / MFT_RECORD_SIZE
 
+    def cache_stats(self):
+        """
+        @rtype: dict of str to dict of str to int
+        @return: The statistics of the record and path caches,
+          and of their budget.
+        """
+        return {
+            "records": self._record_cache.stats(),
+            "paths": self._path_cache.stats(),
+            "budget": self._cache_budget.stats(),
+        }
+
+    def fixup_all(self, scratch_filename=None, progress_class=Progress.NullProgress):
+        """
+        Apply the fixups of every record in the MFT in a single pass.
+        Subsequently, records are parsed in place from the fixed up MFT,
+          without copying them, and bad records are skipped without
+          being parsed.
+
+        @param scratch_filename: (Optional) The path of a file to which
+          the fixed up MFT is written, rather than kept in memory.
+        @rtype: FixedUpMFT
+        """
+        self._fixed_up = FixedUpMFT(self._buf, scratch_filename=scratch_filename,
+                                    progress_class=progress_class)
+        self._record_cache.clear()
+        return self._fixed_up
+
     def get_record_buf(self, record_num):
         """
         @raises OverrunBufferException: if the record_num is beyond the end of the MFT
@@ -1119,18 +2357,128 @@ class MFTEnumerator(object):
         @raises OverrunBufferException: if the record_num is beyond the end of the MFT.
         @raises InvalidRecordException: if the record appears invalid (incorrect magic header).
         """
-        if self._record_cache.exists(record_num):
-            self._record_cache.touch(record_num)
-            return self._record_cache.get(record_num)
+        record = self._record_cache.lookup(record_num)
+        if record is not None:
+            return record
 
-        record_buf = self.get_record_buf(record_num)
-        if BinaryParser.read_dword(record_buf, 0x0) != 0x454C4946:
-            raise InvalidRecordException("record_num: %d" % record_num)
+        if self._fixed_up is not None:
+            record = self._get_fixed_up_record(record_num)
+        else:
+            record_buf = self.get_record_buf(record_num)
+            if BinaryParser.read_dword(record_buf, 0x0) != 0x454C4946:
+                raise InvalidRecordException("record_num: %d" % record_num)
 
-        record = MFTRecord(record_buf, 0, False, inode=record_num)
+            record = MFTRecord(record_buf, 0, False, inode=record_num)
+        record.set_enumerator(self)
         self._record_cache.insert(record_num, record)
         return record
 
+    def _build_extension_map(self):
+        """
+        Scan the headers of every record for extension records, which
+          refer to their base record.
+
+        @rtype: dict of int to list of int
+        @return: Map from base record number to the numbers of its
+          in-use extension records, in order.
+        """
+        ret = {}
+        count = self.len()
+        for start in xrange(0, count, EXTENSION_SCAN_CHUNK_SIZE):
+            n = min(EXTENSION_SCAN_CHUNK_SIZE, count - start)
+            if n == EXTENSION_SCAN_CHUNK_SIZE:
+                header = EXTENSION_SCAN_CHUNK_HEADERS
+            else:
+                header = struct.Struct("<" + EXTENSION_SCAN_HEADER * n)
+            chunk = str(self._buf[start * MFT_RECORD_SIZE:(start + n) * MFT_RECORD_SIZE])
+            fields = header.unpack(chunk)
+            for i, base_mft_record in enumerate(fields[2::3]):
+                if base_mft_record == 0:
+                    continue
+                if fields[3 * i] != "FILE" or \
+                   not fields[3 * i + 1] & MFT_RECORD_FLAGS.MFT_RECORD_IN_USE:
+                    continue
+                ret.setdefault(MREF(base_mft_record), []).append(start + i)
+        g_logger.debug("found extension records of %d base records", len(ret))
+        return ret
+
+    def get_extension_records(self, record):
+        """
+        Get the extension records of the given base record, which hold
+          the attributes listed in its $ATTRIBUTE_LIST that do not fit
+          in the base record.
+        The extension records of every record are found in a single
+          scan of the record headers, on first use.
+
+        @type record: MFTRecord
+        @rtype: list of MFTRecord
+        """
+        if self._extension_map is None:
+            self._extension_map = self._build_extension_map()
+
+        ret = []
+        for record_num in self._extension_map.get(record.inode, ()):
+            try:
+                extension = self.get_record(record_num)
+            except (BinaryParser.OverrunBufferException, InvalidRecordException):
+                continue
+            if MSEQNO(extension.base_mft_record()) != record.sequence_number():
+                continue
+            ret.append(extension)
+        return ret
+
+    def _get_fixed_up_record(self, record_num):
+        start = record_num * MFT_RECORD_SIZE
+        if start + MFT_RECORD_SIZE > len(self._buf):
+            raise BinaryParser.OverrunBufferException(start + MFT_RECORD_SIZE, len(self._buf))
+        if self._fixed_up.is_bad(record_num):
+            raise InvalidRecordException("record_num: %d" % record_num)
+        return MFTRecord(self._fixed_up.buffer(), start, False,
+                         inode=record_num, fixup=False)
+
+    def get_record_view(self, record_num):
+        """
+        Get a lightweight view of a record that does not copy it from
+          the MFT buffer. Views are not cached.
+
+        @raises OverrunBufferException: if the record_num is beyond the end of the MFT.
+        @raises InvalidRecordException: if the record appears invalid (incorrect magic header).
+        @rtype: MFTRecordView
+        """
+        start = record_num * MFT_RECORD_SIZE
+        if start + MFT_RECORD_SIZE > len(self._buf):
+            raise BinaryParser.OverrunBufferException(start + MFT_RECORD_SIZE, len(self._buf))
+
+        if self._fixed_up is not None:
+            if self._fixed_up.is_bad(record_num):
+                raise InvalidRecordException("record_num: %d" % record_num)
+            return MFTRecordView(self._fixed_up.buffer(), start,
+                                 inode=record_num, fixup=False, enumerator=self)
+
+        view = MFTRecordView(self._buf, start, inode=record_num, enumerator=self)
+        if not view.is_valid():
+            raise InvalidRecordException("record_num: %d" % record_num)
+        return view
+
+    def enumerate_record_views(self):
+        """
+        Like `enumerate_records`, but yield MFTRecordViews, which is much
+          cheaper when only the record headers are inspected.
+        """
+        index = 0
+        while True:
+            if index == 12:  # reserved records are 12-15
+                index = 16
+            try:
+                view = self.get_record_view(index)
+                yield view
+                index += 1
+            except InvalidRecordException:
+                index += 1
+                continue
+            except BinaryParser.OverrunBufferException:
+                return
+
     def enumerate_records(self):
         index = 0
         while True:
@@ -1147,9 +2495,57 @@ class MFTEnumerator(object):
                 return
 
     def enumerate_paths(self):
+        """
+        Yield each record along with its path.
+        The paths are resolved using an MFTPathIndex, which is built
+          before the first record is yielded.
+        """
+        index = self.get_path_index()
         for record in self.enumerate_records():
-            path = self.get_path(record)
-            yield record, path
+            yield record, index.get_path(record.inode)
+
+    def set_upcase_table(self, upcase_table):
+        """
+        Compare paths using the given UpCaseTable, such as the
+          volume's $UpCase table, rather than the uppercase forms
+          given by Python.
+        """
+        self._upcase_table = upcase_table
+        if self._path_index is not None:
+            self._path_index.set_upcase_table(upcase_table)
+
+    def build_path_index(self, progress_class=Progress.NullProgress):
+        """
+        Index the parent and filename of every record in the MFT,
+          for resolving many paths at once.
+
+        @rtype: MFTPathIndex
+        """
+        return MFTPathIndex(self, progress_class=progress_class,
+                            upcase_table=self._upcase_table)
+
+    def get_path_index(self):
+        """
+        Like `build_path_index`, but the index is built once, and then
+          kept by this enumerator for subsequent calls, such as path
+          lookups.
+
+        @rtype: MFTPathIndex
+        """
+        if self._path_index is None:
+            self._path_index = self.build_path_index()
+        return self._path_index
+
+    def set_path_index(self, path_index):
+        """
+        Use the given index, such as one loaded from an
+          MFTIndexSnapshot, rather than building one.
+
+        @type path_index: MFTPathIndex
+        """
+        if self._upcase_table is not None:
+            path_index.set_upcase_table(self._upcase_table)
+        self._path_index = path_index
 
     def get_path(self, record):
         """
@@ -1181,9 +2577,9 @@ class MFTEnumerator(object):
         key = "%d-%d-%d-%d-%d" % (record.magic(), record.lsn(),
                                   record.link_count(), record.mft_record_number(),
                                   record.flags())
-        if self._path_cache.exists(key):
-            self._path_cache.touch(key)
-            return self._path_cache.get(key)
+        path = self._path_cache.lookup(key)
+        if path is not None:
+            return path
 
         record_num = record.mft_record_number()
         if record_num == 5:
@@ -1215,99 +2611,159 @@ class MFTEnumerator(object):
         self._path_cache.insert(key, path)
         return path
 
+    def scan_headers(self):
+        """
+        Parse the header fields of every record in the MFT at once.
+        Requires the `numpy` module.
+
+        @rtype: MFTHeaderScan
+        """
+        return MFTHeaderScan(self._buf)
+
     def get_record_by_path(self, path):
-        lower_path = path.lower()
-        for record, record_path in self.enumerate_paths():
-            if lower_path == record_path.lower():
-                return record
-        raise KeyError("Path not found: %s" % path)
+        """
+        Find the record with the given path, ignoring case.
+        The first lookup resolves the paths of all the records, and
+          subsequent lookups are constant time.
+
+        @type path: str
+        @rtype: MFTRecord
+        @raises KeyError: if no record has the given path.
+        """
+        try:
+            record_num = self.get_path_index().get_record_number(path)
+        except KeyError:
+            raise KeyError("Path not found: %s" % path)
+        return self.get_record(record_num)
+
+    def get_records_by_path(self, paths):
+        """
+        Find the records with the given paths, ignoring case.
+
+        @type paths: iterable of str
+        @rtype: list of MFTRecord
+        @return: The record of each path, in the same order,
+          or None for paths that are not found.
+        """
+        record_nums = self.get_path_index().get_record_numbers(paths)
+        return [self.get_record(record_num) if record_num is not None else None
+                for record_num in record_nums]
 
 
 class MFTTreeNode(object):
-    def __init__(self, nodes, record_number, filename, parent_record_number):
+    """
+    A node of an MFTTree. Nodes are created on demand, and read
+      from the arrays of the tree.
+    """
+    __slots__ = ("_tree", "_record_number")
+
+    def __init__(self, tree, record_number):
         super(MFTTreeNode, self).__init__()
-        self._nodes = nodes
+        self._tree = tree
         self._record_number = record_number
-        self._filename = filename
-        self._parent_record_number = parent_record_number
-        self._children_record_numbers = []
 
     def get_record_number(self):
         return self._record_number
 
     def get_filename(self):
-        return self._filename
+        return self._tree._get_filename(self._record_number)
 
     def get_parent(self):
-        return self._nodes[self._parent_record_number]
+        return self._tree.get_node(self._tree._parent[self._record_number])
 
-    def add_child_record_number(self, child_record_number):
-        self._children_record_numbers.append(child_record_number)
+    def _children_record_numbers(self):
+        tree = self._tree
+        child = tree._first_child[self._record_number]
+        while child != MFT_TREE_NO_NODE:
+            yield child
+            child = tree._next_sibling[child]
 
     def get_children_nodes(self):
-        return map(lambda n: self._nodes[n], self._children_record_numbers)
+        return [MFTTreeNode(self._tree, n) for n in self._children_record_numbers()]
 
     def get_child_node(self, filename):
-        for child in self.get_children_nodes():
-            if child.get_filename() == filename:
-                return child
+        for n in self._children_record_numbers():
+            if self._tree._get_filename(n) == filename:
+                return MFTTreeNode(self._tree, n)
         raise KeyError("Failed to find filename: " + filename)
 
 
 ROOT_INDEX = 5
+MFT_TREE_NO_NODE = -1
 class MFTTree(object):
+    """
+    The tree of records of an MFT, linked by the parent reference of
+      their filename.
+
+    The tree is stored in compact arrays indexed by record number:
+      - `_parent`: the parent record number, or -1 if the record
+          is not a node
+      - `_first_child`: the first child record number, or -1
+      - `_next_sibling`: the next child of the parent, or -1
+      - `_name_offset` and `_name_length`: the UTF-8 filename, in
+          the shared buffer `_names`
+    The children of a node are in record number order. Records whose
+      parent is not a node, or has a different sequence number, are
+      children of the ORPHAN node.
+    """
     ORPHAN_INDEX = 12
 
     def __init__(self, buf):
         super(MFTTree, self).__init__()
         self._buf = buf
-        self._nodes = {}  # array of MFTTreeNodes
-
-    def _add_record(self, mft_enumerator, record):
-        record_num = record.mft_record_number()
-
-        if record_num in self._nodes:
-            return
-
-        if record_num == ROOT_INDEX:
-            self._nodes[ROOT_INDEX] = MFTTreeNode(self._nodes, ROOT_INDEX, "\.", ROOT_INDEX)
-            return
-
-        fn = record.filename_information()
-        if not fn:
-            # then there's no filename, or parent reference
-            # there could be some standard information (timestamps),
-            # or named streams
-            # but still no parent link.
-            # ...so lets bail
-            return
-
-        parent_record_num = MREF(fn.mft_parent_reference())
-        parent_seq_num = MSEQNO(fn.mft_parent_reference())
-
-        try:
-            parent_record = mft_enumerator.get_record(parent_record_num)
-        except (BinaryParser.OverrunBufferException, InvalidRecordException):
-            parent_record_num = MFTTree.ORPHAN_INDEX
-            parent_record = None
+        # 32 bit items, whatever the size of a C long
+        self._parent = array.array("i")
+        self._first_child = array.array("i")
+        self._next_sibling = array.array("i")
+        self._name_offset = array.array("I")
+        self._name_length = array.array("H")
+        self._names = bytearray()
+
+    @classmethod
+    def from_tables(cls, tables):
+        """
+        Create a tree from the tables of another tree, such as those
+          persisted by an MFTIndexSnapshot, rather than building it.
 
-        if not parent_record:
-            parent_record_num = MFTTree.ORPHAN_INDEX
-        elif parent_record.sequence_number() != parent_seq_num:
-            parent_record_num = MFTTree.ORPHAN_INDEX
+        @type tables: dict of str to sequence
+        @param tables: As returned by `tables`. The sequences need only
+          support indexing and `len`, and the names slicing.
+        @rtype: MFTTree
+        """
+        self = cls(None)
+        self._parent = tables["parent"]
+        self._first_child = tables["first_child"]
+        self._next_sibling = tables["next_sibling"]
+        self._name_offset = tables["name_offset"]
+        self._name_length = tables["name_length"]
+        self._names = tables["names"]
+        return self
+
+    def tables(self):
+        """
+        The tables of the tree, from which `from_tables` creates
+          an identical tree.
 
-        if parent_record_num != MFTTree.ORPHAN_INDEX and parent_record:
-            self._add_record(mft_enumerator, parent_record)
+        @rtype: dict of str to sequence
+        """
+        return {
+            "parent": self._parent,
+            "first_child": self._first_child,
+            "next_sibling": self._next_sibling,
+            "name_offset": self._name_offset,
+            "name_length": self._name_length,
+            "names": self._names,
+        }
 
-        try:
-            parent_node = self._nodes[parent_record_num]
-        except IndexError:
-            parent_record_num = MFTTree.ORPHAN_INDEX
+    def _set_filename(self, record_num, filename):
+        name = filename.encode("utf-8")
+        self._name_offset[record_num] = len(self._names)
+        self._name_length[record_num] = len(name)
+        self._names.extend(name)
 
-        record_node = MFTTreeNode(self._nodes, record_num, fn.filename(), parent_record_num)
-        self._nodes[record_num] = record_node
-        if parent_node:
-            parent_node.add_child_record_number(record_num)
+    def _get_filename(self, record_num):
+        offset = self._name_offset[record_num]
+        return str(self._names[offset:offset + self._name_length[record_num]]).decode("utf-8")
 
     def build(self, record_cache=None,
               path_cache=None, progress_class=Progress.NullProgress):
@@ -1319,16 +2775,186 @@ class MFTTree(object):
 
         enum = MFTEnumerator(self._buf, record_cache=record_cache, path_cache=path_cache)
 
-        self._nodes[MFTTree.ORPHAN_INDEX] = MFTTreeNode(self._nodes, MFTTree.ORPHAN_INDEX,
-                                                        ORPHAN_ENTRY, ROOT_INDEX)
+        count = max(enum.len(), MFTTree.ORPHAN_INDEX + 1)
+        self._parent = array.array("i", [MFT_TREE_NO_NODE]) * count
+        self._first_child = array.array("i", [MFT_TREE_NO_NODE]) * count
+        self._next_sibling = array.array("i", [MFT_TREE_NO_NODE]) * count
+        self._name_offset = array.array("I", [0]) * count
+        self._name_length = array.array("H", [0]) * count
+        self._names = bytearray()
+        # only needed while the nodes are linked
+        sequence = array.array("H", [0]) * count
+        parent_sequence = array.array("H", [0]) * count
+
+        # first, read the parent reference and filename of each record
+        progress = progress_class(count)
+        for record_num in xrange(count):
+            progress.set_current(record_num)
+            if 12 <= record_num < 16:  # reserved records are 12-15
+                continue
+            try:
+                view = enum.get_record_view(record_num)
+            except (BinaryParser.OverrunBufferException, InvalidRecordException):
+                continue
+            sequence[record_num] = view.sequence_number()
 
-        count = 0
-        progress = progress_class(len(self._buf) / 1024)
-        for record in enum.enumerate_records():
-            self._add_record(enum, record)
-            count += 1
-            progress.set_current(count)
+            if record_num == ROOT_INDEX:
+                self._parent[ROOT_INDEX] = ROOT_INDEX
+                self._set_filename(ROOT_INDEX, "\.")
+                continue
+
+            fn = view.filename_information()
+            if not fn:
+                # then there's no filename, or parent reference
+                # there could be some standard information (timestamps),
+                # or named streams
+                # but still no parent link.
+                # ...so its not a node
+                continue
+
+            parent_ref = fn.mft_parent_reference()
+            self._parent[record_num] = min(MREF(parent_ref), count)
+            parent_sequence[record_num] = MSEQNO(parent_ref)
+            self._set_filename(record_num, fn.filename())
+
+        self._parent[MFTTree.ORPHAN_INDEX] = ROOT_INDEX
+        self._set_filename(MFTTree.ORPHAN_INDEX, ORPHAN_ENTRY)
+
+        # then, link each node to its parent, in reverse, so that
+        #  the children of a node end up in record number order
+        for record_num in xrange(count - 1, -1, -1):
+            parent_num = self._parent[record_num]
+            if parent_num == MFT_TREE_NO_NODE or \
+               record_num in (ROOT_INDEX, MFTTree.ORPHAN_INDEX):
+                continue
+
+            if parent_num == count or \
+               self._parent[parent_num] == MFT_TREE_NO_NODE or \
+               sequence[parent_num] != parent_sequence[record_num]:
+                parent_num = MFTTree.ORPHAN_INDEX
+                self._parent[record_num] = parent_num
+
+            self._next_sibling[record_num] = self._first_child[parent_num]
+            self._first_child[parent_num] = record_num
         progress.set_complete()
 
+    def get_node(self, record_number):
+        """
+        @rtype: MFTTreeNode
+        @raises KeyError: if the record is not a node of the tree.
+        """
+        if not 0 <= record_number < len(self._parent) or \
+           self._parent[record_number] == MFT_TREE_NO_NODE:
+            raise KeyError("Record is not in tree: %d" % record_number)
+        return MFTTreeNode(self, record_number)
+
     def get_root(self):
-        return self._nodes[ROOT_INDEX]
+        return self.get_node(ROOT_INDEX)
+
+
+def _make_test_record(record_num):
+    """
+    Make an in-use MFT record with no attributes, and its fixups applied
+      to the buffer, as it would be stored on disk.
+
+    @rtype: bytearray
+    """
+    buf = bytearray(MFT_RECORD_SIZE)
+    usa_offset = 0x30
+    usa_count = MFT_RECORD_SIZE // 512 + 1
+    attrs_offset = 0x38
+    struct.pack_into("<4sHHQHHHHII", buf, 0, "FILE", usa_offset, usa_count, 0, 1, 1,
+                     attrs_offset, MFT_RECORD_FLAGS.MFT_RECORD_IN_USE,
+                     attrs_offset + 8, MFT_RECORD_SIZE)
+    struct.pack_into("<I", buf, 0x2C, record_num)
+    struct.pack_into("<I", buf, attrs_offset, 0xFFFFFFFF)
+    usn = 1
+    struct.pack_into("<H", buf, usa_offset, usn)
+    for i in xrange(1, usa_count):
+        end = i * 512 - 2
+        buf[usa_offset + 2 * i:usa_offset + 2 * i + 2] = buf[end:end + 2]
+        struct.pack_into("<H", buf, end, usn)
+    return buf
+
+
+def test():
+    count = 1024
+    mft = bytearray()
+    for record_num in xrange(count):
+        mft += _make_test_record(record_num)
+
+    # the fixed up MFT is larger than the budget, but the records
+    #  parsed in place from it are charged only for their own bytes
+    budget = CacheBudget(64 * 1024)
+    enumerator = MFTEnumerator(mft, cache_budget=budget)
+    enumerator.fixup_all()
+    for record_num in xrange(16, 26):
+        assert enumerator.get_record(record_num).inode == record_num
+    stats = enumerator.cache_stats()
+    assert stats["records"]["entries"] == 10, stats
+    assert stats["records"]["evictions"] == 0, stats
+    print "MFTEnumerator cache passed tests."
+
+    # the extents of an attribute are merged in VCN order, even when
+    #  the first extent is found after a later one, such as in an
+    #  extension record
+    class FakeExtent(object):
+        def __init__(self, lowest_vcn, highest_vcn, data_size):
+            self._vcns = (lowest_vcn, highest_vcn)
+            self._data_size = data_size
+
+        def type(self):
+            return ATTR_TYPE.DATA
+
+        def non_resident(self):
+            return 1
+
+        def name(self):
+            return ""
+
+        def lowest_vcn(self):
+            return self._vcns[0]
+
+        def highest_vcn(self):
+            return self._vcns[1]
+
+        def data_size(self):
+            return self._data_size
+
+    record = enumerator.get_record(16)
+    record.attributes = lambda: iter([FakeExtent(8, 15, 0), FakeExtent(0, 7, 0x10000)])
+    data = record.attribute(ATTR_TYPE.DATA)
+    assert [e.lowest_vcn() for e in data.extents()] == [0, 8]
+    assert data.data_size() == 0x10000
+    assert data.highest_vcn() == 15
+    print "MFTRecord extents passed tests."
+
+    # caches sharing a budget, used from several threads, evict
+    #  each other's entries without losing track of their sizes
+    budget = CacheBudget(4096)
+    caches = [Cache(budget=budget), Cache(size_limit=8, budget=budget)]
+
+    def worker(seed):
+        for i in xrange(2000):
+            cache = caches[(seed + i) % 2]
+            k = (seed * i) % 64
+            v = cache.lookup(k)
+            if v is None:
+                cache.insert(k, "x" * k)
+            else:
+                assert v == "x" * k
+
+    threads = [threading.Thread(target=worker, args=(seed,)) for seed in xrange(1, 9)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    stats = budget.stats()
+    assert stats["bytes"] <= stats["max_bytes"], stats
+    assert stats["bytes"] == sum(c.stats()["bytes"] for c in caches), stats
+    assert stats["entries"] == sum(len(c) for c in caches), stats
+    print "Cache passed tests."
+
+
+if __name__ == "__main__":
+    test()
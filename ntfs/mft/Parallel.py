@@ -0,0 +1,248 @@
+#!/usr/bin/env python
+"""
+Enumerate the records of an MFT using a pool of worker processes.
+
+The MFT is split into shards of consecutive, record-aligned record
+  numbers. Each worker process opens its own memory map of the MFT file,
+  and parses the records of the shards it is handed. The results are
+  merged back together in record number order, so they are the same
+  as those of the serial MFTEnumerator.
+"""
+import sys
+import mmap
+import logging
+import multiprocessing
+
+from .MFT import MFTRecord
+from .MFT import MFTEnumerator
+from .MFT import MFT_RECORD_SIZE
+from .MFT import InvalidRecordException
+
+
+g_logger = logging.getLogger("ntfs.mft.parallel")
+
+
+DEFAULT_SHARD_SIZE = 8192  # records
+
+
+# the state of a worker process, set up by `_init_worker`
+_g_mmap = None
+_g_enumerator = None
+
+
+def _init_worker(filename, offset, length):
+    """
+    Open the worker's own memory map of the MFT.
+    The file object may be closed once the map is created.
+    """
+    global _g_mmap
+    global _g_enumerator
+    with open(filename, "rb") as f:
+        _g_mmap = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    _g_enumerator = MFTEnumerator(buffer(_g_mmap, offset, length))
+
+
+def _parse_shard(args):
+    """
+    Parse the valid records in the given range of record numbers.
+
+    @type args: tuple(int, int, callable)
+    @param args: The first record number, the record number after the
+      last, and the function to apply to each valid record.
+    @rtype: list of tuple(int, object)
+    @return: The record number and result of each valid record.
+    """
+    start, end, func = args
+    ret = []
+    for record_num in xrange(start, end):
+        if 12 <= record_num < 16:  # reserved records are 12-15
+            continue
+        try:
+            record = _g_enumerator.get_record(record_num)
+        except InvalidRecordException:
+            continue
+        ret.append((record_num, func(_g_enumerator, record)))
+    return ret
+
+
+def _record_buf(enumerator, record):
+    """
+    The fixed up bytes of the record.
+    """
+    return record.unpack_binary(0, length=MFT_RECORD_SIZE)
+
+
+def _record_buf_and_path(enumerator, record):
+    return _record_buf(enumerator, record), enumerator.get_path(record)
+
+
+class ParallelMFTEnumerator(object):
+    """
+    Like MFTEnumerator, but the records are parsed in worker processes.
+
+    The MFT must be a contiguous run of records in a file,
+      such as an $MFT extracted from an image.
+    """
+    def __init__(self, filename, offset=0, length=None,
+                 workers=None, shard_size=DEFAULT_SHARD_SIZE):
+        """
+        Constructor.
+        Arguments:
+        - `filename`: The path of the file containing the MFT.
+        - `offset`: The offset into the file at which the MFT starts.
+        - `length`: The length of the MFT, in bytes. Defaults to the
+            rest of the file.
+        - `workers`: The number of worker processes. Defaults to the
+            number of CPUs.
+        - `shard_size`: The number of records parsed by a worker at a time.
+        """
+        super(ParallelMFTEnumerator, self).__init__()
+        if length is None:
+            with open(filename, "rb") as f:
+                f.seek(0, 2)
+                length = f.tell() - offset
+        if workers is None:
+            workers = multiprocessing.cpu_count()
+
+        self._filename = filename
+        self._offset = offset
+        self._length = length
+        self._workers = workers
+        self._shard_size = shard_size
+        self._mmap = None
+        self._enumerator = None
+
+    def len(self):
+        return self._length / MFT_RECORD_SIZE
+
+    def get_enumerator(self):
+        """
+        Get the MFTEnumerator over this process's own memory map of the
+          MFT, with which the records sent back by the workers resolve
+          their $ATTRIBUTE_LIST. The map is opened on first use.
+
+        @rtype: MFTEnumerator
+        """
+        if self._enumerator is None:
+            with open(self._filename, "rb") as f:
+                self._mmap = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            self._enumerator = MFTEnumerator(buffer(self._mmap, self._offset, self._length))
+        return self._enumerator
+
+    def close(self):
+        """
+        Release the memory map of the MFT.
+        The records enumerated may not resolve their extension
+          records after this.
+        """
+        if self._mmap is not None:
+            self._enumerator = None
+            self._mmap.close()
+            self._mmap = None
+
+    def _make_record(self, record_num, buf):
+        record = MFTRecord(buf, 0, False, inode=record_num, fixup=False)
+        record.set_enumerator(self.get_enumerator())
+        return record
+
+    def shards(self):
+        """
+        @rtype: list of tuple(int, int)
+        @return: The first record number, and the record number after
+          the last, of each shard.
+        """
+        count = self.len()
+        return [(start, min(start + self._shard_size, count))
+                for start in xrange(0, count, self._shard_size)]
+
+    def map_records(self, func):
+        """
+        Apply a function to each valid record of the MFT, in the
+          worker processes.
+
+        The function is called with the worker's MFTEnumerator, and
+          the MFTRecord, and its result is sent back to this process.
+        So, the function must be defined at the top level of a module,
+          and its result must be picklable.
+
+        @type func: callable
+        @rtype: generator of tuple(int, object)
+        @return: The record number and result of each valid record,
+          in record number order.
+        """
+        pool = multiprocessing.Pool(self._workers,
+                                    initializer=_init_worker,
+                                    initargs=(self._filename, self._offset, self._length))
+        try:
+            shards = [(start, end, func) for start, end in self.shards()]
+            g_logger.debug("parsing %d records in %d shards with %d workers",
+                           self.len(), len(shards), self._workers)
+            # imap returns the results in the order of the shards
+            for results in pool.imap(_parse_shard, shards):
+                for result in results:
+                    yield result
+            pool.close()
+        finally:
+            pool.terminate()
+            pool.join()
+
+    def enumerate_records(self):
+        """
+        Like `MFTEnumerator.enumerate_records`.
+        The records are validated and fixed up in the worker processes,
+          and resolve their $ATTRIBUTE_LIST using `get_enumerator`.
+        """
+        for record_num, buf in self.map_records(_record_buf):
+            yield self._make_record(record_num, buf)
+
+    def enumerate_paths(self):
+        """
+        Like `MFTEnumerator.enumerate_paths`.
+        The paths are resolved in the worker processes.
+        """
+        for record_num, (buf, path) in self.map_records(_record_buf_and_path):
+            yield self._make_record(record_num, buf), path
+
+
+def _describe_record(record):
+    """
+    The record number, flags, and attributes of a record, including those
+      in its extension records, and the runs of its data attribute.
+    """
+    attributes = [(a.type(), a.instance()) for a in record.attributes()]
+    data = record.data_attribute()
+    if data is None or not data.non_resident():
+        runs = None
+    else:
+        runs = list(data.runlist().runs())
+    return record.inode, record.flags(), attributes, runs
+
+
+def test(filename):
+    """
+    Check that the parallel enumeration of the MFT in the given file,
+      such as an $MFT extracted from an image, matches the serial one,
+      including the attributes of records with an $ATTRIBUTE_LIST.
+    """
+    with open(filename, "rb") as f:
+        mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    try:
+        enumerator = MFTEnumerator(buffer(mm))
+        serial = [_describe_record(r) for r in enumerator.enumerate_records()]
+    finally:
+        mm.close()
+
+    parallel_enumerator = ParallelMFTEnumerator(filename, workers=2, shard_size=256)
+    try:
+        parallel = [_describe_record(r) for r in parallel_enumerator.enumerate_records()]
+    finally:
+        parallel_enumerator.close()
+
+    assert len(serial) == len(parallel), (len(serial), len(parallel))
+    for expected, actual in zip(serial, parallel):
+        assert expected == actual, (expected, actual)
+    print "parallel enumeration of %d records matches serial." % len(serial)
+
+
+if __name__ == "__main__":
+    test(sys.argv[1])
@@ -0,0 +1,385 @@
+#!/usr/bin/env python
+"""
+Persist the indexes of an MFT to a sidecar file, so that reopening the
+  same image need not parse every record again.
+
+A snapshot holds the tables of an MFTPathIndex (whether each record is
+  valid, its sequence number, its parent reference and its filename),
+  and of an MFTTree (the children of each directory). It is keyed by
+  the serial number of the volume and a hash of the MFT, and is memory
+  mapped when opened, so only the pages of the tables that are used
+  are read.
+
+The file starts with a header, followed by a table of sections, each
+  of which is aligned to eight bytes:
+  - array: the items of an `array.array`, in native byte order
+  - blob: a string of bytes
+  - names: an array of count + 1 unsigned int offsets, followed by
+      the UTF-8 encoded names, so that name i is the bytes from
+      offset i to offset i + 1
+"""
+import os
+import sys
+import mmap
+import array
+import struct
+import hashlib
+import logging
+
+from .MFT import MFTTree
+from .MFT import MFTPathIndex
+from .MFT import MFT_RECORD_SIZE
+
+
+g_logger = logging.getLogger("ntfs.mft.snapshot")
+
+
+SNAPSHOT_MAGIC = "NTFSIDX\x00"
+SNAPSHOT_VERSION = 1
+SNAPSHOT_ALIGNMENT = 8
+SNAPSHOT_HEADER = struct.Struct("<8sII20sQI")  # magic, version, byte order, key, record count, section count
+SNAPSHOT_SECTION = struct.Struct("<32sccHQQ")  # name, kind, typecode, item size, offset, count
+
+SECTION_ARRAY = "a"
+SECTION_BLOB = "b"
+SECTION_NAMES = "n"
+
+SNAPSHOT_KEY_CHUNK_SIZE = 4096  # records
+# the log file sequence number and sequence number of a record header
+SNAPSHOT_KEY_HEADER = "8x10s%dx" % (MFT_RECORD_SIZE - 0x12)
+SNAPSHOT_KEY_CHUNK_HEADERS = struct.Struct("<" + SNAPSHOT_KEY_HEADER * SNAPSHOT_KEY_CHUNK_SIZE)
+
+
+class SnapshotError(Exception):
+    def __init__(self, msg):
+        super(SnapshotError, self).__init__(msg)
+        self._msg = msg
+
+    def __str__(self):
+        return "SnapshotError(%s)" % (self._msg)
+
+
+def _byte_order():
+    return 0 if sys.byteorder == "little" else 1
+
+
+def snapshot_key(volume_serial_number, mft_buf):
+    """
+    Compute the key of the snapshot of an MFT.
+
+    The key hashes the length of the MFT, and the log file sequence
+      number and sequence number of every record, in a single scan of
+      the record headers. Since NTFS updates the log file sequence
+      number of a record whenever it changes the record, any changed
+      record changes the key, without hashing the whole MFT.
+
+    @type volume_serial_number: int
+    @param mft_buf: The MFT, which supports slicing and `len`.
+    @rtype: str
+    """
+    count = len(mft_buf) // MFT_RECORD_SIZE
+    h = hashlib.sha1()
+    h.update(struct.pack("<QQ", volume_serial_number, len(mft_buf)))
+    for start in xrange(0, count, SNAPSHOT_KEY_CHUNK_SIZE):
+        n = min(SNAPSHOT_KEY_CHUNK_SIZE, count - start)
+        if n == SNAPSHOT_KEY_CHUNK_SIZE:
+            header = SNAPSHOT_KEY_CHUNK_HEADERS
+        else:
+            header = struct.Struct("<" + SNAPSHOT_KEY_HEADER * n)
+        chunk = str(mft_buf[start * MFT_RECORD_SIZE:(start + n) * MFT_RECORD_SIZE])
+        h.update("".join(header.unpack(chunk)))
+    return h.digest()
+
+
+class MappedArray(object):
+    """
+    A read-only array whose items are unpacked from a buffer, such
+      as a memory map, as they are accessed.
+    """
+    __slots__ = ("_buf", "_offset", "_struct", "_count")
+
+    def __init__(self, buf, offset, typecode, count):
+        """
+        Constructor.
+        Arguments:
+        - `buf`: The buffer.
+        - `offset`: The offset of the first item.
+        - `typecode`: The `array.array` typecode of the items,
+            which are in native byte order.
+        - `count`: The number of items.
+        """
+        super(MappedArray, self).__init__()
+        self._buf = buf
+        self._offset = offset
+        self._struct = struct.Struct(typecode)
+        self._count = count
+
+    def __len__(self):
+        return self._count
+
+    def __getitem__(self, index):
+        if index < 0:
+            index += self._count
+        if not 0 <= index < self._count:
+            raise IndexError("MappedArray index out of range")
+        return self._struct.unpack_from(self._buf, self._offset + index * self._struct.size)[0]
+
+
+class MappedNames(object):
+    """
+    A read-only list of names, decoded from a names section of a
+      buffer, such as a memory map, as they are accessed.
+    """
+    __slots__ = ("_buf", "_offsets", "_start")
+
+    def __init__(self, buf, offset, count):
+        super(MappedNames, self).__init__()
+        self._buf = buf
+        self._offsets = MappedArray(buf, offset, "I", count + 1)
+        self._start = offset + (count + 1) * self._offsets._struct.size
+
+    def __len__(self):
+        return len(self._offsets) - 1
+
+    def __getitem__(self, index):
+        if index < 0:
+            index += len(self)
+        if not 0 <= index < len(self):
+            raise IndexError("MappedNames index out of range")
+        start = self._start + self._offsets[index]
+        end = self._start + self._offsets[index + 1]
+        return self._buf[start:end].decode("utf-8")
+
+
+def _pad(f):
+    padding = -f.tell() % SNAPSHOT_ALIGNMENT
+    f.write("\x00" * padding)
+
+
+def _write_section(f, name, table):
+    """
+    Write the given table at the current position of the file.
+
+    @type table: array.array, bytearray or str (blob), or list of unicode (names)
+    @rtype: str
+    @return: The entry of the section table.
+    """
+    _pad(f)
+    offset = f.tell()
+    if isinstance(table, array.array):
+        table.tofile(f)
+        return SNAPSHOT_SECTION.pack(name, SECTION_ARRAY, table.typecode,
+                                     table.itemsize, offset, len(table))
+    elif isinstance(table, (bytearray, str)):
+        f.write(table)
+        return SNAPSHOT_SECTION.pack(name, SECTION_BLOB, "\x00", 1, offset, len(table))
+    else:
+        offsets = array.array("I", [0])
+        data = []
+        for n in table:
+            data.append(n.encode("utf-8"))
+            offsets.append(offsets[-1] + len(data[-1]))
+        offsets.tofile(f)
+        f.write("".join(data))
+        return SNAPSHOT_SECTION.pack(name, SECTION_NAMES, "\x00", 1, offset, len(table))
+
+
+def write_snapshot(filename, key, path_index, tree):
+    """
+    Write the tables of the given indexes to a snapshot file.
+    The file is written to a temporary file first, and then renamed,
+      so a concurrent reader never sees a partial snapshot.
+
+    @type key: str
+    @param key: As computed by `snapshot_key`.
+    @type path_index: MFTPathIndex
+    @type tree: MFTTree
+    """
+    sections = []
+    for prefix, tables in (("path", path_index.tables()), ("tree", tree.tables())):
+        for name in sorted(tables.keys()):
+            sections.append((prefix + "." + name, tables[name]))
+
+    temp_filename = filename + ".tmp"
+    try:
+        with open(temp_filename, "wb") as f:
+            f.write(SNAPSHOT_HEADER.pack(SNAPSHOT_MAGIC, SNAPSHOT_VERSION, _byte_order(),
+                                         key, len(path_index), len(sections)))
+            table_offset = f.tell()
+            f.write("\x00" * (SNAPSHOT_SECTION.size * len(sections)))
+
+            entries = [_write_section(f, name, table) for name, table in sections]
+            f.seek(table_offset)
+            f.write("".join(entries))
+        os.rename(temp_filename, filename)
+    except:
+        # don't leave a partial snapshot behind
+        if os.path.exists(temp_filename):
+            os.remove(temp_filename)
+        raise
+    g_logger.debug("wrote snapshot of %d records to %s", len(path_index), filename)
+
+
+class MFTIndexSnapshot(object):
+    """
+    A snapshot file, memory mapped, from which the indexes of an MFT
+      are loaded without parsing its records.
+    """
+    def __init__(self, filename, key=None):
+        """
+        Constructor.
+        Arguments:
+        - `filename`: The path of the snapshot file.
+        - `key`: (Optional) The key the snapshot must have, as computed
+            by `snapshot_key` for the MFT being opened.
+
+        @raises SnapshotError: if the snapshot cannot be read, is of
+          another version, or has a different key.
+        """
+        super(MFTIndexSnapshot, self).__init__()
+        self._mmap = None
+        try:
+            with open(filename, "rb") as f:
+                self._mmap = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        except (IOError, OSError, ValueError) as e:
+            raise SnapshotError("failed to open snapshot: %s" % e)
+
+        try:
+            self._sections = self._read_header(key)
+        except (SnapshotError, struct.error) as e:
+            self.close()
+            if isinstance(e, struct.error):
+                e = SnapshotError("truncated snapshot")
+            raise e
+
+    def _read_header(self, key):
+        buf = self._mmap
+        magic, version, byte_order, stored_key, count, section_count = \
+            SNAPSHOT_HEADER.unpack_from(buf, 0)
+        if magic != SNAPSHOT_MAGIC:
+            raise SnapshotError("invalid magic")
+        if version != SNAPSHOT_VERSION:
+            raise SnapshotError("unsupported version: %d" % version)
+        if byte_order != _byte_order():
+            raise SnapshotError("snapshot written with another byte order")
+        if key is not None and stored_key != key:
+            raise SnapshotError("snapshot of another MFT")
+        self._count = count
+
+        sections = {}
+        for i in xrange(section_count):
+            name, kind, typecode, itemsize, offset, n = SNAPSHOT_SECTION.unpack_from(
+                buf, SNAPSHOT_HEADER.size + i * SNAPSHOT_SECTION.size)
+            name = name.rstrip("\x00")
+            if kind == SECTION_ARRAY:
+                if struct.calcsize(typecode) != itemsize:
+                    raise SnapshotError("snapshot written with another item size: %s" % name)
+                end = offset + itemsize * n
+                table = MappedArray(buf, offset, typecode, n)
+            elif kind == SECTION_BLOB:
+                end = offset + n
+                table = buffer(buf, offset, n)
+            elif kind == SECTION_NAMES:
+                end = offset + struct.calcsize("I") * (n + 1)
+                table = MappedNames(buf, offset, n)
+            else:
+                raise SnapshotError("unknown section kind: %r" % kind)
+            if end > len(buf):
+                raise SnapshotError("truncated section: %s" % name)
+            sections[name] = table
+        return sections
+
+    def __len__(self):
+        return self._count
+
+    def _tables(self, prefix):
+        prefix += "."
+        return dict((name[len(prefix):], table) for name, table in self._sections.iteritems()
+                    if name.startswith(prefix))
+
+    def path_index(self, upcase_table=None):
+        """
+        @rtype: MFTPathIndex
+        """
+        return MFTPathIndex.from_tables(self._tables("path"), upcase_table=upcase_table)
+
+    def tree(self):
+        """
+        @rtype: MFTTree
+        """
+        return MFTTree.from_tables(self._tables("tree"))
+
+    def close(self):
+        """
+        Release the memory map.
+        The indexes loaded from the snapshot may not be used after this.
+        """
+        if self._mmap is not None:
+            self._mmap.close()
+            self._mmap = None
+
+
+def test():
+    import tempfile
+
+    class FakeIndex(object):
+        def __init__(self, tables):
+            self._tables = tables
+
+        def tables(self):
+            return self._tables
+
+        def __len__(self):
+            return len(self._tables.get("valid", ()))
+
+    path_tables = {
+        "valid": array.array("B", [1, 0, 1]),
+        "parent": array.array("L", [5, 3, 0]),
+        "names": [u"a", u"", u"\xe9t\xe9"],
+    }
+    tree_tables = {"names": bytearray("abc")}
+
+    fd, filename = tempfile.mkstemp()
+    os.close(fd)
+    try:
+        write_snapshot(filename, "k" * 20, FakeIndex(path_tables), FakeIndex(tree_tables))
+        snapshot = MFTIndexSnapshot(filename, key="k" * 20)
+        assert len(snapshot) == 3
+        tables = snapshot._tables("path")
+        assert list(tables["valid"]) == [1, 0, 1]
+        assert list(tables["parent"]) == [5, 3, 0]
+        assert list(tables["names"]) == [u"a", u"", u"\xe9t\xe9"]
+        assert snapshot._tables("tree")["names"][1:3] == "bc"
+        snapshot.close()
+
+        try:
+            MFTIndexSnapshot(filename, key="x" * 20)
+        except SnapshotError:
+            pass
+        else:
+            assert False, "expected SnapshotError"
+
+        # a failed write leaves no partial snapshot behind
+        try:
+            write_snapshot(filename, "k" * 20, FakeIndex({"names": [None]}), FakeIndex({}))
+        except AttributeError:
+            pass
+        else:
+            assert False, "expected AttributeError"
+        assert not os.path.exists(filename + ".tmp")
+    finally:
+        os.remove(filename)
+
+    # a change to the header of any one record changes the key
+    mft = bytearray(MFT_RECORD_SIZE * (SNAPSHOT_KEY_CHUNK_SIZE + 101))
+    key = snapshot_key(1, mft)
+    for record_num in (0, 101, SNAPSHOT_KEY_CHUNK_SIZE + 100):
+        changed = bytearray(mft)
+        struct.pack_into("<Q", changed, record_num * MFT_RECORD_SIZE + 0x8, 1)
+        assert snapshot_key(1, changed) != key
+    assert snapshot_key(2, mft) != key
+    print "snapshot passed tests."
+
+
+if __name__ == "__main__":
+    test()
@@ -0,0 +1,335 @@
+#!/usr/bin/env python
+"""
+Stream the records of an MFT into a timeline.
+
+The timeline has a fixed schema: one row per MFT record, with the
+  record's path, size, flags, and the $STANDARD_INFORMATION and
+  $FILENAME_INFORMATION MACB timestamps.
+Rows are produced in batches of a bounded size, and each batch is
+  handed to a TimelineWriter (CSV, JSON Lines, or Parquet) before the
+  next batch is parsed, so memory usage does not grow with the MFT.
+"""
+import csv
+import json
+import logging
+from itertools import izip
+from collections import OrderedDict  # python 2.7 only
+
+from .. import Progress
+from .MFT import ATTR_TYPE
+from .MFT import FilenameAttribute
+from .MFT import StandardInformation
+
+
+g_logger = logging.getLogger("ntfs.mft.timeline")
+
+
+DEFAULT_BATCH_SIZE = 10000
+
+
+# list of tuple(name, type), where type is one of:
+#   - int
+#   - bool
+#   - str
+#   - timestamp (datetime.datetime, or None if invalid)
+TIMELINE_SCHEMA = [
+    ("record_number", "int"),
+    ("sequence_number", "int"),
+    ("active", "bool"),
+    ("directory", "bool"),
+    ("path", "str"),
+    ("filename", "str"),
+    ("size", "int"),
+    ("si_modified", "timestamp"),
+    ("si_accessed", "timestamp"),
+    ("si_changed", "timestamp"),
+    ("si_created", "timestamp"),
+    ("fn_modified", "timestamp"),
+    ("fn_accessed", "timestamp"),
+    ("fn_changed", "timestamp"),
+    ("fn_created", "timestamp"),
+]
+TIMELINE_FIELD_NAMES = [name for name, _ in TIMELINE_SCHEMA]
+
+
+class TimelineBatch(object):
+    """
+    A batch of timeline rows, stored by column.
+    The columns are ordered according to TIMELINE_SCHEMA.
+    """
+    def __init__(self):
+        super(TimelineBatch, self).__init__()
+        self.columns = OrderedDict((name, []) for name in TIMELINE_FIELD_NAMES)
+        self._column_lists = self.columns.values()
+
+    def __len__(self):
+        return len(self._column_lists[0])
+
+    def append(self, row):
+        """
+        @type row: sequence
+        @param row: The values of a row, ordered according to TIMELINE_SCHEMA.
+        """
+        for column, value in izip(self._column_lists, row):
+            column.append(value)
+
+    def rows(self):
+        """
+        A generator of the rows in this batch, as tuples.
+        """
+        return izip(*self._column_lists)
+
+
+def _safe_timestamp(f):
+    """
+    Timestamps that cannot be represented as a datetime are reported as None.
+    """
+    try:
+        return f()
+    except ValueError:
+        return None
+
+
+def _parse_attributes(record):
+    """
+    Find the attributes of a record needed for its timeline row
+      in a single pass over its attributes.
+    The $FILENAME_INFORMATION is chosen like
+      `MFTRecord.filename_information`.
+
+    @rtype: tuple(StandardInformation, FilenameAttribute, Attribute)
+    @return: The $STANDARD_INFORMATION, $FILENAME_INFORMATION, and
+      default $DATA attribute, any of which may be None.
+    """
+    si = None
+    fn = None
+    data_attribute = None
+    for attribute in record.attributes():
+        type_ = attribute.type()
+        if type_ == ATTR_TYPE.STANDARD_INFORMATION and si is None:
+            si = StandardInformation(attribute.value(), 0, record)
+        elif type_ == ATTR_TYPE.FILENAME_INFORMATION:
+            try:
+                check = FilenameAttribute(attribute.value(), 0, record)
+            except Exception:
+                continue
+            if fn is None or fn.filename_type() not in (0x0001, 0x0003):
+                fn = check
+        elif type_ == ATTR_TYPE.DATA and data_attribute is None and \
+             attribute.name_length() == 0:
+            data_attribute = attribute
+    return si, fn, data_attribute
+
+
+def _record_size(record, fn, data_attribute):
+    """
+    Like NTFSFileMetadataMixin.get_size, but from the record alone.
+    """
+    if record.is_directory():
+        return 0
+    if data_attribute is not None:
+        if data_attribute.non_resident() == 0:
+            return data_attribute.value_length()
+        else:
+            return data_attribute.data_size()
+    if fn is not None:
+        return fn.logical_size()
+    return 0
+
+
+class TimelineExporter(object):
+    """
+    Stream the records of an MFTEnumerator as TimelineBatches.
+    """
+    def __init__(self, enumerator, batch_size=DEFAULT_BATCH_SIZE):
+        """
+        Constructor.
+        Arguments:
+        - `enumerator`: An MFTEnumerator.
+        - `batch_size`: The maximum number of rows in each batch.
+        """
+        super(TimelineExporter, self).__init__()
+        self._enumerator = enumerator
+        self._batch_size = batch_size
+        self._path_index = None
+
+    def row(self, record):
+        """
+        Get the timeline row for the given record.
+
+        @type record: MFTRecord or MFTRecordView
+        @rtype: tuple
+        """
+        si, fn, data_attribute = _parse_attributes(record)
+
+        if fn is not None:
+            filename = fn.filename()
+            fn_times = (_safe_timestamp(fn.modified_time),
+                        _safe_timestamp(fn.accessed_time),
+                        _safe_timestamp(fn.changed_time),
+                        _safe_timestamp(fn.created_time))
+        else:
+            filename = ""
+            fn_times = (None, None, None, None)
+
+        if si is not None:
+            si_times = (_safe_timestamp(si.modified_time),
+                        _safe_timestamp(si.accessed_time),
+                        _safe_timestamp(si.changed_time),
+                        _safe_timestamp(si.created_time))
+        else:
+            si_times = (None, None, None, None)
+
+        return (record.inode,
+                record.sequence_number(),
+                bool(record.is_active()),
+                bool(record.is_directory()),
+                self._get_path(record),
+                filename,
+                _record_size(record, fn, data_attribute)) + si_times + fn_times
+
+    def _get_path(self, record):
+        if self._path_index is not None:
+            return self._path_index.get_path(record.inode)
+        return self._enumerator.get_path(record)
+
+    def batches(self):
+        """
+        A generator of TimelineBatches that cover all the records
+          of the MFT, in record number order.
+        The paths are resolved using an MFTPathIndex, which is built
+          before the first batch is parsed.
+        """
+        self._path_index = self._enumerator.build_path_index()
+        batch = TimelineBatch()
+        for record in self._enumerator.enumerate_record_views():
+            batch.append(self.row(record))
+            if len(batch) >= self._batch_size:
+                yield batch
+                batch = TimelineBatch()
+        if len(batch) > 0:
+            yield batch
+
+    def export(self, writer, progress_class=Progress.NullProgress):
+        """
+        Write all the records of the MFT to the given TimelineWriter,
+          and then close it.
+
+        @type writer: TimelineWriter
+        @rtype: int
+        @return: The number of rows written.
+        """
+        count = 0
+        progress = progress_class(self._enumerator.len())
+        try:
+            for batch in self.batches():
+                writer.write_batch(batch)
+                count += len(batch)
+                progress.set_current(count)
+        finally:
+            writer.close()
+        progress.set_complete()
+        return count
+
+
+class TimelineWriter(object):
+    """
+    interface
+    """
+    def write_batch(self, batch):
+        """
+        @type batch: TimelineBatch
+        """
+        raise NotImplementedError()
+
+    def close(self):
+        pass
+
+
+def _format_text_value(value):
+    if value is None:
+        return ""
+    if hasattr(value, "isoformat"):
+        return value.isoformat()
+    if isinstance(value, unicode):
+        return value.encode("utf-8")
+    return value
+
+
+class CSVTimelineWriter(TimelineWriter):
+    """
+    Write the timeline as CSV with a header row.
+    Text is UTF-8 encoded, and timestamps are in ISO 8601 format.
+    """
+    def __init__(self, f):
+        """
+        @param f: A file-like object opened for writing in binary mode.
+        """
+        super(CSVTimelineWriter, self).__init__()
+        self._writer = csv.writer(f)
+        self._writer.writerow(TIMELINE_FIELD_NAMES)
+
+    def write_batch(self, batch):
+        writerow = self._writer.writerow
+        for row in batch.rows():
+            writerow([_format_text_value(v) for v in row])
+
+
+class JSONLinesTimelineWriter(TimelineWriter):
+    """
+    Write the timeline as one JSON object per line.
+    Timestamps are in ISO 8601 format, or null if invalid.
+    """
+    def __init__(self, f):
+        """
+        @param f: A file-like object opened for writing.
+        """
+        super(JSONLinesTimelineWriter, self).__init__()
+        self._f = f
+
+    def write_batch(self, batch):
+        lines = []
+        for row in batch.rows():
+            values = [v.isoformat() if hasattr(v, "isoformat") else v
+                      for v in row]
+            lines.append(json.dumps(OrderedDict(izip(TIMELINE_FIELD_NAMES, values))))
+        lines.append("")
+        self._f.write("\n".join(lines))
+
+
+class ParquetTimelineWriter(TimelineWriter):
+    """
+    Write the timeline as a columnar Parquet file, with one row group
+      per batch.
+
+    Requires the `pyarrow` module.
+    """
+    def __init__(self, filename):
+        """
+        @type filename: str
+        @param filename: The path of the Parquet file to create.
+        """
+        import pyarrow
+        import pyarrow.parquet
+        super(ParquetTimelineWriter, self).__init__()
+        self._pyarrow = pyarrow
+
+        types = {
+            "int": pyarrow.int64(),
+            "bool": pyarrow.bool_(),
+            "str": pyarrow.string(),
+            "timestamp": pyarrow.timestamp("us"),
+        }
+        self._schema = pyarrow.schema([pyarrow.field(name, types[type_])
+                                       for name, type_ in TIMELINE_SCHEMA])
+        self._writer = pyarrow.parquet.ParquetWriter(filename, self._schema)
+
+    def write_batch(self, batch):
+        pyarrow = self._pyarrow
+        arrays = [pyarrow.array(column, type=field.type)
+                  for column, field in izip(batch.columns.values(), self._schema)]
+        table = pyarrow.Table.from_arrays(arrays, schema=self._schema)
+        self._writer.write_table(table)
+
+    def close(self):
+        self._writer.close()
@@ -1,4 +1,7 @@
 
 __all__ = [
     "MFT",
+    "Timeline",
+    "Parallel",
+    "Snapshot",
 ]
@@ -0,0 +1,357 @@
+#!/usr/bin/env python
+"""
+Find the NTFS volumes in a disk image, using its MBR or GPT partition table,
+  and analyze them concurrently.
+"""
+import struct
+import logging
+import multiprocessing
+
+from ntfs.BinaryParser import Mmap
+from ntfs.BinaryParser import Block
+from ntfs.BinaryParser import StructLayout
+from ntfs.BinaryParser import layout
+from ntfs.BinaryParser import OverrunBufferException
+from ntfs.volume import FlatVolume
+from ntfs.filesystem import NTFSVBR
+from ntfs.filesystem import NTFSFilesystem
+from ntfs.filesystem import FileSystemError
+from ntfs.mft.MFT import InvalidRecordException
+
+
+g_logger = logging.getLogger("ntfs.volume.partitions")
+
+
+SECTOR_SIZE = 512
+BOOT_SIGNATURE = 0xAA55
+GPT_SIGNATURE = "EFI PART"
+NTFS_OEM_ID = struct.unpack("<Q", "NTFS    ")[0]
+
+MBR_PARTITION_TABLE_OFFSET = 0x1BE
+MBR_PARTITION_ENTRY_SIZE = 0x10
+MBR_PARTITION_ENTRY_COUNT = 4
+MBR_BOOT_SIGNATURE_OFFSET = 0x1FE
+
+
+class MBR_PARTITION_TYPES:
+    EMPTY = 0x00
+    EXTENDED_CHS = 0x05
+    NTFS = 0x07
+    EXTENDED_LBA = 0x0F
+    LINUX_EXTENDED = 0x85
+    GPT_PROTECTIVE = 0xEE
+
+
+EXTENDED_PARTITION_TYPES = (MBR_PARTITION_TYPES.EXTENDED_CHS,
+                            MBR_PARTITION_TYPES.EXTENDED_LBA,
+                            MBR_PARTITION_TYPES.LINUX_EXTENDED)
+
+
+@layout(StructLayout([
+    ("byte", "status", 0x0),
+    ("binary", "first_chs", None, 3),
+    ("byte", "partition_type"),
+    ("binary", "last_chs", None, 3),
+    ("dword", "first_lba"),
+    ("dword", "sector_count"),
+]))
+class MBRPartitionEntry(Block):
+    def __init__(self, buf, offset, parent):
+        super(MBRPartitionEntry, self).__init__(buf, offset)
+        self.unpack_layout(self.LAYOUT)
+
+
+@layout(StructLayout([
+    ("binary", "signature", 0x0, 8),
+    ("dword", "revision"),
+    ("dword", "header_size"),
+    ("dword", "header_crc32"),
+    ("dword", "reserved"),
+    ("qword", "current_lba"),
+    ("qword", "backup_lba"),
+    ("qword", "first_usable_lba"),
+    ("qword", "last_usable_lba"),
+    ("binary", "disk_guid_binary", None, 16),
+    ("qword", "partition_entries_lba"),
+    ("dword", "partition_entry_count"),
+    ("dword", "partition_entry_size"),
+    ("dword", "partition_entries_crc32"),
+]))
+class GPTHeader(Block):
+    def __init__(self, buf, offset, parent):
+        super(GPTHeader, self).__init__(buf, offset)
+        self.unpack_layout(self.LAYOUT)
+
+    def disk_guid(self):
+        return self.unpack_guid(0x38)
+
+
+@layout(StructLayout([
+    ("binary", "type_guid_binary", 0x0, 16),
+    ("binary", "unique_guid_binary", None, 16),
+    ("qword", "first_lba"),
+    ("qword", "last_lba"),  # inclusive
+    ("qword", "attributes"),
+]))
+class GPTPartitionEntry(Block):
+    def __init__(self, buf, offset, parent):
+        super(GPTPartitionEntry, self).__init__(buf, offset)
+        self.unpack_layout(self.LAYOUT)
+
+    def type_guid(self):
+        return self.unpack_guid(0x0)
+
+    def unique_guid(self):
+        return self.unpack_guid(0x10)
+
+    def is_empty(self):
+        return self.type_guid_binary() == "\x00" * 16
+
+    def name(self):
+        return self.unpack_wstring(0x38, 36).partition(u"\x00")[0]
+
+
+class Partition(object):
+    """
+    A partition found in a partition table.
+    """
+    def __init__(self, index, offset, length, partition_type, name=""):
+        """
+        Constructor.
+        Arguments:
+        - `index`: The index of the partition within the partition table.
+            Logical partitions in an MBR extended partition are numbered
+            from 4.
+        - `offset`: The offset of the partition, in bytes.
+        - `length`: The length of the partition, in bytes.
+        - `partition_type`: The MBR partition type (int), or
+            GPT partition type GUID (str).
+        - `name`: The GPT partition name, if any.
+        """
+        super(Partition, self).__init__()
+        self.index = index
+        self.offset = offset
+        self.length = length
+        self.partition_type = partition_type
+        self.name = name
+
+    def __repr__(self):
+        return "Partition(index=%d, offset=%s, length=%s, type=%r)" % \
+            (self.index, hex(self.offset), hex(self.length), self.partition_type)
+
+
+def _has_boot_signature(buf, offset):
+    try:
+        return struct.unpack_from("<H", buf[offset + MBR_BOOT_SIGNATURE_OFFSET:
+                                            offset + MBR_BOOT_SIGNATURE_OFFSET + 2])[0] == BOOT_SIGNATURE
+    except struct.error:
+        return False
+
+
+def _mbr_entries(buf, offset):
+    """
+    @rtype: list of tuple(int, MBRPartitionEntry)
+    @return: The slot within the partition table, and the entry, of
+      the non-empty entries of the MBR or EBR at the given offset.
+    """
+    ret = []
+    for i in xrange(MBR_PARTITION_ENTRY_COUNT):
+        entry = MBRPartitionEntry(buf, offset + MBR_PARTITION_TABLE_OFFSET +
+                                  i * MBR_PARTITION_ENTRY_SIZE, None)
+        if entry.partition_type() == MBR_PARTITION_TYPES.EMPTY or \
+           entry.sector_count() == 0:
+            continue
+        ret.append((i, entry))
+    return ret
+
+
+def _parse_extended_partition(buf, extended_lba, sector_size, first_index):
+    """
+    Walk the chain of EBRs in an extended partition.
+    The logical partition of each EBR is relative to the EBR, while
+      the link to the next EBR is relative to the extended partition.
+
+    @rtype: list of Partition
+    """
+    ret = []
+    seen = set()
+    ebr_lba = extended_lba
+    while ebr_lba not in seen:
+        seen.add(ebr_lba)
+        ebr_offset = ebr_lba * sector_size
+        if not _has_boot_signature(buf, ebr_offset):
+            g_logger.warning("invalid EBR at %s", hex(ebr_offset))
+            break
+
+        next_ebr_lba = None
+        for _, entry in _mbr_entries(buf, ebr_offset):
+            if entry.partition_type() in EXTENDED_PARTITION_TYPES:
+                next_ebr_lba = extended_lba + entry.first_lba()
+            else:
+                ret.append(Partition(first_index + len(ret),
+                                     (ebr_lba + entry.first_lba()) * sector_size,
+                                     entry.sector_count() * sector_size,
+                                     entry.partition_type()))
+        if next_ebr_lba is None:
+            break
+        ebr_lba = next_ebr_lba
+    return ret
+
+
+def parse_mbr(buf, sector_size=SECTOR_SIZE):
+    """
+    Parse the MBR partition table, including the logical partitions
+      of any extended partition.
+
+    @rtype: list of Partition
+    @return: The partitions, or the empty list if there is no MBR.
+    """
+    if not _has_boot_signature(buf, 0):
+        return []
+
+    ret = []
+    logical = []
+    for i, entry in _mbr_entries(buf, 0):
+        if entry.partition_type() in EXTENDED_PARTITION_TYPES:
+            logical.extend(_parse_extended_partition(buf, entry.first_lba(), sector_size,
+                                                     MBR_PARTITION_ENTRY_COUNT + len(logical)))
+            continue
+        ret.append(Partition(i,
+                             entry.first_lba() * sector_size,
+                             entry.sector_count() * sector_size,
+                             entry.partition_type()))
+    return ret + logical
+
+
+def parse_gpt(buf, sector_size=SECTOR_SIZE):
+    """
+    Parse the GPT partition table, whose header is found in the second sector.
+
+    @rtype: list of Partition
+    @return: The partitions, or the empty list if there is no GPT.
+    """
+    header = GPTHeader(buf, sector_size, None)
+    if header.signature() != GPT_SIGNATURE:
+        return []
+
+    ret = []
+    entries_offset = header.partition_entries_lba() * sector_size
+    for i in xrange(header.partition_entry_count()):
+        entry = GPTPartitionEntry(buf, entries_offset + i * header.partition_entry_size(), None)
+        if entry.is_empty():
+            continue
+        ret.append(Partition(i,
+                             entry.first_lba() * sector_size,
+                             (entry.last_lba() - entry.first_lba() + 1) * sector_size,
+                             entry.type_guid(),
+                             name=entry.name()))
+    return ret
+
+
+def find_partitions(buf, sector_size=SECTOR_SIZE):
+    """
+    Parse the partition table of a disk image. If the MBR is a GPT
+      protective MBR, then the GPT partition table is used.
+
+    @rtype: list of Partition
+    """
+    try:
+        partitions = parse_mbr(buf, sector_size=sector_size)
+        if any(p.partition_type == MBR_PARTITION_TYPES.GPT_PROTECTIVE for p in partitions):
+            return parse_gpt(buf, sector_size=sector_size)
+        return partitions
+    except OverrunBufferException as e:
+        g_logger.warning("failed to parse partition table: %s", e)
+        return []
+
+
+def is_ntfs_volume(volume):
+    """
+    Does the volume start with an NTFS VBR?
+
+    @type volume: Volume
+    @rtype: bool
+    """
+    try:
+        vbr = NTFSVBR(volume)
+        return vbr.oem_id() == NTFS_OEM_ID and vbr.end_of_sector() == BOOT_SIGNATURE
+    except OverrunBufferException:
+        return False
+
+
+def find_ntfs_volumes(buf, sector_size=SECTOR_SIZE):
+    """
+    Find the NTFS volumes in a disk image, using its partition table.
+    The image itself may be an NTFS volume, without a partition table.
+
+    @rtype: list of FlatVolume
+    """
+    # a VBR also ends with the boot signature, so check for it
+    #  before reading its boot code as a partition table
+    volume = FlatVolume(buf, 0, sector_size=sector_size)
+    if is_ntfs_volume(volume):
+        return [volume]
+
+    ret = []
+    for partition in find_partitions(buf, sector_size=sector_size):
+        if partition.offset >= len(buf):
+            g_logger.warning("partition %d starts past the end of the image", partition.index)
+            continue
+        volume = FlatVolume(buf, partition.offset, sector_size=sector_size)
+        if is_ntfs_volume(volume):
+            ret.append(volume)
+    return ret
+
+
+def _analyze_volume(args):
+    """
+    Open the filesystem on the volume at the given offset in a disk
+      image, in a worker process, and call the given function with it.
+    A volume that cannot be opened yields None, rather than failing
+      the analysis of every other volume.
+    """
+    filename, offset, func = args
+    with Mmap(filename) as buf:
+        try:
+            filesystem = NTFSFilesystem(FlatVolume(buf, offset))
+        except (FileSystemError, InvalidRecordException,
+                OverrunBufferException, struct.error) as e:
+            g_logger.warning("failed to open filesystem at %s: %s", hex(offset), e)
+            return None
+        return func(filesystem)
+
+
+def analyze_volumes(filename, func, workers=None):
+    """
+    Open an NTFSFilesystem on each NTFS volume in a disk image, and call
+      the given function with each, concurrently, in a pool of worker
+      processes. Each worker opens its own memory map of the image.
+
+    The function must be defined at the top level of a module,
+      and its result must be picklable.
+
+    @type filename: str
+    @type func: callable
+    @param workers: The number of worker processes. Defaults to the
+      number of volumes, or the number of CPUs, whichever is fewer.
+    @rtype: list of tuple(int, object)
+    @return: The offset of each volume, and the result of the function,
+      which is None if the filesystem could not be opened.
+    """
+    with Mmap(filename) as buf:
+        offsets = [volume.offset() for volume in find_ntfs_volumes(buf)]
+    if not offsets:
+        return []
+
+    if workers is None:
+        workers = min(len(offsets), multiprocessing.cpu_count())
+    pool = multiprocessing.Pool(workers)
+    try:
+        results = pool.map(_analyze_volume,
+                           [(filename, offset, func) for offset in offsets],
+                           chunksize=1)
+        pool.close()
+    finally:
+        pool.terminate()
+        pool.join()
+    return zip(offsets, results)
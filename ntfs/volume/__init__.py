@@ -1,5 +1,10 @@
+import os
+import mmap
+import bisect
+
 from ntfs.BinaryParser import Block
 from ntfs.BinaryParser import Mmap
+from ntfs.BinaryParser import view_buffer
 from ntfs.FileMap import FileMap
 
 
@@ -20,6 +25,12 @@ class Volume(Block):
     def __getslice__(self, start, end):
         return self._buf[start + self._offset:end + self._offset]
 
+    def view(self, start, end):
+        """
+        Like a slice, but without copying the bytes, if possible.
+        """
+        return view_buffer(self._buf, start + self._offset, end + self._offset)
+
     def __len__(self):
         return len(self._buf) - self._offset
 
@@ -32,14 +43,151 @@ class FlatVolume(Volume):
         super(FlatVolume, self).__init__(buf, offset, sector_size=sector_size)
 
 
+class SegmentedBuffer(object):
+    """
+    A logical buffer made of the concatenation of a sequence of buffers,
+      such as the memory maps of the segments of a split image.
+    Use this like a bytestring, or as the buffer of a FlatVolume.
+
+    The segment that contains an offset is found with a binary search
+      over the segment offsets, and only slices that cross a segment
+      boundary are assembled from more than one segment.
+    """
+    __unpackable__ = True
+    def __init__(self, buffers):
+        """
+        @type buffers: sequence of buffers
+        @param buffers: The segments, in order. Empty segments are ignored.
+        """
+        super(SegmentedBuffer, self).__init__()
+        self._buffers = [b for b in buffers if len(b) > 0]
+        # the logical offset at which each segment starts,
+        #  followed by the total length
+        self._offsets = [0]
+        for b in self._buffers:
+            self._offsets.append(self._offsets[-1] + len(b))
+        self._size = self._offsets[-1]
+
+    def _get_segment_index(self, index):
+        return bisect.bisect_right(self._offsets, index) - 1
+
+    def __getitem__(self, index):
+        if index < 0:
+            index = self._size + index
+        if not 0 <= index < self._size:
+            raise IndexError("%d is beyond the segmented buffer length %d" %
+                             (index, self._size))
+        segment_index = self._get_segment_index(index)
+        return self._buffers[segment_index][index - self._offsets[segment_index]]
+
+    def _get_range(self, start, end, view=False):
+        end = min(end, self._size)
+        if end <= start:
+            return ""
+
+        first_segment = self._get_segment_index(start)
+        last_segment = self._get_segment_index(end - 1)
+        if first_segment == last_segment:
+            # everything falls within the same segment
+            segment_start = self._offsets[first_segment]
+            buf = self._buffers[first_segment]
+            if view:
+                return view_buffer(buf, start - segment_start, end - segment_start)
+            return buf[start - segment_start:end - segment_start]
+
+        parts = []
+        for segment_index in xrange(first_segment, last_segment + 1):
+            segment_start = self._offsets[segment_index]
+            s = max(start, segment_start) - segment_start
+            e = min(end, self._offsets[segment_index + 1]) - segment_start
+            parts.append(self._buffers[segment_index][s:e])
+        return "".join(parts)
+
+    def __getslice__(self, start, end):
+        return self._get_range(start, end)
+
+    def view(self, start, end):
+        """
+        Like a slice, but without copying the bytes, if the slice
+          falls within a single segment.
+        """
+        return self._get_range(start, end, view=True)
+
+    def __len__(self):
+        return self._size
+
+
+class SegmentedMmap(object):
+    """
+    Convenience class for opening read-only memory maps for the segments
+      of a split image, as a single SegmentedBuffer.
+    """
+    def __init__(self, filenames):
+        """
+        @type filenames: sequence of str
+        @param filenames: The paths of the segments, in order.
+          See `find_segments`.
+        """
+        super(SegmentedMmap, self).__init__()
+        self._filenames = filenames
+        self._files = []
+        self._mmaps = []
+
+    def __enter__(self):
+        for filename in self._filenames:
+            f = open(filename, "rb")
+            self._files.append(f)
+            if os.fstat(f.fileno()).st_size == 0:
+                # empty files cannot be mapped
+                continue
+            self._mmaps.append(mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ))
+        return SegmentedBuffer(self._mmaps)
+
+    def __exit__(self, type, value, traceback):
+        for m in self._mmaps:
+            m.close()
+        for f in self._files:
+            f.close()
+        self._mmaps = []
+        self._files = []
+
+
+def find_segments(filename):
+    """
+    Find the paths of the segments of a split image, given the path of
+      its first segment, such as `image.001`. The following segments
+      have the same name, with sequentially numbered extensions of
+      the same width, such as `image.002` and `image.003`.
+
+    If the extension is not a number, then the image is not split,
+      and the given path is the only segment.
+
+    @rtype: list of str
+    """
+    base, extension = os.path.splitext(filename)
+    digits = extension[1:]
+    if not digits.isdigit():
+        return [filename]
+
+    ret = []
+    number = int(digits)
+    while True:
+        segment = "%s.%0*d" % (base, len(digits), number)
+        if not os.path.exists(segment):
+            break
+        ret.append(segment)
+        number += 1
+    return ret
+
+
 def main():
     import sys
 
     # two methods
     with open(sys.argv[1], "rb") as f:
-        buf = FileMap(f)
-        v = FlatVolume(buf, int(sys.argv[2]))
-        print list(v[3:3+4])
+        with FileMap(f, readahead=4) as buf:
+            v = FlatVolume(buf, int(sys.argv[2]))
+            print list(v[3:3+4])
 
     # probably prefer this one
     with Mmap(sys.argv[1]) as buf: